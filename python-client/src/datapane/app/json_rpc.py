@@ -9,6 +9,7 @@ from datapane.client import log
 from datapane.client.analytics import capture
 
 from .runtime import GlobalState, apply_ref, get_session_state
+from .table_query import query_datatable
 
 RPC_JSON = t.Union[str, int, float, bool, None, t.Mapping[str, t.Any], t.List[t.Any]]
 JListDict = t.Union[t.List[t.Any], t.Dict[str, t.Any]]
@@ -110,6 +111,8 @@ def _app_rpc_call(g_s: GlobalState) -> t.Optional[t.Dict]:
                 # move into helper?
                 ref = s_s.entries[json_req.method]
                 res = apply_ref(g_s, s_s, ref, params=kwargs)
+            elif f_name == "datatable.query":
+                res = query_datatable(g_s, s_s, kwargs)
             else:
                 raise RPCException(-32601, f"Method '{f_name}' not found", _id)
 
@@ -11,6 +11,7 @@ import typing as t
 import uuid
 from pathlib import Path
 
+import pyarrow as pa
 from boltons.cacheutils import LRU
 from pydantic import ValidationError
 
@@ -18,9 +19,11 @@ import datapane._vendor.bottle as bt
 from datapane.blocks import Controls, Swap
 from datapane.client import log
 from datapane.processors import AppTransformations, ConvertXML, Pipeline, PreProcessView, ViewState
-from datapane.processors.file_store import GzipTmpFileEntry
+from datapane.processors.file_store import EncodedTmpFileEntry
 from datapane.view import Blocks
 
+from .table_query import TableCache
+
 if t.TYPE_CHECKING:
     from datapane.common.dp_types import SDict
 
@@ -77,10 +80,15 @@ class GlobalState:
     state: SDict = dc.field(default_factory=dict)
     server_id: str = dc.field(default_factory=lambda: uuid.uuid4().hex)
     function_cache: LRU[t.Tuple[str, bytes], ViewState] = dc.field(default_factory=lambda: LRU(max_size=128))
+    # DataTable assets and the rows selected by queries over them, see table_query
+    table_cache: TableCache = dc.field(default_factory=TableCache)
+    selection_cache: LRU[t.Tuple[str, str], t.Optional[pa.Array]] = dc.field(default_factory=lambda: LRU(max_size=64))
 
     def clear(self) -> None:
         """Wipe global state - called on app.close"""
         self.function_cache.clear()
+        self.table_cache.clear()
+        self.selection_cache.clear()
         self.state.clear()
         shutil.rmtree(self.app_dir, ignore_errors=True)
 
@@ -193,7 +201,7 @@ def apply_ref(g_s: GlobalState, s_s: SessionState, ref: FunctionRef, params: t.D
         assets_dir = g_s.app_dir / "assets"
 
         # write the app html and assets
-        vs = ViewState(blocks=blocks, file_entry_klass=GzipTmpFileEntry, dir_path=assets_dir)
+        vs = ViewState(blocks=blocks, file_entry_klass=EncodedTmpFileEntry, dir_path=assets_dir)
 
         return (
             Pipeline(vs)
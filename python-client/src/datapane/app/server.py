@@ -25,9 +25,10 @@ import datapane._vendor.bottle as bt
 from datapane.blocks import Controls
 from datapane.client import log
 from datapane.client.analytics import capture
-from datapane.common.dp_types import SECS_1_HOUR, SIZE_1_MB
+from datapane.common.dp_types import SECS_1_WEEK, SIZE_1_MB
 from datapane.common.utils import guess_type
 from datapane.ipython.environment import get_environment
+from datapane.processors.codecs import CODECS, Codec, IdentityCodec, negotiate
 from datapane.processors.processors import ExportBaseHTMLOnly
 from datapane.view import Blocks, BlocksT
 
@@ -91,14 +92,36 @@ def serve_file(global_state: GlobalState, filename: str):
     _ = get_session_state()
 
     # pull from the asset store, or directly from the file?
+    # assets are named by their contents, so can be cached without revalidation
     headers = {
-        "Content-Encoding": "gzip",
-        "Cache-Control": f"private, max-age={SECS_1_HOUR}, must-revalidate, no-transform, immutable",
+        "Cache-Control": f"private, max-age={SECS_1_WEEK}, no-transform, immutable",
+        "Vary": "Accept-Encoding",
     }
     root = global_state.app_dir / "assets"
     mime = guess_type(root / filename)
-    log.info(f"Serving asset file {filename=} ({mime=})")
-    return bt.static_file(filename=filename, root=root, mimetype=mime, headers=headers)
+
+    # entries are stored suffixed with their content-coding, choose the variant the client accepts
+    stored = [c for c in CODECS.values() if (root / f"{filename}{c.suffix}").is_file()]
+    if not stored:
+        return bt.HTTPError(404, "File does not exist.")
+    codec = negotiate(bt.request.get_header("Accept-Encoding"), stored)
+
+    if codec is None:
+        # no acceptable stored variant, so decode on the fly
+        codec = stored[0]
+        log.info(f"Serving decoded asset file {filename=} ({mime=}, {codec.encoding=})")
+        body = _decode_file(codec(), root / f"{filename}{codec.suffix}")
+        return bt.HTTPResponse(body, headers={**headers, "Content-Type": mime})
+
+    if codec is not IdentityCodec:
+        headers["Content-Encoding"] = codec.encoding
+    log.info(f"Serving asset file {filename=} ({mime=}, {codec.encoding=})")
+    return bt.static_file(filename=f"{filename}{codec.suffix}", root=root, mimetype=mime, headers=headers)
+
+
+def _decode_file(codec: Codec, path: Path) -> t.Iterator[bytes]:
+    with path.open("rb") as f:
+        yield from codec.decode(f)
 
 
 # See tests/client/test_server.py for important info on testing this code.
@@ -0,0 +1,261 @@
+"""
+Server-side queries over the DataTable assets of a served app, so large tables can be paged into the
+frontend, with any sorting, filtering and searching applied on the server using pyarrow.compute,
+rather than transferring and parsing the whole table in the browser
+"""
+from __future__ import annotations
+
+import base64
+import os
+import tempfile
+import threading
+import typing as t
+from collections import OrderedDict
+from contextlib import suppress
+from functools import reduce
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pydantic import BaseModel, StrictBool, StrictFloat, StrictInt, StrictStr, ValidationError, conint, root_validator
+
+from datapane.client import log
+from datapane.common import SIZE_1_MB, ArrowFormat
+from datapane.processors.codecs import CODECS, Codec
+
+if t.TYPE_CHECKING:
+    from .runtime import GlobalState, SessionState
+
+MAX_PAGE_ROWS = 10_000
+# bounds of the tables cached per app, memory-mapped tables only use memory as paged in by the OS,
+# whereas those decoded into memory, i.e. if their decoded variant can't be stored, count towards the size
+MAX_CACHED_TABLES = 16
+MAX_CACHED_DECODED_SIZE = 512 * SIZE_1_MB
+
+FilterOp = t.Literal["eq", "ne", "lt", "le", "gt", "ge", "contains", "not_contains", "begins"]
+_STR_OPS = ("contains", "not_contains", "begins")
+_COMPARE_OPS: t.Dict[str, t.Callable] = dict(
+    eq=pc.equal, ne=pc.not_equal, lt=pc.less, le=pc.less_equal, gt=pc.greater, ge=pc.greater_equal
+)
+
+
+class SortKey(BaseModel):
+    column: str
+    descending: bool = False
+
+
+class Filter(BaseModel):
+    column: str
+    op: FilterOp = "eq"
+    value: t.Union[StrictBool, StrictInt, StrictFloat, StrictStr, None] = None
+
+    @root_validator(skip_on_failure=True)
+    def check_str_op(cls, values: t.Dict) -> t.Dict:
+        if values["op"] in _STR_OPS and values["value"] is None:
+            raise ValueError(f"A value is required for the {values['op']} filter")
+        return values
+
+
+class TableQuery(BaseModel):
+    # the id of the DataTable asset
+    asset: str
+    offset: conint(ge=0) = 0  # type: ignore
+    limit: conint(gt=0, le=MAX_PAGE_ROWS) = 1000  # type: ignore
+    sort: t.List[SortKey] = []
+    filters: t.List[Filter] = []
+    # case-insensitive search over all string columns
+    search: t.Optional[str] = None
+
+    @property
+    def selection_key(self) -> t.Tuple:
+        """Key for the rows selected by the query, independent of the page"""
+        return (self.asset, self.json(include={"sort", "filters", "search"}))
+
+    class Config:
+        allow_mutation = False
+
+
+class TableCache:
+    """LRU cache of the tables loaded from DataTable assets, bounded by both the number of tables and the
+    total size of those decoded into memory - a decoded table larger than this isn't cached at all"""
+
+    def __init__(self, max_tables: int = MAX_CACHED_TABLES, max_decoded_size: int = MAX_CACHED_DECODED_SIZE):
+        self.max_tables = max_tables
+        self.max_decoded_size = max_decoded_size
+        # the table and its decoded size, or 0 if memory-mapped
+        self._tables: OrderedDict[str, t.Tuple[pa.Table, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def decoded_size(self) -> int:
+        return sum(size for (_, size) in self._tables.values())
+
+    def get(self, key: str) -> t.Optional[pa.Table]:
+        with self._lock:
+            entry = self._tables.get(key)
+            if entry is None:
+                return None
+            self._tables.move_to_end(key)
+            return entry[0]
+
+    def add(self, key: str, table: pa.Table, decoded: bool) -> None:
+        size = table.nbytes if decoded else 0
+        if size > self.max_decoded_size:
+            return
+        with self._lock:
+            self._tables[key] = (table, size)
+            self._tables.move_to_end(key)
+            # evict the least-recently used tables, only those decoded if over the decoded size
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+            while self.decoded_size > self.max_decoded_size:
+                del self._tables[next(k for (k, (_, size)) in self._tables.items() if size)]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._tables
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+
+
+def query_datatable(g_s: GlobalState, s_s: SessionState, params: t.Dict) -> t.Dict:
+    """Return a page of rows from the DataTable asset, as a base64-encoded Arrow IPC stream, along with the counts"""
+    from .json_rpc import RPCException
+
+    try:
+        q = TableQuery(**params)
+    except ValidationError as e:
+        raise RPCException(-32602, "Invalid Parameters", data=e.errors()) from e
+
+    # only allow querying tables within the session
+    asset = s_s.assets.get(q.asset)
+    if asset is None or not asset["mime"].startswith(ArrowFormat.content_type):
+        raise RPCException(-32602, f"Unknown DataTable {q.asset}")
+
+    table = g_s.table_cache.get(q.asset)
+    if table is None:
+        table, decoded = _load_table(g_s, asset["src"].rsplit("/", 1)[-1])
+        g_s.table_cache.add(q.asset, table, decoded)
+
+    try:
+        selection = g_s.selection_cache.get(q.selection_key)
+        if selection is None:
+            selection = g_s.selection_cache[q.selection_key] = _select(table, q)
+    except (KeyError, pa.ArrowException) as e:
+        raise RPCException(-32602, f"Invalid query - {e}") from e
+
+    if selection is None:
+        n_rows = table.num_rows
+        page = table.slice(q.offset, q.limit)
+    else:
+        n_rows = len(selection)
+        page = table.take(selection[q.offset : q.offset + q.limit])
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, page.schema) as writer:
+        writer.write_table(page)
+
+    return dict(
+        total_rows=table.num_rows,
+        rows=n_rows,
+        offset=q.offset,
+        data=base64.b64encode(sink.getvalue()).decode("ascii"),
+    )
+
+
+_decode_lock = threading.Lock()
+
+
+def _load_table(g_s: GlobalState, filename: str) -> t.Tuple[pa.Table, bool]:
+    """
+    Load the stored asset memory-mapped, and whether it was decoded into memory instead
+
+    Assets stored with a content-coding, e.g. gzip, are decoded once into an identity-coded variant alongside,
+    that's then memory-mapped by this and any later loads (and may be served to clients too)
+    """
+    root = g_s.app_dir / "assets"
+    path = root / filename
+    with _decode_lock:
+        if not path.is_file():
+            codec = next((c for c in CODECS.values() if (root / f"{filename}{c.suffix}").is_file()), None)
+            if codec is None:
+                raise FileNotFoundError(filename)
+            try:
+                _decode_file(codec(), root / f"{filename}{codec.suffix}", path)
+            except OSError as e:
+                log.warning(f"Couldn't store decoded asset {filename} ({e}), decoding into memory")
+                with (root / f"{filename}{codec.suffix}").open("rb") as f:
+                    return ArrowFormat.load_table(pa.BufferReader(b"".join(codec().decode(f)))), True
+    return ArrowFormat.load_table(path), False
+
+
+def _decode_file(codec: Codec, src: Path, dest: Path) -> None:
+    # decode into a temp file renamed once complete, so a partially decoded file is never loaded
+    fd, tmp = tempfile.mkstemp(prefix=".dp-tmp-", dir=dest.parent)
+    try:
+        with os.fdopen(fd, "wb") as out, src.open("rb") as f:
+            for chunk in codec.decode(f):
+                out.write(chunk)
+        os.replace(tmp, dest)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+def _values(table: pa.Table, column: str) -> pa.ChunkedArray:
+    # compare categories by their values
+    col = table.column(column)
+    return col.cast(col.type.value_type) if pa.types.is_dictionary(col.type) else col
+
+
+def _is_str(col: pa.ChunkedArray) -> bool:
+    return pa.types.is_string(col.type) or pa.types.is_large_string(col.type)
+
+
+def _filter_mask(table: pa.Table, f: Filter) -> pa.ChunkedArray:
+    col = _values(table, f.column)
+    if f.op in _STR_OPS:
+        col = col.cast(pa.string())
+        if f.op == "begins":
+            return pc.starts_with(col, str(f.value), ignore_case=True)
+        mask = pc.match_substring(col, str(f.value), ignore_case=True)
+        return mask if f.op == "contains" else pc.invert(mask)
+    if f.value is None:
+        return pc.is_null(col) if f.op == "eq" else pc.is_valid(col)
+    value = pa.scalar(f.value)
+    if not _is_str(col) and pa.types.is_string(value.type):
+        # e.g. dates as strings
+        value = value.cast(col.type)
+    return _COMPARE_OPS[f.op](col, value)
+
+
+def _select(table: pa.Table, q: TableQuery) -> t.Optional[pa.Array]:
+    """The indices of the rows selected by the query in order, or None if all rows in their original order"""
+    masks = [_filter_mask(table, f) for f in q.filters]
+    if q.search:
+        str_cols = [c for c in (_values(table, n) for n in table.column_names) if _is_str(c)]
+        search_masks = [pc.match_substring(c, q.search, ignore_case=True) for c in str_cols]
+        masks.append(reduce(pc.or_kleene, search_masks) if search_masks else pa.nulls(table.num_rows, pa.bool_()))
+
+    indices: t.Optional[pa.Array] = None
+    if masks:
+        mask = reduce(pc.and_kleene, masks).fill_null(False)
+        indices = pa.array(np.flatnonzero(np.asarray(mask)))
+
+    if q.sort:
+        sort_table = pa.table({f"{i}": _values(table, k.column) for (i, k) in enumerate(q.sort)})
+        if indices is not None:
+            sort_table = sort_table.take(indices)
+        order = pc.sort_indices(
+            sort_table,
+            sort_keys=[(f"{i}", "descending" if k.descending else "ascending") for (i, k) in enumerate(q.sort)],
+        )
+        indices = order if indices is None else indices.take(order)
+
+    return indices
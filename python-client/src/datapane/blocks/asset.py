@@ -1,14 +1,18 @@
 """Asset-based blocks"""
 from __future__ import annotations
 
+import json
 import typing as t
 from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
 from pandas.io.formats.style import Styler
 
+from datapane import optional_libs as opt
+from datapane.client import DPClientError
 from datapane.common import NPath, SSDict
-from datapane.common.df_processor import to_df
+from datapane.common.df_processor import summarise_columns, to_df, to_table, truncate_dataframe
 from datapane.common.viewxml_utils import mk_attribs
 
 from .base import BlockId, DataBlock
@@ -40,6 +44,8 @@ class AssetBlock(DataBlock):
         self.file = file
         self.caption = caption
         self.file_attribs: SSDict = dict()
+        # options passed to the asset writer, rather than stored as attributes
+        self.writer_options: t.Dict[str, t.Any] = dict()
 
     def get_file_attribs(self) -> SSDict:
         return self.file_attribs
@@ -118,6 +124,9 @@ class Attachment(AssetBlock):
         super().__init__(data=data, file=file, filename=filename, name=name, caption=caption, label=label)
 
 
+PlotFormat = t.Literal["auto", "svg", "png", "webp"]
+
+
 class Plot(AssetBlock):
     """
     Datapane supports all major Python visualization libraries, allowing you to add interactive plots and visualizations to your app.
@@ -138,6 +147,8 @@ class Plot(AssetBlock):
         scale: float = 1.0,
         name: BlockId = None,
         label: str = None,
+        format: PlotFormat = "auto",
+        dpi: t.Optional[int] = None,
     ):
         """
         Args:
@@ -147,8 +158,30 @@ class Plot(AssetBlock):
             scale: Set the scaling factor for the plt (optional, default = 1.0)
             name: A unique name for the block to reference when adding text or embedding (optional)
             label: A label used when displaying the block (optional)
+            format: The image format for matplotlib plots, one of svg, png, webp (matplotlib 3.6+) or auto, which uses png for plots with too many points to draw as an svg (optional, default: auto)
+            dpi: The resolution of png or webp matplotlib plots, defaulting to that of the figure (optional)
         """
+        if format not in t.get_args(PlotFormat):
+            raise DPClientError(f"Unknown plot format {format}, please choose from {t.get_args(PlotFormat)}")
+        if format == "webp" and opt.HAVE_MATPLOTLIB and not opt.HAVE_MATPLOTLIB_WEBP:
+            raise DPClientError(f"webp plots require matplotlib {opt.MPL_WEBP_V_SPECIFIER}, please upgrade or use png")
+        if dpi is not None and dpi <= 0:
+            raise DPClientError("dpi must be positive")
         super().__init__(data=data, caption=caption, responsive=responsive, scale=scale, name=name, label=label)
+        self.writer_options = dict(format=format, dpi=dpi)
+
+
+class VegaDataset(AssetBlock):
+    """
+    A DataFrame shared by Altair plots, stored once as a separate asset and referenced by name from
+    the spec of each plot using it (internal, created when building the view, not exported)
+    """
+
+    _tag = "VegaDataset"
+
+    def __init__(self, data: pd.DataFrame, name: str):
+        super().__init__(data=data)
+        self.writer_options = dict(name=name)
 
 
 class Table(AssetBlock):
@@ -183,7 +216,7 @@ class Table(AssetBlock):
 
 class DataTable(AssetBlock):
     """
-    The DataTable block takes a pandas DataFrame and renders an interactive, sortable, searchable table in your app, along with advanced analysis options such as exploring data through [SandDance](https://www.microsoft.com/en-us/research/project/sanddance/).
+    The DataTable block takes a pandas DataFrame (or an Arrow table or Polars DataFrame) and renders an interactive, sortable, searchable table in your app, along with advanced analysis options such as exploring data through [SandDance](https://www.microsoft.com/en-us/research/project/sanddance/).
 
     It supports large datasets and viewers can also download the table from the website as a CSV or Excel file.
 
@@ -192,24 +225,60 @@ class DataTable(AssetBlock):
     """
 
     _tag = "DataTable"
+    # the full dataset, stored as a separate asset, when only a preview is embedded
+    full: t.Optional[DataTable] = None
 
     def __init__(
         self,
-        df: pd.DataFrame,
+        df: t.Union[pd.DataFrame, pa.Table, pa.RecordBatchReader, t.Any],
         caption: t.Optional[str] = None,
         name: BlockId = None,
         label: str = None,
+        preview_rows: t.Optional[int] = None,
     ):
         """
         Args:
-            df: The pandas dataframe to attach to the report
+            df: The pandas dataframe, arrow table / record batch reader, or polars dataframe to attach to the report
             caption: A caption to display below the plot (optional)
             name: A unique name for the block to reference when adding text or embedding (optional)
             label: A label used when displaying the block (optional)
+            preview_rows: Only embed the first rows, along with a summary of each column, and load the full dataset when requested by the viewer (optional)
+
+        !!! note
+            Arrow tables and Polars DataFrames are written directly, without converting them to pandas
+
+        !!! tip
+            Use `preview_rows` for very large datasets, so the app loads quickly regardless of their size
         """
-        # create a copy of the df to process
-        df = to_df(df)
+        if opt.HAVE_POLARS and isinstance(df, opt.PLDataFrame):
+            df = df.to_arrow()
+
+        if isinstance(df, (pa.Table, pa.RecordBatchReader)):
+            # arrow data is immutable, so no need to copy
+            df = to_table(df)
+            (rows, columns) = (df.num_rows, df.num_columns)
+        else:
+            # snapshot the df to process, so later edits to it aren't reflected in the report
+            df = to_df(df)
+            (rows, columns) = df.shape
+        if preview_rows is not None and preview_rows < 1:
+            raise DPClientError("preview_rows must be positive")
+        if preview_rows is not None and rows > preview_rows:
+            self.full = DataTable._from_snapshot(df, rows, columns)
+            summary = json.dumps(summarise_columns(df), default=str)
+            df = df.slice(0, preview_rows) if isinstance(df, pa.Table) else truncate_dataframe(df, preview_rows, None)
+            preview_attribs = dict(preview_rows=preview_rows, summary=summary)
+        else:
+            preview_attribs = {}
+
         super().__init__(data=df, caption=caption, name=name, label=label)
         # TODO - support pyarrow schema for local reports
-        (rows, columns) = df.shape
-        self.file_attribs = mk_attribs(rows=rows, columns=columns, schema="[]")
+        self.file_attribs = mk_attribs(rows=rows, columns=columns, schema="[]", **preview_attribs)
+
+    @classmethod
+    def _from_snapshot(cls, df: t.Union[pd.DataFrame, pa.Table], rows: int, columns: int) -> DataTable:
+        """Create the block for an already snapshotted dataset, e.g. the full dataset of a preview, without copying it"""
+        dt = cls.__new__(cls)
+        AssetBlock.__init__(dt, data=df)
+        dt.file_attribs = mk_attribs(rows=rows, columns=columns, schema="[]")
+        return dt
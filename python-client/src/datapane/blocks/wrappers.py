@@ -6,6 +6,7 @@ import typing as t
 from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
 from altair.utils import SchemaBase
 from multimethod import multimethod
 
@@ -46,6 +47,18 @@ def convert_to_block(x: pd.DataFrame) -> DataBlock:
     return b.Table(x) if n_cells <= 250 else b.DataTable(x)
 
 
+@multimethod
+def convert_to_block(x: pa.Table) -> DataBlock:
+    return b.DataTable(x)
+
+
+if opt.HAVE_POLARS:
+
+    @multimethod
+    def convert_to_block(x: opt.PLDataFrame) -> DataBlock:
+        return b.DataTable(x)
+
+
 # Plots
 @multimethod
 def convert_to_block(x: SchemaBase) -> DataBlock:
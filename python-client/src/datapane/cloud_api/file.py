@@ -4,9 +4,11 @@ import json
 import os
 import pickle
 import typing as t
+from contextlib import suppress
 from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
 
 from datapane.client import DPClientError, log
 from datapane.common import PKL_MIMETYPE, ArrowFormat, NPath
@@ -21,7 +23,7 @@ def save_df(df: pd.DataFrame) -> DPTmpFile:
     """Export a df for uploading"""
     fn = DPTmpFile(ArrowFormat.ext)
 
-    # create a copy of the df to process
+    # create a shallow copy of the df to process, processing never mutates it
     df = to_df(df)
     if df.size == 0:
         raise DPClientError("Empty DataFrame provided")
@@ -104,9 +106,26 @@ class File(DPObjectRef):
         Returns:
             A pandas dataframe generated from the file
         """
-        with DPTmpFile(ArrowFormat.ext) as fn:
-            do_download_file(self.data_url, fn.name)
-            return ArrowFormat.load_file(fn.name)
+        return self._download_arrow(ArrowFormat.load_file)
+
+    def download_table(self) -> pa.Table:
+        """
+        Download the file and return it as an Arrow table, without converting to a Dataframe
+
+        Returns:
+            A pyarrow table, memory-mapped from the downloaded file
+        """
+        return self._download_arrow(ArrowFormat.load_table)
+
+    def _download_arrow(self, load: t.Callable[[str], t.Any]) -> t.Any:
+        fn = DPTmpFile(ArrowFormat.ext)
+        do_download_file(self.data_url, fn.name)
+        x = load(fn.name)
+        # the result may be memory-mapped from the file, which can be removed whilst mapped except on Windows,
+        # where it's instead removed on exit
+        with suppress(PermissionError):
+            fn.file.unlink()
+        return x
 
     def download_file(self, fn: NPath) -> None:
         """
@@ -1,28 +1,219 @@
 """Dataset Format handling"""
 import abc
 import enum
-from typing import IO, Dict, Type, Union
+import os
+from pathlib import Path
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple, Type, Union
 
 import pandas as pd
 import pyarrow as pa
+from pandas.core.dtypes.cast import find_common_type
 from pandas.errors import ParserError
 from pyarrow import RecordBatchFileWriter
+from pyarrow import csv as pa_csv
 
-from .df_processor import obj_to_str, process_df, str_to_arrow_str
-from .dp_types import ARROW_EXT, ARROW_MIMETYPE, MIME, log
+from .df_processor import (
+    PD_1_3_GREATER,
+    PD_VERSION,
+    ArrowLike,
+    category_criteria,
+    convert_axis,
+    obj_to_str,
+    process_df,
+    process_table,
+    str_to_arrow_str,
+    to_table,
+)
+from .dp_types import ARROW_EXT, ARROW_MIMETYPE, MIME, SIZE_1_MB, log
 from .utils import guess_encoding
 
+# approx. in-memory size of each chunk of rows processed and written when saving large dataframes
+ARROW_CHUNK_SIZE = 128 * SIZE_1_MB
+ARROW_COMPRESSIONS = ("lz4", "zstd")
+# size of the blocks CSVs are read and parsed in parallel in, column types are inferred from the first block
+CSV_BLOCK_SIZE = 16 * SIZE_1_MB
 
-def write_table(table: pa.Table, sink: Union[str, IO[bytes]]):
-    """Write an arrow table to a file"""
-    writer = RecordBatchFileWriter(sink, table.schema)
+
+def arrow_compression(compression: Optional[str] = None) -> Optional[str]:
+    """
+    The arrow IPC buffer compression to use, one of lz4, zstd or none,
+    defaulting to that set via `DATAPANE_ARROW_COMPRESSION`
+    NOTE - this is only for files read back by pyarrow, e.g. uploaded Files, as the report frontend
+    can't read compressed buffers, so DataTable assets are never compressed (see `DataTableWriter`)
+    """
+    compression = (compression or os.getenv("DATAPANE_ARROW_COMPRESSION") or "none").lower()
+    if compression == "none":
+        return None
+    if compression not in ARROW_COMPRESSIONS or not pa.Codec.is_available(compression):
+        raise ValueError(
+            f"Unknown or unavailable arrow compression {compression}, please choose from {ARROW_COMPRESSIONS}"
+        )
+    return compression
+
+
+def downcast_tolerance(tolerance: Optional[float] = None) -> Optional[float]:
+    """
+    The relative tolerance within which float64 columns are downcast to float32, or None to disable,
+    defaulting to that set via `DATAPANE_DOWNCAST_FLOATS`, either `exact` (or a boolean flag, e.g. `true`, `1`),
+    or a tolerance, e.g. `1e-6`
+    NOTE - this is disabled by default, as float32 values may differ from the originals within the tolerance
+    """
+    if tolerance is None:
+        env = (os.getenv("DATAPANE_DOWNCAST_FLOATS") or "").lower()
+        if env in ("", "0", "false", "no", "off", "none"):
+            return None
+        try:
+            tolerance = 0.0 if env in ("exact", "1", "true", "yes", "on") else float(env)
+        except ValueError:
+            raise ValueError(f"Invalid float downcasting tolerance {env}, please use exact or a number") from None
+    if not 0.0 <= tolerance < 1.0:
+        raise ValueError(f"Float downcasting tolerance {tolerance} must be in the range [0, 1)")
+    return tolerance
+
+
+def _writer(sink: Union[str, IO[bytes]], schema: pa.Schema, compression: Optional[str]) -> RecordBatchFileWriter:
+    return RecordBatchFileWriter(sink, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+
+def write_table(table: pa.Table, sink: Union[str, IO[bytes]], compression: Optional[str] = None):
+    """Write an arrow table to a file, optionally compressing the buffers"""
+    writer = _writer(sink, table.schema, compression)
     writer.write(table)
     writer.close()
 
 
+def chunk_rows(df: pd.DataFrame, chunk_size: int = ARROW_CHUNK_SIZE) -> int:
+    """Estimate the number of rows in each chunk of the given size, using the deep memory usage of the first rows"""
+    head = df.head(1000)
+    row_size = head.memory_usage(index=False, deep=True).sum() / max(len(head), 1)
+    return max(int(chunk_size // max(row_size, 1)), 1)
+
+
+def _iter_raw_chunks(df: pd.DataFrame, n_rows: int) -> Iterator[pd.DataFrame]:
+    for i in range(0, len(df), n_rows):
+        # shallow copy, so processing doesn't modify the source frame
+        chunk = df.iloc[i : i + n_rows].copy(deep=False)
+        # flatten the axes as when processing, so the columns line up with those of the processed chunk
+        convert_axis(chunk)
+        yield chunk
+
+
+def _iter_chunks(
+    df: pd.DataFrame, n_rows: int, float_tolerance: Optional[float] = None
+) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """Iterate over the chunks of rows, both unprocessed and processed"""
+    for raw in _iter_raw_chunks(df, n_rows):
+        yield raw, process_df(raw.copy(deep=False), float_tolerance=float_tolerance)
+
+
+def _is_str(dtype: Any) -> bool:
+    return isinstance(dtype, (pd.CategoricalDtype, pd.StringDtype))
+
+
+def _unify_dtypes(a: Any, b: Any) -> Any:
+    """The dtype of a column processed in separate chunks, as found from the dtypes of each chunk"""
+    if a == b:
+        return a
+    if _is_str(a) or _is_str(b):
+        return pd.StringDtype("pyarrow")
+    dtype = find_common_type([a, b])
+    return pd.StringDtype("pyarrow") if dtype == object else dtype
+
+
+def _str_uniques(ser: pd.Series) -> Optional[pd.Index]:
+    if isinstance(ser.dtype, pd.CategoricalDtype):
+        # only categories of strings, as created when processing, can be merged with other chunks
+        categories = ser.cat.categories
+        return categories if isinstance(categories.dtype, pd.StringDtype) else None
+    if isinstance(ser.dtype, pd.StringDtype):
+        return pd.Index(ser.dropna().unique(), dtype="string")
+    return None
+
+
+def write_table_chunked(
+    df: pd.DataFrame,
+    sink: Union[str, IO[bytes]],
+    n_rows: int,
+    compression: Optional[str] = None,
+    float_tolerance: Optional[float] = None,
+):
+    """
+    Process and write the dataframe in chunks of rows, each as a separate record batch, so only a
+    single processed chunk is held in memory at once.
+    NOTE - the chunks are processed twice, first to find a single schema for all chunks, as processing
+    may choose different dtypes per chunk. This includes finding the unique values of string columns
+    so categories are chosen using the full column, and with the same dictionary for each record batch,
+    as required by the file format. Columns with the same categorical dtype in every chunk, e.g. existing
+    categoricals, are kept as-is, whilst those only processed as strings in some chunks, e.g. mixed object
+    columns, are converted to strings from their unprocessed values, as when processing the whole column.
+    Likewise float columns are only downcast if safe in every chunk
+    """
+    max_nunique = max(20, int(0.05 * (len(df) + 1)))
+
+    def _track_uniques(u: Optional[pd.Index], ser: pd.Series) -> Optional[pd.Index]:
+        # stop tracking once there are too many unique values to be a category
+        su = _str_uniques(ser) if u is not None else None
+        u = u.union(su, sort=False) if su is not None else None
+        return u if u is not None and len(u) <= max_nunique else None
+
+    dtypes: List[Any] = []
+    uniques: List[Optional[pd.Index]] = []
+    # whether any chunk of the column wasn't processed as strings
+    non_str: List[bool] = []
+    for _, chunk in _iter_chunks(df, n_rows, float_tolerance):
+        if not dtypes:
+            dtypes = list(chunk.dtypes)
+            uniques = [pd.Index([], dtype="string")] * len(dtypes)
+            non_str = [False] * len(dtypes)
+        for i, (_, ser) in enumerate(chunk.items()):
+            dtypes[i] = _unify_dtypes(dtypes[i], ser.dtype)
+            if _is_str(ser.dtype):
+                uniques[i] = _track_uniques(uniques[i], ser)
+            else:
+                non_str[i] = True
+
+    # columns processed as strings overall, but not in every chunk, are converted from their unprocessed values
+    from_raw = [_is_str(d) and not isinstance(d, pd.CategoricalDtype) and n for (d, n) in zip(dtypes, non_str)]
+    if any(from_raw):
+        uniques = [pd.Index([], dtype="string") if r else u for (u, r) in zip(uniques, from_raw)]
+        for raw in _iter_raw_chunks(df, n_rows):
+            for i in (i for (i, r) in enumerate(from_raw) if r):
+                uniques[i] = _track_uniques(uniques[i], raw.iloc[:, i].astype("string"))
+
+    for i, u in enumerate(uniques):
+        if isinstance(dtypes[i], pd.CategoricalDtype):
+            # the same categories in every chunk, so kept, along with their order
+            continue
+        if u is not None and _is_str(dtypes[i]) and category_criteria(len(u), len(df)):
+            dtypes[i] = pd.CategoricalDtype(u.sort_values())
+        elif _is_str(dtypes[i]):
+            dtypes[i] = pd.StringDtype("pyarrow")
+
+    writer: Optional[RecordBatchFileWriter] = None
+    for raw, chunk in _iter_chunks(df, n_rows, float_tolerance):
+        cols = [
+            (raw.iloc[:, i].astype("string") if from_raw[i] else ser).astype(d, copy=False)
+            for (i, ((_, ser), d)) in enumerate(zip(chunk.items(), dtypes))
+        ]
+        chunk = pd.concat(cols, axis=1, copy=False, keys=chunk.columns)
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = _writer(sink, table.schema, compression)
+        writer.write(table)
+    assert writer is not None
+    writer.close()
+
+
 PathOrFile = Union[str, IO]
 
 
+def _types_mapper() -> Optional[Callable[[pa.DataType], Optional[Any]]]:
+    # map strings directly to the arrow string dtype, without converting via python objects (pandas >= 1.3 only)
+    if PD_VERSION in PD_1_3_GREATER:
+        return {pa.string(): pd.StringDtype("pyarrow")}.get
+    return None
+
+
 class DFFormatter(abc.ABC):
     # TODO - tie to mimetypes lib
     content_type: MIME
@@ -48,20 +239,77 @@ class ArrowFormat(DFFormatter):
     ext = ARROW_EXT
     enum = "ARROW"
 
+    @staticmethod
+    def load_table(fn: Union[PathOrFile, Path]) -> pa.Table:
+        """
+        Load the file as an arrow table, memory-mapping files given by path so the table references
+        the file contents rather than copying them (unless the buffers are compressed)
+        """
+        source = pa.memory_map(str(fn)) if isinstance(fn, (str, Path)) else fn
+        return pa.ipc.open_file(source).read_all()
+
     @staticmethod
     def load_file(fn: PathOrFile) -> pd.DataFrame:
-        df = pa.ipc.open_file(fn).read_pandas()
+        # NOTE - string columns use the arrow string dtype backed by the (memory-mapped) table
+        df = ArrowFormat.load_table(fn).to_pandas(types_mapper=_types_mapper())
         # NOTE - need to convert categories from object to string https://github.com/apache/arrow/issues/33070
         obj_to_str(df)
         str_to_arrow_str(df)
         return df
 
     @staticmethod
-    def save_file(fn: PathOrFile, df: pd.DataFrame):
-        df = process_df(df)
+    def save_file(
+        fn: PathOrFile,
+        df: pd.DataFrame,
+        chunk_size: int = ARROW_CHUNK_SIZE,
+        compression: Optional[str] = None,
+        float_tolerance: Optional[float] = None,
+    ):
+        """
+        Save the dataframe, processing and writing it in chunks of rows if larger than the chunk size,
+        compressing the buffers if set (see `arrow_compression`),
+        and downcasting float columns within the tolerance if set (see `downcast_tolerance`)
+        """
+        compression = arrow_compression(compression)
+        tolerance = downcast_tolerance(float_tolerance)
+        n_rows = chunk_rows(df, chunk_size)
+        # NOTE - chunking uses the arrow string dtype, so requires pandas >= 1.3
+        if len(df) > n_rows and PD_VERSION in PD_1_3_GREATER:
+            log.debug(f"Writing dataframe in chunks of {n_rows} rows")
+            write_table_chunked(df, fn, n_rows, compression, tolerance)
+            return
+
+        df = process_df(df, copy=True, float_tolerance=tolerance)
         # NOTE - can pass expected schema and columns for output df here
         table: pa.Table = pa.Table.from_pandas(df, preserve_index=False)
-        write_table(table, fn)
+        write_table(table, fn, compression)
+
+    @staticmethod
+    def save_table(
+        fn: PathOrFile, table: ArrowLike, compression: Optional[str] = None, float_tolerance: Optional[float] = None
+    ):
+        """Save the arrow table or batch reader, processing it natively rather than via a dataframe"""
+        table = process_table(to_table(table), downcast_tolerance(float_tolerance))
+        write_table(table, fn, arrow_compression(compression))
+
+
+def _rewind(fn: PathOrFile) -> PathOrFile:
+    # file objects are read from the start each time
+    if hasattr(fn, "seek"):
+        fn.seek(0)
+    return fn
+
+
+def _read_csv_arrow(fn: PathOrFile, encoding: str = "utf8") -> pa.Table:
+    """Read the CSV using the multithreaded arrow reader, with the same conversions as pd.read_csv"""
+    read_options = pa_csv.ReadOptions(use_threads=True, block_size=CSV_BLOCK_SIZE, encoding=encoding)
+    convert_options = pa_csv.ConvertOptions(
+        strings_can_be_null=True, true_values=["True", "TRUE", "true"], false_values=["False", "FALSE", "false"]
+    )
+    # column types are inferred from the first block - as per pandas, don't parse dates and times
+    with pa_csv.open_csv(_rewind(fn), read_options=read_options, convert_options=convert_options) as reader:
+        convert_options.column_types = {f.name: pa.string() for f in reader.schema if pa.types.is_temporal(f.type)}
+    return pa_csv.read_csv(_rewind(fn), read_options=read_options, convert_options=convert_options)
 
 
 class CSVFormat(DFFormatter):
@@ -71,22 +319,31 @@ class CSVFormat(DFFormatter):
 
     @staticmethod
     def load_file(fn: PathOrFile) -> pd.DataFrame:
-        # TODO - fix
-        if not isinstance(fn, str):
-            raise ValueError("FObj not yet supported")
+        """
+        Load the CSV file, given by path or as a binary file, using the multithreaded arrow reader,
+        and falling back to pandas, detecting the separator, for files it can't parse
+        """
+        try:
+            table = _read_csv_arrow(fn)
+            # invalid utf-8 strings are read as binary
+            if any(pa.types.is_binary(f.type) for f in table.schema):
+                table = _read_csv_arrow(fn, encoding=guess_encoding(_rewind(fn)))
+            return table.to_pandas(split_blocks=True, self_destruct=True)
+        except (pa.ArrowInvalid, LookupError) as e:
+            log.warning(f"Error parsing CSV file ({e}), trying pandas fallback")
 
         try:
-            return pd.read_csv(fn, engine="c", sep=",")
+            return pd.read_csv(_rewind(fn), engine="c", sep=",")
         except UnicodeDecodeError:
-            encoding = guess_encoding(fn)
-            return pd.read_csv(fn, engine="c", sep=",", encoding=encoding)
+            encoding = guess_encoding(_rewind(fn))
+            return pd.read_csv(_rewind(fn), engine="c", sep=",", encoding=encoding)
         except ParserError as e:
             log.warning(f"Error parsing CSV file ({e}), trying python fallback")
             try:
-                return pd.read_csv(fn, engine="python", sep=None)
+                return pd.read_csv(_rewind(fn), engine="python", sep=None)
             except UnicodeDecodeError:
-                encoding = guess_encoding(fn)
-                return pd.read_csv(fn, engine="python", sep=None, encoding=encoding)
+                encoding = guess_encoding(_rewind(fn))
+                return pd.read_csv(_rewind(fn), engine="python", sep=None, encoding=encoding)
 
     @staticmethod
     def save_file(fn: PathOrFile, df: pd.DataFrame):
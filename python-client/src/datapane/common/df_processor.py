@@ -1,16 +1,45 @@
 import datetime
+import math
+from contextlib import nullcontext
+from functools import lru_cache
 from numbers import Number
-from typing import Any
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from packaging.specifiers import SpecifierSet
 from packaging.version import Version
 
+from .dp_types import log
+
 PD_VERSION = Version(pd.__version__)
 PD_1_3_GREATER = SpecifierSet(">=1.3.0")
 PD_1_2_x = SpecifierSet("~=1.2.0")
 PD_1_1_x = SpecifierSet("~=1.1.0")
+PD_COW = SpecifierSet(">=1.5.0")
+# copy-on-write fully tracks references between frames from pandas 2, and is always enabled from pandas 3
+PD_COW_SNAPSHOT = SpecifierSet(">=2.0.0")
+PD_3_GREATER = SpecifierSet(">=3.0.0")
+
+# columns larger than this are first sampled to rule out converting them to categories
+CATEGORY_SAMPLE_SIZE = 2**16
+# probability of wrongly ruling out a column that should be a category
+CATEGORY_SAMPLE_ERROR = 1e-6
+
+
+def copy_on_write() -> ContextManager:
+    """Enable pandas copy-on-write (pandas >= 1.5), so unchanged columns are shared rather than copied"""
+    return pd.option_context("mode.copy_on_write", True) if PD_VERSION in PD_COW else nullcontext()
+
+
+def cow_enabled() -> bool:
+    """Whether pandas copy-on-write is enabled globally, so shallow copies are snapshots of the original frame
+    that aren't changed by later in-place edits to it"""
+    if PD_VERSION in PD_3_GREATER:
+        return True
+    return PD_VERSION in PD_COW_SNAPSHOT and pd.get_option("mode.copy_on_write") is True
 
 
 def convert_axis(df: pd.DataFrame):
@@ -49,14 +78,44 @@ def downcast_numbers(data: pd.DataFrame):
     df_num = data.select_dtypes("integer", exclude=["timedelta"])  # , pd.Int64Dtype])
     data[df_num.columns] = df_num.apply(downcast_ints)
 
-    def downcast_floats(ser: pd.Series) -> pd.Series:
-        ser = pd.to_numeric(ser, downcast="float", errors="ignore")
-        return ser
+    # NOTE - floats aren't downcast here, as float32 can alter values and rounds to 'inf' instead of erroring,
+    # see https://github.com/pandas-dev/pandas/issues/19729 - instead use the opt-in, checked downcast_floats
 
-    # float downcasting currently disabled - alters values (both float64 and int64) and rounds to 'inf' instead of erroring
-    # see https://github.com/pandas-dev/pandas/issues/19729
-    # df_num = data.select_dtypes("floating")
-    # data[df_num.columns] = df_num.apply(downcast_floats)
+
+def float32_safe(values: np.ndarray, tolerance: float = 0.0) -> bool:
+    """
+    Check if the float64 values can be stored as float32, i.e. every value round-trips exactly,
+    or within the given relative tolerance, and no finite value overflows to inf.
+    NaN and inf values are preserved by the cast, whilst values that underflow to zero or lose precision
+    as float32 subnormals only pass within the tolerance
+    """
+    with np.errstate(over="ignore", under="ignore", invalid="ignore"):
+        back = values.astype(np.float32).astype(np.float64)
+    finite = np.isfinite(values)
+    if not np.array_equal(finite, np.isfinite(back)):
+        # out of range
+        return False
+    values, back = values[finite], back[finite]
+    return bool(np.all(np.abs(back - values) <= tolerance * np.abs(values)))
+
+
+def downcast_floats(df: pd.DataFrame, tolerance: float = 0.0) -> List[str]:
+    """
+    Downcast the float64 columns to float32 where safe (see float32_safe), keeping nullable columns nullable
+    NOTE - this mutates the dataframe, returning the names of the downcast columns
+    """
+    changed: List[Any] = []
+    for name, ser in df.items():
+        if ser.dtype == np.dtype("float64"):
+            dtype: Any = np.float32
+        elif ser.dtype == pd.Float64Dtype():
+            dtype = "Float32"
+        else:
+            continue
+        if float32_safe(ser.to_numpy(dtype=np.float64, na_value=np.nan), tolerance):
+            changed.append(name)
+            df[name] = ser.astype(dtype)
+    return [str(n) for n in changed]
 
 
 def timedelta_to_str(df: pd.DataFrame):
@@ -68,27 +127,55 @@ def timedelta_to_str(df: pd.DataFrame):
     df[df_td.columns] = np.where(pd.isnull(df_td), pd.NA, df_td.astype("string"))
 
 
-def parse_categories(data: pd.DataFrame):
-    """Detect and converts categories"""
+def category_criteria(nunique: int, size: int) -> bool:
+    """Decides whether to convert into categorical, given the number of unique values"""
+    if nunique <= 20 and (nunique != size):
+        # few unique values => make it a category regardless of the proportion
+        return True
 
-    def criteria(ser: pd.Series) -> bool:
-        """Decides whether to convert into categorical"""
-        nunique: int = ser.nunique()
+    prop_unique = (nunique + 1) / (size + 1)  # + 1 for nan
 
-        if nunique <= 20 and (nunique != ser.size):
-            # few unique values => make it a category regardless of the proportion
-            return True
+    if prop_unique <= 0.05:
+        # a lot of redundant information => categories are more compact
+        return True
 
-        prop_unique = (nunique + 1) / (ser.size + 1)  # + 1 for nan
+    return False
 
-        if prop_unique <= 0.05:
-            # a lot of redundant information => categories are more compact
-            return True
 
-        return False
+def _may_be_category(size: int, sample_nunique: Callable[[np.ndarray], int]) -> bool:
+    if size <= CATEGORY_SAMPLE_SIZE:
+        return True
+
+    # sample with replacement, so the number of unique values seen is a bound that doesn't depend on the ordering
+    k = max(CATEGORY_SAMPLE_SIZE, size // 16)
+    idx = np.random.default_rng(0).integers(0, size, k)
+
+    # the most unique values a category could have, for which we'd expect the most unique values in the sample
+    # when evenly distributed, plus a margin for the sampling error (via McDiarmid's inequality)
+    max_nunique = max(20, math.floor(0.05 * (size + 1) - 1))
+    expected = max_nunique * -math.expm1(k * math.log1p(-1 / max_nunique))
+    margin = math.sqrt(k * math.log(1 / CATEGORY_SAMPLE_ERROR) / 2)
+    return sample_nunique(idx) <= expected + margin
+
+
+def may_be_category(ser: pd.Series) -> bool:
+    """
+    Cheaply rule out large columns with too many unique values to be categories, using a random sample
+    NOTE - returns True if the column may be a category and so should be checked exactly
+    """
+    return _may_be_category(ser.size, lambda idx: ser.take(idx).nunique())
+
+
+def is_category_candidate(ser: pd.Series) -> bool:
+    """Decides whether to convert into categorical"""
+    return may_be_category(ser) and category_criteria(ser.nunique(), ser.size)
+
+
+def parse_categories(data: pd.DataFrame):
+    """Detect and converts categories"""
 
     def try_to_category(ser: pd.Series) -> pd.Series:
-        return ser.astype("category") if criteria(ser) else ser
+        return ser.astype("category") if is_category_candidate(ser) else ser
 
     potential_cats = data.select_dtypes(["string", "object"])
     data[potential_cats.columns] = potential_cats.apply(try_to_category)
@@ -136,14 +223,133 @@ def str_to_arrow_str(df: pd.DataFrame):
         df[df_str.columns] = df_str.astype("string[pyarrow]")
 
 
-def process_df(df: pd.DataFrame, copy: bool = False) -> pd.DataFrame:
+################################################################################
+# Column-wise processing
+# Applies the same steps as the frame-wise functions above (for pandas >= 1.3), but converting each column
+# independently, following a plan of the steps needed for each column as computed once per schema,
+# and only building a single new frame at the end
+ColumnStep = Callable[[pd.Series], pd.Series]
+
+
+def _downcast_col(ser: pd.Series) -> pd.Series:
+    try:
+        ser = pd.to_numeric(ser, downcast="signed")
+        ser = pd.to_numeric(ser, downcast="unsigned")
+    except Exception:
+        pass  # catch failure on Int64Dtype
+    return ser
+
+
+def _convert_col(ser: pd.Series) -> pd.Series:
+    """convert_dtypes, downcast_numbers, obj_to_str, parse_categories and str_to_arrow_str for a single column"""
+    ser = ser.convert_dtypes()
+    dtype = ser.dtype
+
+    if pd.api.types.is_integer_dtype(dtype):
+        return _downcast_col(ser)
+    if isinstance(dtype, pd.CategoricalDtype):
+        return _categorical_col(ser)
+    if dtype == np.dtype("object"):
+        ser = ser.astype("string")
+    elif not isinstance(dtype, pd.StringDtype):
+        return ser
+
+    return _str_col(ser)
+
+
+def _str_col(ser: pd.Series) -> pd.Series:
+    """Convert to a category if suitable, else the arrow string dtype - using a single arrow dictionary encoding"""
+    if not may_be_category(ser):
+        return ser.astype("string[pyarrow]")
+
+    arr = pa.array(ser.array, type=pa.string())
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    enc = pc.dictionary_encode(arr)
+    if not category_criteria(len(enc.dictionary), ser.size):
+        return pd.Series(pd.arrays.ArrowStringArray(arr), index=ser.index, name=ser.name)
+
+    # reorder to use sorted categories, as per astype("category")
+    order = pc.array_sort_indices(enc.dictionary).to_numpy()
+    ranks = np.empty(len(order) + 1, dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    ranks[-1] = -1
+    codes = ranks[enc.indices.fill_null(-1).to_numpy(zero_copy_only=False)]
+    categories = pd.Index(enc.dictionary.take(order).to_numpy(zero_copy_only=False), dtype="string")
+    return pd.Series(
+        pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(categories)), index=ser.index, name=ser.name
+    )
+
+
+def _timedelta_col(ser: pd.Series) -> pd.Series:
+    ser = pd.Series(np.where(pd.isnull(ser), pd.NA, ser.astype("string")), index=ser.index, name=ser.name)
+    return _convert_col(ser)
+
+
+def _categorical_col(ser: pd.Series) -> pd.Series:
+    # convert categorical values (as strings if object)
+    if ser.cat.categories.dtype == np.dtype("object"):
+        return ser.cat.rename_categories(ser.cat.categories.astype("string"))
+    return ser
+
+
+def _passthrough_col(ser: pd.Series) -> pd.Series:
+    return ser
+
+
+@lru_cache(maxsize=128)
+def _mk_plan(dtypes: Tuple[Any, ...]) -> Tuple[ColumnStep, ...]:
+    """Choose the steps for each column based upon its dtype - cached, so repeated schemas skip this"""
+
+    def _col_step(dtype: Any) -> ColumnStep:
+        if pd.api.types.is_timedelta64_dtype(dtype):
+            return _timedelta_col
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            # no conversions apply
+            return _passthrough_col
+        if isinstance(dtype, pd.CategoricalDtype):
+            return _categorical_col
+        return _convert_col
+
+    return tuple(_col_step(dtype) for dtype in dtypes)
+
+
+def process_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert each column of the frame independently, returning a new frame (pandas >= 1.3 only)"""
+    if len(df.columns) == 0:
+        return df
+    plan = _mk_plan(tuple(df.dtypes))
+    cols = [step(ser) for (step, (_, ser)) in zip(plan, df.items())]
+    return pd.concat(cols, axis=1, copy=False, keys=df.columns)
+
+
+def _downcast_floats(df: pd.DataFrame, float_tolerance: Optional[float]) -> pd.DataFrame:
+    if float_tolerance is not None:
+        changed = downcast_floats(df, float_tolerance)
+        if changed:
+            log.info(f"Downcast float columns {changed} to float32")
+    return df
+
+
+def process_df(df: pd.DataFrame, copy: bool = False, float_tolerance: Optional[float] = None) -> pd.DataFrame:
     """
     Processing steps needed before writing / after reading
     We only modify the dataframe to optimise size,
     rather than convert/infer types, e.g. no longer parsing dates from strings
+    Float columns are also downcast to float32 where safe if a `float_tolerance` is given (see downcast_floats)
 
     NOTE - this mutates the dataframe by default but returns it - use the returned copy!
     """
+    # NOTE - pandas >= 1.3 handles downcasting of nullable values correctly, so can process column-wise
+    if PD_VERSION in PD_1_3_GREATER:
+        # only the axes are modified in-place, as the columns are processed into a new frame,
+        # so a shallow copy is enough to leave the original untouched
+        if copy:
+            df = df.copy(deep=False)
+        convert_axis(df)
+        with copy_on_write():
+            return _downcast_floats(process_columns(df), float_tolerance)
+
     if copy:
         df = df.copy(deep=True)
 
@@ -152,23 +358,17 @@ def process_df(df: pd.DataFrame, copy: bool = False) -> pd.DataFrame:
     # convert timedelta
     timedelta_to_str(df)
 
-    # NOTE - pandas >= 1.3 handles downcasting of nullable values correctly
-    if PD_VERSION in PD_1_3_GREATER:
-        df = df.convert_dtypes()
-        downcast_numbers(df)
-    else:
-        # downcast first as can't downcast Int64 correctly after
-        downcast_numbers(df)
-        # convert all non-floating vals
-
-        non_f = df.select_dtypes(exclude="floating")
-        # pandas version < 1.3 raises ValueError when running convert_dtypes on empty dataframes so we need to check it
-        if len(non_f.columns) > 0:
-            df[non_f.columns] = non_f.convert_dtypes()
-        # convert all floating vals, but disable float64->int64 conversioon
-        f = df.select_dtypes(include="floating")
-        if len(f.columns) > 0:
-            df[f.columns] = f.convert_dtypes(convert_integer=False)
+    # downcast first as can't downcast Int64 correctly after
+    downcast_numbers(df)
+    # convert all non-floating vals
+    non_f = df.select_dtypes(exclude="floating")
+    # pandas version < 1.3 raises ValueError when running convert_dtypes on empty dataframes so we need to check it
+    if len(non_f.columns) > 0:
+        df[non_f.columns] = non_f.convert_dtypes()
+    # convert all floating vals, but disable float64->int64 conversioon
+    f = df.select_dtypes(include="floating")
+    if len(f.columns) > 0:
+        df[f.columns] = f.convert_dtypes(convert_integer=False)
 
     # save timedeltas cols (unneeded whilst timedelta_to_str used)
     # td_col = df.select_dtypes("timedelta")
@@ -179,7 +379,113 @@ def process_df(df: pd.DataFrame, copy: bool = False) -> pd.DataFrame:
     # convert all strings to use the arrow dtype
     str_to_arrow_str(df)
 
-    return df
+    return _downcast_floats(df, float_tolerance)
+
+
+################################################################################
+# Arrow-native processing
+# The equivalent of process_df for arrow tables, e.g. from polars, applying the same size optimisations
+# (flattening, integer downcasting and dictionary encoding) directly on the arrow data without using pandas
+ArrowLike = Union[pa.Table, pa.RecordBatchReader]
+
+# smallest first, so the first type that fits is used
+_UINT_TYPES = (pa.uint8(), pa.uint16(), pa.uint32(), pa.uint64())
+_INT_TYPES = (pa.int8(), pa.int16(), pa.int32(), pa.int64())
+
+
+def _downcast_arrow_int(arr: pa.ChunkedArray) -> pa.ChunkedArray:
+    min_max = pc.min_max(arr)
+    lo, hi = min_max["min"].as_py(), min_max["max"].as_py()
+    if lo is None:
+        return arr
+    for typ in _UINT_TYPES if lo >= 0 else _INT_TYPES:
+        if np.iinfo(typ.to_pandas_dtype()).min <= lo and hi <= np.iinfo(typ.to_pandas_dtype()).max:
+            return arr if typ == arr.type else arr.cast(typ)
+    return arr
+
+
+def _arrow_str_col(arr: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Dictionary encode if suitable as a category, as per _str_col"""
+    # arrow.js doesn't support large strings
+    arr = arr.cast(pa.string())
+    size = len(arr)
+    if _may_be_category(size, lambda idx: pc.count_distinct(arr.take(idx)).as_py()) and category_criteria(
+        pc.count_distinct(arr).as_py(), size
+    ):
+        return _arrow_dict_col(pc.dictionary_encode(arr))
+    return arr
+
+
+def _arrow_dict_col(arr: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Use a single dictionary across chunks, as required by the IPC file format, and the smallest index type"""
+    arr = pa.table(dict(x=arr)).unify_dictionaries().column(0)
+    typ = arr.type
+    n = len(arr.chunk(0).dictionary) if arr.num_chunks else 0
+    index_type = next(it for it in _INT_TYPES if n <= np.iinfo(it.to_pandas_dtype()).max)
+    # arrow.js doesn't support large strings
+    value_type = pa.string() if pa.types.is_large_string(typ.value_type) else typ.value_type
+    if (index_type, value_type) == (typ.index_type, typ.value_type):
+        return arr
+    return arr.cast(pa.dictionary(index_type, value_type))
+
+
+def _arrow_duration_col(arr: pa.ChunkedArray) -> pa.ChunkedArray:
+    # NOTE - format via pandas to match timedelta_to_str, as arrow can't cast durations to strings
+    ser = arr.to_pandas().astype("string")
+    return _arrow_str_col(pa.chunked_array([pa.array(ser.array, type=pa.string())]))
+
+
+def _downcast_arrow_float(arr: pa.ChunkedArray, tolerance: float) -> pa.ChunkedArray:
+    # NOTE - arrow float casts are unchecked, so check first as per downcast_floats
+    return arr.cast(pa.float32()) if float32_safe(arr.to_numpy(), tolerance) else arr
+
+
+def _process_arrow_col(arr: pa.ChunkedArray, float_tolerance: Optional[float] = None) -> pa.ChunkedArray:
+    typ = arr.type
+    if pa.types.is_integer(typ):
+        return _downcast_arrow_int(arr)
+    if pa.types.is_float64(typ) and float_tolerance is not None:
+        return _downcast_arrow_float(arr, float_tolerance)
+    if pa.types.is_string(typ) or pa.types.is_large_string(typ):
+        return _arrow_str_col(arr)
+    if pa.types.is_duration(typ):
+        return _arrow_duration_col(arr)
+    if pa.types.is_dictionary(typ):
+        return _arrow_dict_col(arr)
+    return arr
+
+
+def _flatten_arrow_cols(name: str, arr: pa.ChunkedArray) -> Iterator[Tuple[str, pa.ChunkedArray]]:
+    """Flatten struct columns into a column per field, named as per hierarchical columns in convert_axis"""
+    if pa.types.is_struct(arr.type):
+        for field, child in zip(arr.type, arr.flatten()):
+            yield from _flatten_arrow_cols(f"{name}/{field.name}", child)
+    else:
+        yield (name, arr)
+
+
+def process_table(table: pa.Table, float_tolerance: Optional[float] = None) -> pa.Table:
+    """Processing steps needed before writing an arrow table, returning a new table"""
+    flat_cols = [
+        (name, arr)
+        for (n, col) in zip(table.column_names, table.columns)
+        for (name, arr) in _flatten_arrow_cols(str(n), col)
+    ]
+    cols = [(name, _process_arrow_col(arr, float_tolerance)) for (name, arr) in flat_cols]
+    changed = [
+        name
+        for ((name, arr), (_, orig)) in zip(cols, flat_cols)
+        if pa.types.is_float64(orig.type) and pa.types.is_float32(arr.type)
+    ]
+    if changed:
+        log.info(f"Downcast float columns {changed} to float32")
+    # NOTE - drop any pandas metadata, as the columns no longer match
+    return pa.Table.from_arrays([arr for (_, arr) in cols], names=[name for (name, _) in cols])
+
+
+def to_table(value: ArrowLike) -> pa.Table:
+    """Converts an arrow object to a table, reading all batches of readers into memory"""
+    return value.read_all() if isinstance(value, pa.RecordBatchReader) else value
 
 
 def to_df(value: Any) -> pd.DataFrame:
@@ -194,7 +500,9 @@ def to_df(value: Any) -> pd.DataFrame:
         return pd.DataFrame()
 
     if isinstance(value, pd.DataFrame):
-        return value.copy(deep=True)
+        # a snapshot of the frame, so later in-place edits to it aren't written - as processing doesn't mutate
+        # the values of the frame (see process_df), a shallow copy is enough if copy-on-write is enabled
+        return value.copy(deep=not cow_enabled())
 
     if isinstance(value, (pd.Series, pd.Index)):
         if value.name is not None:
@@ -229,17 +537,55 @@ TRUNCATE_ROWS = 1000
 
 
 def truncate_dataframe(
-    df: pd.DataFrame, max_rows: int = TRUNCATE_ROWS, max_cells: int = TRUNCATE_CELLS
+    df: pd.DataFrame, max_rows: int = TRUNCATE_ROWS, max_cells: Optional[int] = TRUNCATE_CELLS
 ) -> pd.DataFrame:
-    """Truncate a pandas dataframe if needed"""
+    """Truncate a pandas dataframe if needed, with no limit on the number of cells if `max_cells` is None"""
     rows, cols = df.shape
     # determine max rows to truncate df to based on max cells and df cols
     cols = cols or 1  # handle empty df
-    max_rows = min(max_rows, int(max_cells / cols))
+    if max_cells is not None:
+        max_rows = min(max_rows, int(max_cells / cols))
     # return non-truncated preview if df smaller than max rows allowed
     if rows <= max_rows:
         return df
-    # truncate df to fit max cells
-    if not isinstance(df.index, pd.RangeIndex):
-        raise ValueError("Dataframe has unsupported index type")
-    return df.truncate(before=0, after=max_rows - 1, copy=False)
+    # truncate df to fit max cells, by position so any index type is supported
+    return df.iloc[:max_rows]
+
+
+def _summary_value(x: Any) -> Any:
+    # convert to a json-serialisable value, using None for missing values
+    if x is None or x is pd.NaT or (isinstance(x, float) and math.isnan(x)):
+        return None
+    if isinstance(x, (np.generic, pa.Scalar)):
+        return _summary_value(x.item() if isinstance(x, np.generic) else x.as_py())
+    return x if isinstance(x, (bool, int, float, str)) else str(x)
+
+
+def summarise_columns(data: Union[pd.DataFrame, pa.Table]) -> List[Dict[str, Any]]:
+    """
+    Summarise each column, i.e. the type and number of nulls, along with the min and max
+    (and mean, if numeric) of numeric and datetime columns
+    """
+    summary = []
+    if isinstance(data, pa.Table):
+        for name, col in zip(data.column_names, data.columns):
+            s: Dict[str, Any] = dict(name=name, type=str(col.type), nulls=col.null_count)
+            typ = col.type
+            if pa.types.is_integer(typ) or pa.types.is_floating(typ) or pa.types.is_temporal(typ):
+                min_max = pc.min_max(col)
+                s.update(min=_summary_value(min_max["min"]), max=_summary_value(min_max["max"]))
+                if not pa.types.is_temporal(typ):
+                    s.update(mean=_summary_value(pc.mean(col)))
+            summary.append(s)
+        return summary
+
+    for name, ser in data.items():
+        s = dict(name=str(name), type=str(ser.dtype), nulls=int(ser.isna().sum()))
+        if pd.api.types.is_bool_dtype(ser.dtype):
+            pass
+        elif pd.api.types.is_numeric_dtype(ser.dtype) or pd.api.types.is_datetime64_any_dtype(ser.dtype):
+            s.update(min=_summary_value(ser.min()), max=_summary_value(ser.max()))
+            if pd.api.types.is_numeric_dtype(ser.dtype):
+                s.update(mean=_summary_value(ser.mean()))
+        summary.append(s)
+    return summary
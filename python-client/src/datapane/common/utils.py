@@ -4,6 +4,7 @@ import mimetypes
 import re
 import sys
 import typing as t
+from contextlib import nullcontext
 from pathlib import Path
 
 import chardet
@@ -47,10 +48,11 @@ def guess_type(filename: Path) -> MIME:
     return MIME(mtype or "application/octet-stream")
 
 
-def guess_encoding(fn: str) -> str:
-    with open(fn, "rb") as f:
+def guess_encoding(fn: t.Union[str, Path, t.IO[bytes]]) -> str:
+    """Guess the encoding of the file, given by path or as a binary file"""
+    with open(fn, "rb") if isinstance(fn, (str, Path)) else nullcontext(fn) as f:
         detector = UniversalDetector()
-        for line in f.readlines():
+        for line in f:
             detector.feed(line)
             if detector.done:
                 break
@@ -109,3 +111,20 @@ _SHOULD_COMPRESS_MIME_TYPE_REGEXPS = [
         r"^application/xml$",
     ]
 ]
+
+
+def is_precompressed_mime_type(mime_type: str) -> bool:
+    # formats that are already compressed, and so gain little from compressing again
+    return any(pattern.search(mime_type) for pattern in _PRECOMPRESSED_MIME_TYPE_REGEXPS)
+
+
+_PRECOMPRESSED_MIME_TYPE_REGEXPS = [
+    re.compile(p)
+    for p in [
+        r"^image/(png|jpeg|gif|webp|avif)$",
+        r"^video/",
+        r"^audio/(mpeg|mp4|aac|ogg|webm|flac)$",
+        r"^application/(zip|gzip|x-gzip|x-bzip2|x-xz|zstd|x-7z-compressed|x-rar-compressed)$",
+        r"parquet",
+    ]
+]
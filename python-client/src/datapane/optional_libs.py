@@ -13,6 +13,8 @@ from datapane.client import log
 BOKEH_V_SPECIFIER = SpecifierSet("~=2.4.2")
 PLOTLY_V_SPECIFIER = SpecifierSet(">=4.0.0")
 FOLIUM_V_SPECIFIER = SpecifierSet(">=0.12.0")
+# matplotlib can only save webp images from 3.6
+MPL_WEBP_V_SPECIFIER = SpecifierSet(">=3.6.0")
 
 
 def _check_version(name: str, _v: v.Version, ss: SpecifierSet):
@@ -25,13 +27,16 @@ def _check_version(name: str, _v: v.Version, ss: SpecifierSet):
 # Optional Plotting library import handling
 # Matplotlib
 try:
+    import matplotlib
     from matplotlib.figure import Axes, Figure
     from numpy import ndarray
 
     HAVE_MATPLOTLIB = True
+    HAVE_MATPLOTLIB_WEBP = v.Version(matplotlib.__version__) in MPL_WEBP_V_SPECIFIER
 except ImportError:
     log.debug("No matplotlib found")
     HAVE_MATPLOTLIB = False
+    HAVE_MATPLOTLIB_WEBP = False
 
 # Folium
 try:
@@ -75,3 +80,32 @@ try:
 except ImportError:
     HAVE_PLOTLY = False
     log.debug("No Plotly Found")
+
+# Optional dataframe library import handling
+# Polars
+try:
+    from polars import DataFrame as PLDataFrame
+
+    HAVE_POLARS = True
+except ImportError:
+    HAVE_POLARS = False
+    log.debug("No polars found")
+
+# Optional compression library import handling
+# Brotli
+try:
+    import brotli
+
+    HAVE_BROTLI = True
+except ImportError:
+    HAVE_BROTLI = False
+    log.debug("No brotli found")
+
+# Zstandard
+try:
+    import zstandard
+
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+    log.debug("No zstandard found")
@@ -20,7 +20,7 @@ from datapane.cloud_api.report import CloudReport
 from datapane.common import NPath, dict_drop_empty
 from datapane.view import Blocks, BlocksT
 
-from .file_store import B64FileEntry, GzipTmpFileEntry
+from .file_store import B64FileEntry, EncodedTmpFileEntry, GzipTmpFileEntry
 from .processors import (
     ConvertXML,
     ExportHTMLFileAssets,
@@ -29,6 +29,7 @@ from .processors import (
     PreProcessView,
     PreUploadProcessor,
 )
+from .profiling import ProfileArg, mk_profile
 from .types import Formatting, Pipeline, ViewState
 
 if t.TYPE_CHECKING:
@@ -46,11 +47,15 @@ def build_report(
     dest: t.Optional[NPath] = None,
     formatting: t.Optional[Formatting] = None,
     overwrite: bool = False,
+    max_workers: t.Optional[int] = None,
+    incremental: bool = False,
+    profile: ProfileArg = False,
 ) -> None:
     """Build an (static) app with a directory structure, which can be served by a local http server
 
     !!! note
         This outputs compressed assets into the dir as well, may be an issue if self-hosting...
+        Set `DATAPANE_ASSET_CODEC` to choose the compression used (one of `gzip`, `br`, `zstd` or `identity`)
 
     Args:
         blocks: The `Blocks` object or a list of Blocks
@@ -58,6 +63,10 @@ def build_report(
         dest: File path to store the app directory
         formatting: Sets the basic app styling
         overwrite: Replace existing app with the same name and destination if already exists (default: False)
+        max_workers: Serialise assets concurrently using this many threads (default: None, i.e. sequentially)
+        incremental: Update an existing app in place, only writing new assets and removing unused ones (default: False)
+        profile: Record the time used by each processing stage and asset (default: False),
+            pass a `Profile` to collect the results, or `Profile(trace_memory=True)` to also record memory
     """
     # TODO(product) - unknown if we should keep this...
 
@@ -65,23 +74,36 @@ def build_report(
     app_dir: Path = Path(dest or os.getcwd()) / name
     app_exists = app_dir.is_dir()
 
-    if app_exists and overwrite:
+    if app_exists and incremental:
+        # assets are named by their contents, so unchanged assets are kept as-is
+        pass
+    elif app_exists and overwrite:
         rmtree(app_dir)
     elif app_exists and not overwrite:
-        raise DPClientError(f"App exists at given path {str(app_dir)} -- set `overwrite=True` to allow overwrite")
+        raise DPClientError(
+            f"App exists at given path {str(app_dir)} -- set `overwrite=True` or `incremental=True` to allow overwrite"
+        )
 
     assets_dir = app_dir / "assets"
-    assets_dir.mkdir(parents=True)
+    assets_dir.mkdir(parents=True, exist_ok=True)
 
     # write the app html and assets
-    s = ViewState(blocks=Blocks.wrap_blocks(blocks), file_entry_klass=GzipTmpFileEntry, dir_path=assets_dir)
-    _: str = (
-        Pipeline(s)
-        .pipe(PreProcessView(is_finalised=True))
-        .pipe(ConvertXML())
-        .pipe(ExportHTMLFileAssets(app_dir=app_dir, name=name, formatting=formatting))
-        .result
+    s = ViewState(
+        blocks=Blocks.wrap_blocks(blocks),
+        file_entry_klass=EncodedTmpFileEntry,
+        dir_path=assets_dir,
+        profile=mk_profile(profile),
     )
+    try:
+        _: str = (
+            Pipeline(s)
+            .pipe(PreProcessView(is_finalised=True))
+            .pipe(ConvertXML(max_workers=max_workers))
+            .pipe(ExportHTMLFileAssets(app_dir=app_dir, name=name, formatting=formatting))
+            .result
+        )
+    finally:
+        _finish_profile(s)
 
 
 def save_report(
@@ -90,6 +112,8 @@ def save_report(
     open: bool = False,
     name: str = "Report",
     formatting: t.Optional[Formatting] = None,
+    max_workers: t.Optional[int] = None,
+    profile: ProfileArg = False,
 ) -> None:
     """Save the app document to a local HTML file
     Args:
@@ -98,22 +122,29 @@ def save_report(
         open: Open in your browser after creating (default: False)
         name: Name of the document (optional: uses path if not provided)
         formatting: Sets the basic app styling
+        max_workers: Serialise assets concurrently using this many threads (default: None, i.e. sequentially)
+        profile: Record the time used by each processing stage and asset (default: False),
+            pass a `Profile` to collect the results, or `Profile(trace_memory=True)` to also record memory
     """
 
-    s = ViewState(blocks=Blocks.wrap_blocks(blocks), file_entry_klass=B64FileEntry)
-    _: str = (
-        Pipeline(s)
-        .pipe(PreProcessView(is_finalised=True))
-        .pipe(ConvertXML())
-        .pipe(ExportHTMLInlineAssets(path=path, open=open, name=name, formatting=formatting))
-        .result
-    )
+    s = ViewState(blocks=Blocks.wrap_blocks(blocks), file_entry_klass=B64FileEntry, profile=mk_profile(profile))
+    try:
+        _: str = (
+            Pipeline(s)
+            .pipe(PreProcessView(is_finalised=True))
+            .pipe(ConvertXML(max_workers=max_workers))
+            .pipe(ExportHTMLInlineAssets(path=path, open=open, name=name, formatting=formatting))
+            .result
+        )
+    finally:
+        _finish_profile(s)
 
 
 def stringify_report(
     blocks: BlocksT,
     name: t.Optional[str] = None,
     formatting: t.Optional[Formatting] = None,
+    profile: ProfileArg = False,
 ) -> str:
     """Stringify the app document to a HTML string
 
@@ -121,16 +152,21 @@ def stringify_report(
         blocks: The `Blocks` object or a list of Blocks
         name: Name of the document (optional: uses path if not provided)
         formatting: Sets the basic app styling
+        profile: Record the time used by each processing stage and asset (default: False),
+            pass a `Profile` to collect the results, or `Profile(trace_memory=True)` to also record memory
     """
 
-    s = ViewState(blocks=Blocks.wrap_blocks(blocks), file_entry_klass=B64FileEntry)
-    report_html: str = (
-        Pipeline(s)
-        .pipe(PreProcessView(is_finalised=False))
-        .pipe(ConvertXML())
-        .pipe(ExportHTMLStringInlineAssets(name=name, formatting=formatting))
-        .result
-    )
+    s = ViewState(blocks=Blocks.wrap_blocks(blocks), file_entry_klass=B64FileEntry, profile=mk_profile(profile))
+    try:
+        report_html: str = (
+            Pipeline(s)
+            .pipe(PreProcessView(is_finalised=False))
+            .pipe(ConvertXML())
+            .pipe(ExportHTMLStringInlineAssets(name=name, formatting=formatting))
+            .result
+        )
+    finally:
+        _finish_profile(s)
 
     return report_html
 
@@ -146,6 +182,8 @@ def upload_report(
     open: bool = False,
     formatting: t.Optional[Formatting] = None,
     overwrite: bool = False,
+    max_workers: t.Optional[int] = None,
+    profile: ProfileArg = False,
     **kwargs,
 ) -> CloudReport:
     """
@@ -161,6 +199,9 @@ def upload_report(
         open: Open the file in your browser after creating
         formatting: Set the basic styling for your app
         overwrite: Overwrite the app
+        max_workers: Serialise assets concurrently using this many threads (default: None, i.e. sequentially)
+        profile: Record the time used by each processing stage and asset (default: False),
+            pass a `Profile` to collect the results, or `Profile(trace_memory=True)` to also record memory
     """
     # NOTE - this will become App deploy entrypoint also
 
@@ -186,10 +227,17 @@ def upload_report(
     # current protocol is to strip all empty args and patch (via a post)
     kwargs = dict_drop_empty(kwargs)
 
-    s = ViewState(blocks=Blocks.wrap_blocks(blocks), file_entry_klass=GzipTmpFileEntry)
-    (view_xml, file_list) = (
-        Pipeline(s).pipe(PreProcessView(is_finalised=True)).pipe(ConvertXML()).pipe(PreUploadProcessor()).result
-    )
+    s = ViewState(blocks=Blocks.wrap_blocks(blocks), file_entry_klass=GzipTmpFileEntry, profile=mk_profile(profile))
+    try:
+        (view_xml, file_list) = (
+            Pipeline(s)
+            .pipe(PreProcessView(is_finalised=True))
+            .pipe(ConvertXML(max_workers=max_workers))
+            .pipe(PreUploadProcessor())
+            .result
+        )
+    finally:
+        _finish_profile(s)
 
     # attach the view and upload as an App
     files: FileAttachmentList = dict(attachments=file_list)
@@ -205,3 +253,8 @@ def upload_report(
         web_url=report.web_url,
     )
     return report
+
+
+def _finish_profile(s: ViewState) -> None:
+    if s.profile:
+        s.profile.finish()
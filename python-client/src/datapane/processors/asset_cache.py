@@ -0,0 +1,204 @@
+"""
+Persistent, on-disk, cache of serialised assets that is shared across runs
+
+Assets are keyed by a fingerprint of the input object (along with the writer and file entry used),
+so unchanged DataFrames and plots can reuse the frozen file entry contents from a previous run
+rather than being serialised and compressed again. The cache is size-bounded with (periodic) LRU eviction.
+
+Enable by setting `DATAPANE_ASSET_CACHE=1`, and optionally `DATAPANE_ASSET_CACHE_SIZE` (in MB)
+"""
+# flake8: noqa:F811
+from __future__ import annotations
+
+import dataclasses as dc
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import typing as t
+from contextlib import suppress
+from pathlib import Path
+
+import pandas as pd
+from altair.utils import SchemaBase
+from multimethod import multimethod
+
+from datapane import optional_libs as opt
+from datapane.client import config as c
+from datapane.client import log
+from datapane.common import SIZE_1_MB
+
+from .file_store import DummyFileEntry, FileEntry
+
+ASSET_CACHE_DIRNAME = "asset_cache"
+DEFAULT_CACHE_SIZE_MB = 1024
+# the cache size is only checked once this fraction of the max size has been added since the last check
+EVICT_INTERVAL_RATIO = 0.1
+
+
+################################################################################
+# Fingerprints
+@multimethod
+def fingerprint(x: t.Any) -> t.Optional[str]:
+    """Return a fast fingerprint of the object, or None if it can't be cached"""
+    return None
+
+
+@multimethod
+def fingerprint(x: pd.DataFrame) -> t.Optional[str]:
+    try:
+        row_hashes = pd.util.hash_pandas_object(x, index=True)
+    except TypeError:
+        # unhashable values, e.g. lists
+        return None
+    h = hashlib.sha256(row_hashes.values.tobytes())
+    h.update(repr((list(x.columns), [str(d) for d in x.dtypes], list(x.index.names))).encode())
+    return h.hexdigest()
+
+
+def _hash_spec(spec: t.Any) -> str:
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@multimethod
+def fingerprint(x: SchemaBase) -> t.Optional[str]:
+    # the spec as written, so shared datasets are included by name (itself a fingerprint) rather than inlined
+    from datapane.view.asset_writers import _altair_spec
+
+    return _hash_spec(_altair_spec(x))
+
+
+if opt.HAVE_PLOTLY:
+
+    @multimethod
+    def fingerprint(x: opt.PFigure) -> t.Optional[str]:
+        return hashlib.sha256(x.to_json().encode()).hexdigest()
+
+
+if opt.HAVE_BOKEH:
+
+    @multimethod
+    def fingerprint(x: t.Union[opt.BFigure, opt.BLayout]) -> t.Optional[str]:
+        from bokeh.embed import json_item
+
+        return _hash_spec(json_item(x))
+
+
+################################################################################
+# Cache
+@dc.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    bytes_reused: int = 0
+
+    def __str__(self) -> str:
+        total = self.hits + self.misses
+        hit_ratio = (self.hits / total * 100) if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_ratio:.2f}%), {self.bytes_reused} bytes reused"
+
+
+class AssetCache:
+    """On-disk cache of frozen file entry contents, keyed by object fingerprint, with size-based LRU eviction"""
+
+    def __init__(self, cache_dir: t.Optional[Path] = None, max_size: int = DEFAULT_CACHE_SIZE_MB * SIZE_1_MB):
+        self.cache_dir = cache_dir or (c.APP_DIR / ASSET_CACHE_DIRNAME)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        # bytes added since the cache size was last checked, starting due so existing entries are checked
+        self._added = self._evict_interval
+
+    def key(self, x: t.Any, writer: t.Any, fe: FileEntry) -> t.Optional[str]:
+        """Generate the cache key for writing the object with the writer into the file entry"""
+        if isinstance(fe, DummyFileEntry):
+            return None
+        try:
+            fp = fingerprint(x)
+        except Exception as e:
+            log.debug(f"Couldn't fingerprint {type(x).__name__} for the asset cache - {e}")
+            fp = None
+        if fp is None:
+            return None
+
+        from datapane import __version__
+
+        # include any options the writer was created with
+        w = f"{type(writer).__name__}({','.join(f'{k}={v}' for (k, v) in sorted(vars(writer).items()))})"
+        k = f"{__version__}:{w}:{type(fe).__name__}:{fe.codec}:{fe.mime}:{fp}"
+        return hashlib.sha256(k.encode()).hexdigest()
+
+    @property
+    def _evict_interval(self) -> int:
+        return int(self.max_size * EVICT_INTERVAL_RATIO)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def restore(self, key: str, fe: FileEntry) -> bool:
+        """Restore a cached entry into the file entry, returns False if not cached"""
+        p = self._path(key)
+        try:
+            with p.open("rb") as f:
+                fe.load_frozen(f)
+        except FileNotFoundError:
+            with self._lock:
+                self.stats.misses += 1
+            return False
+
+        # mark as recently used, unless evicted meanwhile by another process
+        with suppress(FileNotFoundError):
+            os.utime(p)
+        with self._lock:
+            self.stats.hits += 1
+            self.stats.bytes_reused += fe.size
+        return True
+
+    def save(self, key: str, fe: FileEntry) -> None:
+        """Add the frozen file entry to the cache"""
+        # write and move into place, so concurrent writers / readers never see partial entries
+        with tempfile.NamedTemporaryFile("wb", dir=self.cache_dir, prefix=".tmp-", delete=False) as f:
+            fe.write_frozen(f)
+            size = f.tell()
+        os.replace(f.name, self._path(key))
+
+        # only stat the whole cache dir periodically, rather than on every save
+        with self._lock:
+            self._added += size
+            evict_due = self._added >= self._evict_interval
+        if evict_due:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove the least-recently used entries until the cache is within its max size"""
+        with self._lock:
+            self._added = 0
+            entries = [(p, p.stat()) for p in self.cache_dir.iterdir() if p.is_file() and not p.name.startswith(".")]
+            cur_size = sum(st.st_size for (_, st) in entries)
+            if cur_size <= self.max_size:
+                return
+            for p, st in sorted(entries, key=lambda e: e[1].st_mtime):
+                p.unlink(missing_ok=True)
+                cur_size -= st.st_size
+                if cur_size <= self.max_size:
+                    break
+
+    def clear(self) -> None:
+        for p in self.cache_dir.iterdir():
+            p.unlink(missing_ok=True)
+
+
+_asset_cache: t.Optional[AssetCache] = None
+
+
+def get_asset_cache() -> t.Optional[AssetCache]:
+    """Return the global asset cache, if enabled via the environment"""
+    global _asset_cache
+    if os.getenv("DATAPANE_ASSET_CACHE", "").lower() not in ("1", "true"):
+        return None
+    if _asset_cache is None:
+        size_mb = int(os.getenv("DATAPANE_ASSET_CACHE_SIZE", DEFAULT_CACHE_SIZE_MB))
+        _asset_cache = AssetCache(max_size=size_mb * SIZE_1_MB)
+    return _asset_cache
@@ -0,0 +1,206 @@
+"""
+Content-codings used to encode file entries, and to negotiate which stored variant of an entry is served
+
+Entries stored in an assets dir carry the file suffix of their codec, e.g. `dp-xyz.arrow.br`, and are
+served with the matching `Content-Encoding`. The codec and level used can be set via
+`DATAPANE_ASSET_CODEC` (one of `gzip`, `br`, `zstd` or `identity`) and `DATAPANE_ASSET_CODEC_LEVEL`.
+Already-compressed formats, e.g. images and video, always use the identity encoding.
+"""
+from __future__ import annotations
+
+import abc
+import datetime
+import gzip
+import io
+import os
+import typing as t
+import zlib
+from contextlib import suppress
+
+from datapane import optional_libs as opt
+from datapane.client import DPClientError
+from datapane.common.utils import is_precompressed_mime_type
+
+# chunk size used when streaming entry contents
+CHUNK_SIZE = 1024 * 1024
+GZIP_MTIME = datetime.datetime(year=2000, month=1, day=1).timestamp()
+DEFAULT_ENCODING = "gzip"
+
+
+class EncodingWriter(io.BufferedIOBase):
+    """Writable file that passes data through an incremental encoder into the wrapped file,
+    leaving it open on close"""
+
+    def __init__(
+        self,
+        f: t.BinaryIO,
+        encode: t.Optional[t.Callable[[bytes], bytes]] = None,
+        finish: t.Optional[t.Callable[[], bytes]] = None,
+    ):
+        super().__init__()
+        self._f = f
+        self._encode = encode
+        self._finish = finish
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: bytes) -> int:
+        buf = memoryview(b)
+        if self._encode:
+            # some encoders only accept contiguous byte buffers
+            self._f.write(self._encode(buf.cast("B") if buf.c_contiguous else buf.tobytes()))
+        else:
+            self._f.write(buf)
+        self._pos += buf.nbytes
+        return buf.nbytes
+
+    def tell(self) -> int:
+        # position within the unencoded stream
+        return self._pos
+
+    def close(self) -> None:
+        if not self.closed and self._finish:
+            self._f.write(self._finish())
+        super().close()
+
+
+class Codec(abc.ABC):
+    # the http content-coding
+    encoding: t.ClassVar[str]
+    # suffix of entries stored using the codec
+    suffix: t.ClassVar[str]
+    default_level: t.ClassVar[t.Optional[int]] = None
+
+    def __init__(self, level: t.Optional[int] = None):
+        self.level = self.default_level if level is None else level
+
+    def __repr__(self) -> str:
+        return f"{self.encoding}:{self.level}"
+
+    @abc.abstractmethod
+    def writer(self, f: t.BinaryIO) -> t.BinaryIO:
+        """Return a file that encodes all data written into the given file, closing it finishes the encoding"""
+
+    @abc.abstractmethod
+    def decompressor(self) -> t.Callable[[bytes], bytes]:
+        pass
+
+    def decode(self, f: t.BinaryIO, chunk_size: int = CHUNK_SIZE) -> t.Iterator[bytes]:
+        """Iterate over the decoded contents of the given file in chunks"""
+        decompress = self.decompressor()
+        while chunk := f.read(chunk_size):
+            if out := decompress(chunk):
+                yield out
+
+
+class IdentityCodec(Codec):
+    encoding = "identity"
+    suffix = ""
+
+    def writer(self, f: t.BinaryIO) -> t.BinaryIO:
+        return EncodingWriter(f)
+
+    def decompressor(self) -> t.Callable[[bytes], bytes]:
+        return lambda b: b
+
+
+class GzipCodec(Codec):
+    encoding = "gzip"
+    suffix = ".gz"
+    default_level = 9
+
+    def writer(self, f: t.BinaryIO) -> t.BinaryIO:
+        # a fixed mtime and empty filename (rather than that of the, temporary, file) keep the header,
+        # and so the entry hash, deterministic
+        return gzip.GzipFile(filename="", fileobj=f, mode="wb", compresslevel=self.level, mtime=GZIP_MTIME)
+
+    def decompressor(self) -> t.Callable[[bytes], bytes]:
+        return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS).decompress
+
+
+class BrotliCodec(Codec):
+    encoding = "br"
+    suffix = ".br"
+    default_level = 5
+
+    def writer(self, f: t.BinaryIO) -> t.BinaryIO:
+        c = opt.brotli.Compressor(quality=self.level)
+        return EncodingWriter(f, c.process, c.finish)
+
+    def decompressor(self) -> t.Callable[[bytes], bytes]:
+        return opt.brotli.Decompressor().process
+
+
+class ZstdCodec(Codec):
+    encoding = "zstd"
+    suffix = ".zst"
+    default_level = 3
+
+    def writer(self, f: t.BinaryIO) -> t.BinaryIO:
+        c = opt.zstandard.ZstdCompressor(level=self.level).compressobj()
+        return EncodingWriter(f, c.compress, c.flush)
+
+    def decompressor(self) -> t.Callable[[bytes], bytes]:
+        return opt.zstandard.ZstdDecompressor().decompressobj().decompress
+
+
+# available codecs, in order of preference when the client accepts several equally
+CODECS: t.Dict[str, t.Type[Codec]] = {
+    c.encoding: c
+    for c in [
+        BrotliCodec if opt.HAVE_BROTLI else None,
+        ZstdCodec if opt.HAVE_ZSTD else None,
+        GzipCodec,
+        IdentityCodec,
+    ]
+    if c
+}
+
+
+def get_codec(encoding: str, level: t.Optional[int] = None) -> Codec:
+    try:
+        return CODECS[encoding](level)
+    except KeyError:
+        raise DPClientError(f"Unknown or unavailable asset codec {encoding}, please choose from {list(CODECS)}")
+
+
+def default_codec(mime: str) -> Codec:
+    """The codec used for new entries of the given mime-type, as configured via the environment"""
+    if is_precompressed_mime_type(mime):
+        return IdentityCodec()
+    level = os.getenv("DATAPANE_ASSET_CODEC_LEVEL")
+    return get_codec(os.getenv("DATAPANE_ASSET_CODEC", DEFAULT_ENCODING), int(level) if level else None)
+
+
+def parse_accept_encoding(header: str) -> t.Dict[str, float]:
+    """Parse an Accept-Encoding header into a dict of content-codings and their q-values"""
+    prefs = {}
+    for part in header.split(","):
+        coding, *params = [x.strip() for x in part.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for p in params:
+            k, _, v = p.partition("=")
+            if k.strip() == "q":
+                with suppress(ValueError):
+                    q = float(v)
+        prefs[coding.lower()] = q
+    return prefs
+
+
+def negotiate(accept_encoding: t.Optional[str], available: t.Sequence[t.Type[Codec]]) -> t.Optional[t.Type[Codec]]:
+    """Choose the most preferred of the available codecs that is acceptable to the client, if any"""
+    prefs = parse_accept_encoding(accept_encoding or "")
+
+    def _q(c: t.Type[Codec]) -> float:
+        if c.encoding in prefs:
+            return prefs[c.encoding]
+        # identity is always acceptable unless explicitly excluded
+        return prefs.get("*", 1.0 if c is IdentityCodec else 0.0)
+
+    acceptable = [(_q(c), c) for c in available if _q(c) > 0]
+    # max is stable, so ties are broken by the order of available
+    return max(acceptable, key=lambda x: x[0])[1] if acceptable else None
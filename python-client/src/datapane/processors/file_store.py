@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 import abc
-import datetime
-import gzip
 import hashlib
 import io
+import os
+import shutil
+import stat
 import tempfile
 import typing as t
 from pathlib import Path
@@ -13,16 +14,21 @@ from shutil import copyfileobj
 from typing_extensions import Self
 
 from datapane._vendor import base64io
-from datapane.common import guess_type
+from datapane.common import SIZE_1_MB, guess_type
+
+from .codecs import CHUNK_SIZE, Codec, GzipCodec, IdentityCodec, default_codec
 
 SERVED_REPORT_ASSETS_DIR = "assets"
-GZIP_MTIME = datetime.datetime(year=2000, month=1, day=1).timestamp()
 
 
 class FileEntry:
     file: t.IO
     _ext: str
     _dir_path: t.Optional[Path]
+    # content-coding of the frozen contents, if any
+    codec: t.Optional[Codec] = None
+    # size of the contents before encoding, if known
+    raw_size: t.Optional[int] = None
 
     # post-freeze
     frozen: bool = False
@@ -47,9 +53,25 @@ class FileEntry:
     def src(self) -> str:
         pass
 
-    def as_dict(self) -> dict:
+    def write_frozen(self, f: t.BinaryIO) -> None:
+        """Write the frozen, i.e. encoded, contents of the entry to the given file"""
+        assert self.frozen
+        self.wrapped.seek(0)
+        copyfileobj(self.wrapped, f)
+
+    def load_frozen(self, f: t.BinaryIO) -> None:
+        """Restore the (already encoded) contents of a previously frozen entry, e.g. from a cache,
+        bypassing the encoder"""
+        raise NotImplementedError()
+
+    def as_dict(self, include_src: bool = True) -> dict:
         assert self.frozen
-        return dict(src=self.src, hash=self.hash, size=self.size, mime=self.mime)
+        d = dict(hash=self.hash, size=self.size, mime=self.mime)
+        return dict(src=self.src, **d) if include_src else d
+
+    def discard(self) -> None:
+        """Release any resources held by a (frozen) entry that is not kept in a store, e.g. a duplicate"""
+        pass
 
     def __eq__(self, other: FileEntry) -> bool:
         if self.hash:
@@ -57,6 +79,38 @@ class FileEntry:
         raise NotImplementedError()
 
 
+class HashingWriter(io.BufferedIOBase):
+    """Writable file that tees everything written into the wrapped file into a running hash,
+    so entries are hashed in a single pass as they're written, rather than re-read when frozen"""
+
+    def __init__(self, f: t.BinaryIO):
+        super().__init__()
+        self._f = f
+        self.reset()
+
+    def reset(self) -> None:
+        """Restart hashing, e.g. after truncating the wrapped file"""
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: bytes) -> int:
+        self._f.write(b)
+        self._hash.update(b)
+        n = memoryview(b).nbytes
+        self.size += n
+        return n
+
+    def flush(self) -> None:
+        self._f.flush()
+
+    @property
+    def hash(self) -> str:
+        return self._hash.hexdigest()[:10]
+
+
 class NullWriter(io.BytesIO):
     def write(self, s):
         pass
@@ -82,93 +136,235 @@ class DummyFileEntry(FileEntry):
 
 
 class B64FileEntry(FileEntry):
-    """Memory-based b64 file"""
+    """Memory-based b64 file, spilled to a temp file once larger than spool_size"""
 
     # requires b64io is bytes only and wraps to a bytes file only
     file: base64io.Base64IO
-    wrapped: io.BytesIO
-    contents: bytes
+    wrapped: tempfile.SpooledTemporaryFile
+    _tee: HashingWriter
+    spool_size: int = int(os.getenv("DATAPANE_B64_SPOOL_SIZE_MB", 32)) * SIZE_1_MB
 
     def __init__(self, ext: str, mime: t.Optional[str] = None, *a, **kw):
         super().__init__(ext, mime, *a, **kw)
-        self.wrapped = io.BytesIO()
-        self.file = base64io.Base64IO(self.wrapped)
+        self.wrapped = tempfile.SpooledTemporaryFile(max_size=self.spool_size, prefix="dp-")
+        self._tee = HashingWriter(self.wrapped)
+        self.file = base64io.Base64IO(self._tee)
 
     def freeze(self) -> None:
         if not self.frozen:
-            self.frozen = True
-            # get a reference to the buffer to splice later
             self.file.close()
             self.file.flush()
-            self.contents = self.wrapped.getvalue()
-            # calc other properties
-            self.hash = hashlib.sha256(self.contents).hexdigest()[:10]
-            self.size = self.wrapped.tell()
+            self._seal()
+
+    def load_frozen(self, f: t.BinaryIO) -> None:
+        self.file.close()
+        self.wrapped.seek(0)
+        self.wrapped.truncate()
+        self._tee.reset()
+        copyfileobj(f, self._tee)
+        self._seal()
+
+    def _seal(self) -> None:
+        self.frozen = True
+        self.hash = self._tee.hash
+        self.size = self._tee.size
+        # b64 encodes every 3 bytes as 4 chars, padding the final group
+        padding = 0
+        if self.size:
+            self.wrapped.seek(-2, io.SEEK_END)
+            padding = self.wrapped.read().count(b"=")
+        self.raw_size = self.size // 4 * 3 - padding
+
+    @property
+    def contents(self) -> bytes:
+        """The b64-encoded contents, read fully into memory - use iter_contents for large entries"""
+        assert self.frozen
+        self.wrapped.seek(0)
+        return self.wrapped.read()
 
     @property
     def src(self) -> str:
         return f"data:{self.mime};base64,{self.contents.decode('ascii')}"
 
+    def iter_contents(self, chunk_size: int = CHUNK_SIZE) -> t.Iterator[bytes]:
+        """Iterate over the b64-encoded contents in chunks, streaming them from memory or disk"""
+        assert self.frozen
+        self.wrapped.seek(0)
+        while chunk := self.wrapped.read(chunk_size):
+            yield chunk
+
 
-class GzipTmpFileEntry(FileEntry):
-    """Gzipped file, by default stored in /tmp"""
+class EncodedTmpFileEntry(FileEntry):
+    """File encoded using a codec (by default chosen by mime-type), by default stored in /tmp"""
 
     # both file and wapper files are bytes-only
-    file: gzip.GzipFile
+    file: t.BinaryIO
     # TODO - this could actually be an in-memory file...
     wrapped: tempfile.NamedTemporaryFile
     has_output_dir: bool = False
+    # the stored file within the output dir, once frozen named by its contents
+    path: t.Optional[Path] = None
+    codec: Codec
+    _tee: HashingWriter
 
     # Do we need DPTmpFile here, or just use namedtempfile??
-    def __init__(self, ext: str, mime: t.Optional[str] = None, dir_path: t.Optional[Path] = None):
+    def __init__(
+        self, ext: str, mime: t.Optional[str] = None, dir_path: t.Optional[Path] = None, codec: t.Optional[Codec] = None
+    ):
         super().__init__(ext, mime, dir_path)
+        self.codec = codec or default_codec(self.mime)
 
         if dir_path:
-            # create as a permanent file within the given dir
+            # create as a permanent file within the given dir, renamed by its contents once frozen
             self.has_output_dir = True
-            self.wrapped = tempfile.NamedTemporaryFile("w+b", suffix=ext, prefix="dp-", dir=dir_path, delete=False)
+            self.wrapped = tempfile.NamedTemporaryFile("w+b", prefix=".dp-tmp-", dir=dir_path, delete=False)
+            self.path = Path(self.wrapped.name)
         else:
             self.wrapped = tempfile.NamedTemporaryFile("w+b", suffix=ext, prefix="dp-")
 
-        self.file = gzip.GzipFile(fileobj=self.wrapped, mode="w+b", mtime=GZIP_MTIME)
-
-    def calc_hash(self, f: t.IO) -> str:
-        f.seek(0)
-        file_hash = hashlib.sha256()
-        while chunk := f.read(8192):
-            file_hash.update(chunk)
-        return file_hash.hexdigest()[:10]
+        # hash the encoded output as it's written
+        self._tee = HashingWriter(self.wrapped)
+        self.file = self.codec.writer(self._tee)
 
     @property
     def src(self) -> str:
         if self.has_output_dir:
-            return f"/{SERVED_REPORT_ASSETS_DIR}/{Path(self.wrapped.name).name}"
+            name = self.path.name
+            # NOTE - not using str.removesuffix to keep py3.8 support
+            return f"/{SERVED_REPORT_ASSETS_DIR}/{name[: len(name) - len(self.codec.suffix)]}"
         else:
             return "NYI"
 
     def freeze(self) -> None:
         if not self.frozen:
-            self.frozen = True
             self.file.flush()
+            self.raw_size = self.file.tell()
             self.file.close()
-            self.wrapped.flush()
-            # size will be the compressed size...
-            self.size = self.wrapped.tell()
-            self.hash = self.calc_hash(self.wrapped)
+            self._seal()
+
+    def load_frozen(self, f: t.BinaryIO) -> None:
+        # drop any header already written by the (unused) encoder
+        self.file.close()
+        self.wrapped.seek(0)
+        self.wrapped.truncate()
+        self._tee.reset()
+        copyfileobj(f, self._tee)
+        self._seal()
+
+    def _seal(self) -> None:
+        self.frozen = True
+        self.wrapped.flush()
+        # size will be the compressed size...
+        self.size = self._tee.size
+        self.hash = self._tee.hash
+        if self.has_output_dir:
+            self._store_by_hash()
+
+    def _store_by_hash(self) -> None:
+        # content-addressed names (suffixed with the content-coding) mean unchanged assets
+        # keep the same, immutable, file across builds
+        path = self._dir_path / f"dp-{self.hash}{self._ext}{self.codec.suffix}"
+        # the stored file is read via its path from now on
+        self.wrapped.close()
+        if path.exists():
+            # already stored, e.g. by a previous build, so leave it untouched
+            self.path.unlink()
+        else:
+            os.replace(self.path, path)
+        self.path = path
+
+    def write_frozen(self, f: t.BinaryIO) -> None:
+        if not self.has_output_dir:
+            return super().write_frozen(f)
+        assert self.frozen
+        with self.path.open("rb") as src_obj:
+            copyfileobj(src_obj, f)
+
+    def discard(self) -> None:
+        # stored files are named by their contents, so are shared with the entry kept in the store
+        self.wrapped.close()
+
+
+class GzipTmpFileEntry(EncodedTmpFileEntry):
+    """Gzipped file, by default stored in /tmp - as expected when uploading"""
+
+    def __init__(self, ext: str, mime: t.Optional[str] = None, dir_path: t.Optional[Path] = None):
+        super().__init__(ext, mime, dir_path, codec=GzipCodec())
+
+
+class LinkedFileEntry(FileEntry):
+    """Existing file linked, uncompressed, into an assets dir rather than copied through an encoder
+
+    Read-only files are hardlinked, as can't change under their content-addressed name, whilst others are
+    copied (that may reflink / copy in-kernel), so later edits to either file don't affect the other.
+    Either way the file is served as-is with the identity encoding
+    """
+
+    path: Path
+
+    def __init__(self, src_path: Path, dir_path: Path):
+        ext = "".join(src_path.suffixes)
+        super().__init__(ext, dir_path=dir_path)
+        self.codec = IdentityCodec()
+        self.hash = self.calc_hash(src_path)
+        self.size = self.raw_size = src_path.stat().st_size
+        self.path = dir_path / f"dp-{self.hash}{ext}"
+        if not self.path.exists():
+            self._link(src_path, self.path)
+        self.frozen = True
+
+    @staticmethod
+    def calc_hash(path: Path) -> str:
+        file_hash = hashlib.sha256()
+        with path.open("rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()[:10]
+
+    @staticmethod
+    def _link(src_path: Path, dest_path: Path) -> None:
+        # link to the underlying file, as (relative) symlinks may not resolve from the assets dir
+        src_path = src_path.resolve()
+        if not src_path.stat().st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+            try:
+                os.link(src_path, dest_path)
+                return
+            except OSError:
+                # e.g. across devices, or unsupported by the filesystem
+                pass
+        shutil.copyfile(src_path, dest_path)
+
+    def freeze(self) -> None:
+        pass
+
+    @property
+    def src(self) -> str:
+        return f"/{SERVED_REPORT_ASSETS_DIR}/{self.path.name}"
+
+    def write_frozen(self, f: t.BinaryIO) -> None:
+        with self.path.open("rb") as src_obj:
+            copyfileobj(src_obj, f)
 
 
 class FileStore:
-    # TODO - make this a CAS (index by object hash itself?)
+    """Content-addressed store of file entries, indexed by the hash of their (frozen) contents
+
+    Identical assets are only stored once - adding an entry whose contents already exist in the store
+    discards it and returns the existing entry instead, which should be used for all references
+    """
+
     # NOTE - currently we pass dir_path via the FileStore, could move into the file themselves?
     def __init__(self, fw_klass: t.Type[FileEntry], assets_dir: t.Optional[Path] = None):
         super().__init__()
         self.fw_klass = fw_klass
-        self.files: t.List[FileEntry] = []
+        # NOTE - dicts are insertion-ordered, so entries are kept in the order first added
+        self.files: t.Dict[str, FileEntry] = {}
         self.dir_path = assets_dir
 
     def __add__(self, other: FileStore) -> Self:
         # TODO - ensure factory is the same for both
-        self.files.extend(other.files)
+        for fw in other.files.values():
+            self.files.setdefault(fw.hash, fw)
         return self
 
     @property
@@ -177,30 +373,43 @@ class FileStore:
 
     @property
     def file_list(self) -> t.List[t.BinaryIO]:
-        return [f.wrapped for f in self.files]
+        return [f.wrapped for f in self.files.values()]
 
     def get_file(self, ext: str, mime: str) -> FileEntry:
         return self.fw_klass(ext, mime, self.dir_path)
 
-    def add_file(self, fw: FileEntry) -> None:
+    def add_file(self, fw: FileEntry) -> FileEntry:
+        """Freeze and add the entry to the store, returning the stored entry for its contents"""
         fw.freeze()
-        self.files.append(fw)
-
-    def load_file(self, path: Path) -> FileEntry:
-        """load a file into the store (makes a copy)"""
-        # TODO - ideally lazily-link a path to the store (rather than copy it in)
+        existing = self.files.get(fw.hash)
+        if existing is None:
+            self.files[fw.hash] = fw
+            return fw
+        if existing is not fw:
+            fw.discard()
+        return existing
+
+    def read_file(self, path: Path) -> FileEntry:
+        """read a file into a new, frozen, entry without adding it to the store
+
+        files are linked into the assets dir when the store has one, otherwise copied into a new entry
+        """
+        if self.dir_path:
+            return LinkedFileEntry(path, self.dir_path)
         ext = "".join(path.suffixes)
         dest_obj = self.fw_klass(ext=ext, dir_path=self.dir_path)
         with path.open("rb") as src_obj:
             copyfileobj(src_obj, dest_obj.file)
-        self.add_file(dest_obj)
+        dest_obj.freeze()
         return dest_obj
 
-    def as_dict(self) -> dict:
+    def load_file(self, path: Path) -> FileEntry:
+        """load a file into the store"""
+        return self.add_file(self.read_file(path))
+
+    def as_dict(self, include_src: bool = True) -> dict:
         """Build a json structure suitable for embedding in a html file, json-rpc response, etc."""
-        x: FileEntry  # noqa: F842
-        return {x.hash: x.as_dict() for x in self.files}
+        return {h: x.as_dict(include_src) for (h, x) in self.files.items()}
 
     def get_entry(self, hash: str) -> t.Optional[FileEntry]:
-        # TODO - change self.files to a dict[hash, FileEntry]?
-        return next((f for f in self.files if f.hash == hash), None)
+        return self.files.get(hash)
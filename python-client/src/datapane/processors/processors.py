@@ -6,7 +6,6 @@ import os
 import typing as t
 from abc import ABC
 from copy import copy
-from itertools import count
 from os import path as osp
 from pathlib import Path
 from uuid import uuid4
@@ -24,7 +23,8 @@ from datapane.common import HTML, NPath, timestamp, validate_view_doc
 from datapane.common.viewxml_utils import ElementT, local_view_resources
 from datapane.view import CollectFunctions, PreProcess, XMLBuilder
 
-from .file_store import FileEntry
+from .asset_cache import get_asset_cache
+from .file_store import SERVED_REPORT_ASSETS_DIR, B64FileEntry
 from .types import BaseProcessor, Formatting
 
 if t.TYPE_CHECKING:
@@ -84,9 +84,12 @@ class ConvertXML(BaseProcessor):
     local_post_xslt = etree.parse(str(local_view_resources / "local_post_process.xslt"))
     local_post_transform = etree.XSLT(local_post_xslt)
 
-    def __init__(self, *, pretty_print: bool = False, fragment: bool = False) -> None:
+    def __init__(
+        self, *, pretty_print: bool = False, fragment: bool = False, max_workers: t.Optional[int] = None
+    ) -> None:
         self.pretty_print: bool = pretty_print
         self.fragment: bool = fragment
+        self.max_workers: t.Optional[int] = max_workers
         super().__init__()
 
     def __call__(self, _: t.Any) -> ElementT:
@@ -106,9 +109,15 @@ class ConvertXML(BaseProcessor):
 
     def convert_xml(self) -> ElementT:
         # create initial state
-        builder_state = XMLBuilder(store=self.s.store)
-        self.s.blocks.accept(builder_state)
-        return builder_state.get_root(self.fragment)
+        asset_cache = get_asset_cache()
+        with XMLBuilder(
+            store=self.s.store, max_workers=self.max_workers, asset_cache=asset_cache, profile=self.s.profile
+        ) as builder_state:
+            self.s.blocks.accept(builder_state)
+            root = builder_state.get_root(self.fragment)
+        if asset_cache:
+            log.info(f"Asset cache - {asset_cache.stats}")
+        return root
 
     def post_transforms(self, view_doc: ElementT) -> ElementT:
         # TODO - post-xml transformations, essentially xslt / lxml-based DOM operations
@@ -135,17 +144,18 @@ class PreUploadProcessor(BaseProcessor):
                 "Reports with compute blocks can't currently be uploaded, please use dp.serve_app to serve as an app locally"
             )
 
-        # NOTE - this currently relies on all assets existing linearly in document order
-        # in the asset store - if we move to a cas we will need to update the algorithm here
+        # the store is content-addressed, so map each asset hash to its (unique) attachment index
+        # multiple refs may point to the same attachment
+        attachment_idxs: t.Dict[str, int] = {h: idx for (idx, h) in enumerate(self.s.store.files)}
         # replace ref -> attachment in view
-        # all blocks with a ref
-        refs: t.List[ElementT] = doc.xpath("/View//*[@src][starts-with(@src, 'ref://')]")
-        for (idx, ref, f_entry) in zip(count(0), refs, self.s.store.files):
-            ref: ElementT
-            f_entry: FileEntry
-            _hash: str = ref.get("src").split("://")[1]
-            ref.set("src", f"attachment://{idx}")
-            assert _hash == f_entry.hash  # sanity check
+        # all blocks with a ref, including the full datasets of previewed DataTables,
+        # and the list of datasets shared between Plots
+        for attr in ("src", "full_src", "datasets"):
+            refs: t.List[ElementT] = doc.xpath(f"/View//*[@{attr}][starts-with(@{attr}, 'ref://')]")
+            for ref in refs:
+                ref: ElementT
+                _hashes: t.List[str] = [r.split("://")[1] for r in ref.get(attr).split()]
+                ref.set(attr, " ".join(f"attachment://{attachment_idxs[_hash]}" for _hash in _hashes))
 
         self.s.view_xml = etree.tounicode(doc)
         return (self.s.view_xml, self.s.store.file_list)
@@ -153,6 +163,12 @@ class PreUploadProcessor(BaseProcessor):
 
 ###############################################################################
 # HTML Exporting Processors
+# assets streamed into a HTML file are written as separate script elements of this type,
+# base64 is html-safe so the payloads are never json-encoded or escaped
+ASSET_PAYLOAD_TYPE = "application/vnd.datapane.asset+base64"
+ASSET_PAYLOADS_MARKER = "<!-- dp-asset-payloads -->"
+
+
 class BaseExportHTML(BaseProcessor, ABC):
     """Provides shared logic for writing an app to local disk"""
 
@@ -196,8 +212,13 @@ class BaseExportHTML(BaseProcessor, ABC):
         name: str,
         formatting: t.Optional[Formatting] = None,
         app_runner: bool = False,
+        stream_assets: bool = False,
     ) -> t.Tuple[str, str]:
-        """Internal method to write the ViewXML and assets into a HTML container and associated files"""
+        """Internal method to write the ViewXML and assets into a HTML container and associated files
+
+        When `stream_assets` is set the asset srcs are omitted and the returned HTML contains a marker
+        where the asset payloads should be written, see `_stream_html_template`
+        """
         name = name or "app"
         formatting = formatting or Formatting()
 
@@ -206,7 +227,7 @@ class BaseExportHTML(BaseProcessor, ABC):
         # TODO - split this out?
         vs = self.s
         if vs:
-            assets = vs.store.as_dict() or {}
+            assets = vs.store.as_dict(include_src=not stream_assets) or {}
             view_xml = vs.view_xml
         else:
             assets = {}
@@ -227,10 +248,34 @@ class BaseExportHTML(BaseProcessor, ABC):
             cdn_static="https://datapane-cdn.com/static",
             cdn_base=self.get_cdn(),
             app_runner=app_runner,
+            asset_payloads=ASSET_PAYLOADS_MARKER if stream_assets else "",
         )
 
         return html, report_id
 
+    def _stream_html_template(
+        self,
+        path: NPath,
+        name: str,
+        formatting: t.Optional[Formatting] = None,
+    ) -> str:
+        """Internal method to write the HTML container directly to a file, streaming each asset payload
+        in chunks rather than building the whole document in memory"""
+        html, report_id = self._write_html_template(name=name, formatting=formatting, stream_assets=True)
+        head, tail = html.split(ASSET_PAYLOADS_MARKER)
+
+        with open(path, "wb") as f:
+            f.write(head.encode("utf-8"))
+            fe: B64FileEntry
+            for fe in self.s.store.files.values():
+                f.write(f'<script type="{ASSET_PAYLOAD_TYPE}" data-hash="{fe.hash}">'.encode("ascii"))
+                for chunk in fe.iter_contents():
+                    f.write(chunk)
+                f.write(b"</script>\n")
+            f.write(tail.encode("utf-8"))
+
+        return report_id
+
 
 class ExportBaseHTMLOnly(BaseExportHTML):
     """Export the base view used to render an App, containing no ViewXML nor Assets"""
@@ -259,7 +304,7 @@ class ExportHTMLInlineAssets(BaseExportHTML):
     """
     Export a view into a single HTML file containing:
     - View XML - embedded
-    - Assetes - embedded as b64 data-uris
+    - Assetes - embedded as b64 payloads, streamed directly to the file and resolved to data-uris on load
     """
 
     template_name = "local_template.html"
@@ -271,9 +316,7 @@ class ExportHTMLInlineAssets(BaseExportHTML):
         self.formatting = formatting
 
     def __call__(self, _: t.Any) -> str:
-        html, report_id = self._write_html_template(name=self.name, formatting=self.formatting)
-
-        Path(self.path).write_text(html, encoding="utf-8")
+        report_id = self._stream_html_template(self.path, name=self.name, formatting=self.formatting)
 
         display_msg(f"App saved to ./{self.path}")
 
@@ -293,6 +336,7 @@ class ExportHTMLFileAssets(BaseExportHTML):
     """
 
     template_name = "local_template.html"
+    manifest_name = "manifest.json"
 
     def __init__(self, app_dir: Path, name: str = "app", formatting: t.Optional[Formatting] = None):
         self.app_dir = app_dir
@@ -307,9 +351,29 @@ class ExportHTMLFileAssets(BaseExportHTML):
 
         index_path = self.app_dir / "index.html"
         index_path.write_text(html, encoding="utf-8")
+        self._update_manifest()
         display_msg(f"Built app in {self.app_dir}")
         return self.app_dir
 
+    def _update_manifest(self) -> None:
+        """Record the stored assets in the manifest, pruning those from the previous build that are no longer used"""
+        manifest_path = self.app_dir / self.manifest_name
+        assets_dir = self.app_dir / SERVED_REPORT_ASSETS_DIR
+        prev_assets: t.Dict[str, str] = (
+            json.loads(manifest_path.read_text())["assets"] if manifest_path.exists() else {}
+        )
+        # assets are stored named by their contents, so unchanged assets are already in place
+        assets = {h: fe.path.name for (h, fe) in self.s.store.files.items()}
+
+        stale_files = set(prev_assets.values()) - set(assets.values())
+        for fn in stale_files:
+            (assets_dir / fn).unlink(missing_ok=True)
+        manifest_path.write_text(json.dumps(dict(assets=assets), indent=2), encoding="utf-8")
+        log.info(
+            f"Stored {len(assets.keys() - prev_assets.keys())} new assets, "
+            f"{len(assets.keys() & prev_assets.keys())} unchanged, {len(stale_files)} removed"
+        )
+
 
 class ExportHTMLStringInlineAssets(BaseExportHTML):
     """
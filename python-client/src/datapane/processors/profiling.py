@@ -0,0 +1,125 @@
+"""
+Instrumentation of the processing pipeline - wall / cpu time and peak memory per processor,
+and timings and sizes per asset written.
+
+Enable via the `profile` argument of the top-level API, or by setting `DATAPANE_PROFILE=1`.
+Memory tracing (via tracemalloc) slows down processing, and so skews the timings, so is opt-in -
+pass `Profile(trace_memory=True)` or set `DATAPANE_PROFILE_MEMORY=1`.
+Peak memory per processor requires python 3.9+ (for `tracemalloc.reset_peak`), and isn't recorded otherwise.
+Set `DATAPANE_PROFILE_TRACE` to a path to also write the results as a Chrome trace-event file,
+viewable in chrome://tracing or https://ui.perfetto.dev
+"""
+from __future__ import annotations
+
+import dataclasses as dc
+import json
+import os
+import threading
+import time
+import tracemalloc
+import typing as t
+from contextlib import contextmanager
+from pathlib import Path
+
+from datapane.client import log
+from datapane.common import SIZE_1_MB, NPath
+
+ProfileArg = t.Union[bool, "Profile"]
+
+
+@dc.dataclass
+class Span:
+    name: str
+    cat: str
+    # start time and durations, in secs
+    start: float
+    wall: float = 0.0
+    cpu: float = 0.0
+    mem_peak: t.Optional[int] = None
+    thread_id: int = 0
+    args: t.Dict[str, t.Any] = dc.field(default_factory=dict)
+
+    def __str__(self) -> str:
+        mem = f", peak mem {self.mem_peak / SIZE_1_MB:.2f}MB" if self.mem_peak is not None else ""
+        args = "".join(f", {k}={v}" for (k, v) in self.args.items())
+        return f"{self.cat}:{self.name} - wall {self.wall:.3f}s, cpu {self.cpu:.3f}s{mem}{args}"
+
+
+class Profile:
+    """Collects spans for each processor and asset, safe to use across threads"""
+
+    def __init__(self, trace_memory: bool = False):
+        self.spans: t.List[Span] = []
+        self._lock = threading.Lock()
+        # only trace memory if not already done elsewhere, as it's relatively expensive
+        self._owns_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start()
+
+    @contextmanager
+    def span(
+        self, name: str, cat: str, trace_memory: bool = False, cpu_clock: t.Callable[[], float] = time.thread_time
+    ) -> t.Iterator[t.Dict[str, t.Any]]:
+        """Time the enclosed block, yielding a dict of args to attach to the span"""
+        s = Span(name=name, cat=cat, start=time.perf_counter(), thread_id=threading.get_ident())
+        # without reset_peak (py3.8) the peak would be that of the whole run so far, so isn't recorded
+        trace_memory = trace_memory and tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak")
+        if trace_memory:
+            tracemalloc.reset_peak()
+        cpu_start = cpu_clock()
+        try:
+            yield s.args
+        finally:
+            s.wall = time.perf_counter() - s.start
+            s.cpu = cpu_clock() - cpu_start
+            if trace_memory:
+                s.mem_peak = tracemalloc.get_traced_memory()[1]
+            with self._lock:
+                self.spans.append(s)
+
+    def processor_span(self, name: str) -> t.ContextManager[t.Dict[str, t.Any]]:
+        # processors may use worker threads, so measure cpu time across the process
+        return self.span(name, "processor", trace_memory=True, cpu_clock=time.process_time)
+
+    def to_chrome_trace(self) -> t.Dict[str, t.Any]:
+        """Convert to the Chrome trace-event format, using complete events"""
+        pid = os.getpid()
+        events = [
+            dict(
+                name=s.name,
+                cat=s.cat,
+                ph="X",
+                ts=s.start * 1e6,
+                dur=s.wall * 1e6,
+                pid=pid,
+                tid=s.thread_id,
+                args=dict(cpu=s.cpu, mem_peak=s.mem_peak, **s.args),
+            )
+            for s in self.spans
+        ]
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def write_chrome_trace(self, path: NPath) -> None:
+        Path(path).write_text(json.dumps(self.to_chrome_trace(), default=str), encoding="utf-8")
+
+    def finish(self) -> None:
+        """Stop tracing, logging the results and writing the trace if requested"""
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+        log.info(f"Pipeline profile\n{self}")
+        if trace_path := os.getenv("DATAPANE_PROFILE_TRACE"):
+            self.write_chrome_trace(trace_path)
+            log.info(f"Written profile trace to {trace_path}")
+
+    def __str__(self) -> str:
+        return "\n".join(str(s) for s in self.spans)
+
+
+def mk_profile(profile: ProfileArg = False) -> t.Optional[Profile]:
+    """Create a profile if enabled, either directly or via the environment"""
+    if isinstance(profile, Profile):
+        return profile
+    if profile or os.getenv("DATAPANE_PROFILE", "").lower() in ("1", "true"):
+        return Profile(trace_memory=os.getenv("DATAPANE_PROFILE_MEMORY", "").lower() in ("1", "true"))
+    return None
@@ -9,6 +9,7 @@ from datapane.common import ViewXML
 from datapane.view import Blocks
 
 from .file_store import DummyFileEntry, FileEntry, FileStore
+from .profiling import Profile
 
 if t.TYPE_CHECKING:
     from datapane.app.runtime import FunctionRef
@@ -23,6 +24,7 @@ class ViewState:
     view_xml: ViewXML = ""
     entries: t.Dict[str, FunctionRef] = dc.field(default_factory=dict)
     dir_path: dc.InitVar[t.Optional[Path]] = None
+    profile: t.Optional[Profile] = None
 
     def __post_init__(self, file_entry_klass, dir_path):
         # TODO - should we use a lambda for file_entry_klass with dir_path captured?
@@ -57,7 +59,11 @@ class Pipeline(t.Generic[P_IN]):
 
     def pipe(self, p: BaseProcessor[P_IN, P_OUT]) -> Pipeline[P_OUT]:
         p.s = self._state
-        y = p.__call__(self._x)  # need to call as positional args
+        if self._state.profile is None:
+            y = p.__call__(self._x)  # need to call as positional args
+        else:
+            with self._state.profile.processor_span(type(p).__name__):
+                y = p.__call__(self._x)
         self._state = p.s
         return Pipeline(self._state, y)
 
@@ -5,14 +5,20 @@
 # flake8: noqa:F811
 from __future__ import annotations
 
+import base64
 import json
 import pickle
+import threading
 import typing as t
 from contextlib import suppress
 from io import TextIOWrapper
 
+import altair as alt
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from altair.utils import SchemaBase
+from altair.utils.data import to_values
 from multimethod import multimethod
 from packaging import version as v
 from packaging.specifiers import SpecifierSet
@@ -21,6 +27,7 @@ from pandas.io.formats.style import Styler
 from datapane import optional_libs as opt
 from datapane.client import DPClientError, log
 from datapane.common import ArrowFormat
+from datapane.common.datafiles import downcast_tolerance
 
 from .xml_visitor import AssetMeta
 
@@ -72,6 +79,13 @@ class AttachmentWriter:
 
 
 class DataTableWriter:
+    # NOTE - the buffers are never compressed, regardless of DATAPANE_ARROW_COMPRESSION,
+    # as the report frontend (apache-arrow 10) can't read compressed IPC buffers
+
+    def __init__(self, float_tolerance: t.Optional[float] = None):
+        # resolved from the env when created, so is part of the asset cache key
+        self.float_tolerance = downcast_tolerance(float_tolerance)
+
     @multimethod
     def get_meta(self, x: pd.DataFrame) -> AssetMeta:
         return AssetMeta(mime=ArrowFormat.content_type, ext=ArrowFormat.ext)
@@ -81,7 +95,28 @@ class DataTableWriter:
         if x.size == 0:
             raise DPClientError("Empty DataFrame provided")
         # process_df called in Arrow.save_file
-        ArrowFormat.save_file(f, x)
+        ArrowFormat.save_file(f, x, compression="none", float_tolerance=self.float_tolerance)
+
+    @multimethod
+    def get_meta(self, x: t.Union[pa.Table, pa.RecordBatchReader]) -> AssetMeta:
+        return AssetMeta(mime=ArrowFormat.content_type, ext=ArrowFormat.ext)
+
+    @multimethod
+    def write_file(self, x: t.Union[pa.Table, pa.RecordBatchReader], f) -> None:
+        if isinstance(x, pa.Table) and (x.num_rows == 0 or x.num_columns == 0):
+            raise DPClientError("Empty Table provided")
+        # process_table called in Arrow.save_table
+        ArrowFormat.save_table(f, x, compression="none", float_tolerance=self.float_tolerance)
+
+    if opt.HAVE_POLARS:
+
+        @multimethod
+        def get_meta(self, x: opt.PLDataFrame) -> AssetMeta:
+            return AssetMeta(mime=ArrowFormat.content_type, ext=ArrowFormat.ext)
+
+        @multimethod
+        def write_file(self, x: opt.PLDataFrame, f) -> None:
+            self.write_file(x.to_arrow(), f)
 
 
 class HTMLTableWriter:
@@ -109,9 +144,157 @@ class HTMLTableWriter:
             )
 
 
+# plots with more points than this are drawn as images rather than svgs in auto format,
+# as each point is a separate path in the svg, making it slow to write and render
+MPL_RASTER_THRESHOLD = 20_000
+MPL_FORMATS = dict(
+    svg=AssetMeta(mime="image/svg+xml", ext=".svg"),
+    png=AssetMeta(mime="image/png", ext=".png"),
+    webp=AssetMeta(mime="image/webp", ext=".webp"),
+)
+
+
+def _mpl_n_points(fig: opt.Figure) -> int:
+    """Estimate the number of points drawn for the figure, e.g. the markers of scatter plots and vertices of lines"""
+    from matplotlib.collections import Collection
+    from matplotlib.lines import Line2D
+
+    n = 0
+    for artist in fig.findobj():
+        if isinstance(artist, Collection):
+            n_offsets = len(artist.get_offsets())
+            n += n_offsets if n_offsets > 1 else sum(len(p.vertices) for p in artist.get_paths())
+        elif isinstance(artist, Line2D):
+            n += len(artist.get_xydata())
+        else:
+            n += 1
+    return n
+
+
+# numeric arrays in plotly figures larger than this are encoded as base64 typed arrays
+PLOTLY_BDATA_MIN_SIZE = 256
+# the typed array dtypes supported by plotly.js, with 64-bit ints downcast if possible, else stored as floats
+PLOTLY_DTYPES = {np.dtype(d): d for d in ("i1", "u1", "i2", "u2", "i4", "u4", "f4", "f8")}
+
+
+def _plotly_typed_array(x: np.ndarray) -> t.Union[np.ndarray, t.Dict[str, str]]:
+    """Encode the array as per plotly's typed array spec, i.e. `{dtype, bdata, shape}`, if suitable"""
+    if x.dtype.kind not in "iuf" or x.ndim > 2 or x.size < PLOTLY_BDATA_MIN_SIZE:
+        return x
+    dtype = x.dtype.newbyteorder("=")
+    if dtype not in PLOTLY_DTYPES:
+        dtype = np.dtype("f8")
+        if x.dtype.kind in "iu":
+            for d in ("i4", "u4") if x.dtype.kind == "i" else ("u4",):
+                info = np.iinfo(d)
+                if info.min <= x.min() and x.max() <= info.max:
+                    dtype = np.dtype(d)
+                    break
+    out = dict(dtype=PLOTLY_DTYPES[dtype], bdata=base64.b64encode(x.astype(dtype.newbyteorder("<")).tobytes()).decode())
+    if x.ndim == 2:
+        out.update(shape=f"{x.shape[0]}, {x.shape[1]}")
+    return out
+
+
+def _encode_plotly_arrays(x: t.Any) -> t.Any:
+    """Recursively encode the large numeric arrays of a plotly figure dict"""
+    if isinstance(x, dict):
+        return {k: _encode_plotly_arrays(v) for (k, v) in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [_encode_plotly_arrays(v) for v in x]
+    if isinstance(x, np.ndarray):
+        return _plotly_typed_array(x)
+    return x
+
+
+################################################################################
+# Altair datasets
+# The DataFrames of altair charts are stored as separate, shared, dataset assets, named by their contents,
+# so a frame used by many charts is only serialised and stored once, with each chart referencing it by name
+_ALTAIR_LOCK = threading.Lock()
+# smaller frames are kept inline, as not worth the extra request
+ALTAIR_SHARED_MIN_ROWS = 1000
+
+
+def _shared_datasets() -> bool:
+    # other data transformers, e.g. json, already store the data separately
+    # NOTE - checked under the lock, as the transformer is switched whilst writing specs, see _altair_spec
+    with _ALTAIR_LOCK:
+        return alt.data_transformers.active == "default"
+
+
+def altair_dataset_name(x: pd.DataFrame) -> t.Optional[str]:
+    """The name of the dataset for the frame, from a fingerprint of its contents, or None if it isn't shared"""
+    from datapane.processors.asset_cache import fingerprint
+
+    if len(x) < ALTAIR_SHARED_MIN_ROWS:
+        return None
+    fp = fingerprint(x)
+    return f"data-{fp[:32]}" if fp else None
+
+
+def find_altair_datasets(x: SchemaBase) -> t.Dict[str, pd.DataFrame]:
+    """Find the DataFrames in the chart, including any nested charts, to be stored as shared datasets"""
+    datasets: t.Dict[str, pd.DataFrame] = {}
+
+    def _find(v: t.Any) -> None:
+        if isinstance(v, pd.DataFrame):
+            name = altair_dataset_name(v)
+            if name:
+                datasets[name] = v
+        elif isinstance(v, SchemaBase):
+            for _v in v._kwds.values():
+                _find(_v)
+        elif isinstance(v, (list, tuple)):
+            for _v in v:
+                _find(_v)
+
+    if _shared_datasets():
+        _find(x)
+    return datasets
+
+
+def _altair_spec(x: SchemaBase) -> t.Dict[str, t.Any]:
+    """The chart spec, with any DataFrames replaced by references to their shared datasets"""
+
+    def _to_named(data: t.Any) -> t.Dict[str, t.Any]:
+        name = altair_dataset_name(data) if isinstance(data, pd.DataFrame) else None
+        # NOTE - shared datasets aren't limited to max_rows, as like altair's json transformer, they're not inlined
+        return default_transformer(data) if name is None else dict(name=name)
+
+    # NOTE - the data transformer is global, so only used by a single chart at a time
+    with _ALTAIR_LOCK:
+        if alt.data_transformers.active == "default":
+            default_transformer = alt.data_transformers.get()
+            alt.data_transformers.register("datapane", _to_named)
+            with alt.data_transformers.enable("datapane"):
+                return x.to_dict()
+    return x.to_dict()
+
+
+class VegaDatasetWriter:
+    def __init__(self, name: str):
+        self.name = name
+
+    @multimethod
+    def get_meta(self, x: pd.DataFrame) -> AssetMeta:
+        return AssetMeta(mime="application/vnd.vegalite.data+json", ext=".vl.data.json")
+
+    @multimethod
+    def write_file(self, x: pd.DataFrame, f) -> None:
+        # the same values as altair's default transformer, along with the name charts reference them by
+        values = to_values(x)["values"]
+        json.dump(dict(name=self.name, values=values), DPTextIOWrapper(f))
+
+
 class PlotWriter:
     obj_type: t.Any
 
+    def __init__(self, format: str = "auto", dpi: t.Optional[int] = None):
+        # the format and dpi are only used for matplotlib plots
+        self.format = format
+        self.dpi = dpi
+
     # Altair (always installed)
     @multimethod
     def get_meta(self, x: SchemaBase) -> AssetMeta:
@@ -119,7 +302,8 @@ class PlotWriter:
 
     @multimethod
     def write_file(self, x: SchemaBase, f) -> None:
-        json.dump(x.to_dict(), DPTextIOWrapper(f))
+        # any DataFrames are written separately as shared datasets, see find_altair_datasets
+        json.dump(_altair_spec(x), DPTextIOWrapper(f))
 
     if opt.HAVE_FOLIUM:
 
@@ -163,17 +347,26 @@ class PlotWriter:
 
         @multimethod
         def write_file(self, x: opt.PFigure, f):
-            json.dump(x.to_json(), DPTextIOWrapper(f))
+            import plotly.io as pio
+
+            # write the figure as JSON directly, with large arrays as base64 typed arrays,
+            # using plotly's encoder so orjson is used where installed
+            fig = _encode_plotly_arrays(x.to_dict())
+            f.write(pio.to_json(fig, validate=False).encode())
 
     if opt.HAVE_MATPLOTLIB:
 
         @multimethod
         def get_meta(self, x: t.Union[opt.Axes, opt.Figure, opt.ndarray]) -> AssetMeta:
-            return AssetMeta(mime="image/svg+xml", ext=".svg")
+            return MPL_FORMATS[self._mpl_format(self._mpl_figure(x))]
 
         @multimethod
         def write_file(self, x: opt.Figure, f) -> None:
-            x.savefig(DPTextIOWrapper(f), format="svg", bbox_inches="tight")
+            fmt = self._mpl_format(x)
+            if fmt == "svg":
+                x.savefig(DPTextIOWrapper(f), format="svg", bbox_inches="tight")
+            else:
+                x.savefig(f, format=fmt, dpi=self.dpi or "figure", bbox_inches="tight")
 
         @multimethod
         def write_file(self, x: opt.Axes, f) -> None:
@@ -181,5 +374,19 @@ class PlotWriter:
 
         @multimethod
         def write_file(self, x: opt.ndarray, f) -> None:
-            fig = x.flatten()[0].get_figure()
-            self.write_file(fig, f)
+            self.write_file(self._mpl_figure(x), f)
+
+        @staticmethod
+        def _mpl_figure(x: t.Union[opt.Axes, opt.Figure, opt.ndarray]) -> opt.Figure:
+            if isinstance(x, opt.ndarray):
+                x = x.flatten()[0]
+            return x.get_figure() if isinstance(x, opt.Axes) else x
+
+        def _mpl_format(self, fig: opt.Figure) -> str:
+            if self.format != "auto":
+                return self.format
+            n_points = _mpl_n_points(fig)
+            if n_points > MPL_RASTER_THRESHOLD:
+                log.debug(f"Plot has {n_points} points, saving as png rather than svg")
+                return "png"
+            return "svg"
@@ -4,14 +4,18 @@ from __future__ import annotations
 import dataclasses as dc
 import typing as t
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 
+from altair.utils import SchemaBase
 from lxml import etree
 from lxml.builder import ElementMaker
 from multimethod import DispatchError, multimethod
 
 from datapane import DPClientError
+from datapane import optional_libs as opt
 from datapane.blocks import BaseBlock
-from datapane.blocks.asset import AssetBlock
+from datapane.blocks.asset import AssetBlock, DataTable, Plot, VegaDataset
 from datapane.blocks.compute import Compute, TargetMode, gen_name
 from datapane.blocks.layout import ContainerBlock
 from datapane.blocks.text import EmbeddedTextBlock
@@ -22,6 +26,8 @@ from datapane.view.visitors import ViewVisitor
 
 if t.TYPE_CHECKING:
     from datapane.processors import FileEntry, FileStore
+    from datapane.processors.asset_cache import AssetCache
+    from datapane.processors.profiling import Profile
 
     # from typing_extensions import Self
 
@@ -30,14 +36,49 @@ E = ElementMaker()  # XML Tag Factory
 
 @dc.dataclass
 class XMLBuilder(ViewVisitor):
-    """Convert the Blocks into an XML document"""
+    """Convert the Blocks into an XML document
+
+    Passing `max_workers` (> 1) serialises assets concurrently on a thread pool - asset elements are created
+    during the tree walk and their `type` / `src` attributes are set once all writes have been joined,
+    adding entries to the store in document order so the resulting XML and asset order are deterministic.
+    Use the builder as a context manager so the pool is shut down, cancelling outstanding writes, if the walk fails.
+    Matplotlib plots are still written on the calling thread, as pyplot isn't thread-safe
+
+    Passing an `asset_cache` reuses previously serialised assets for unchanged objects across runs
+
+    Passing a `profile` records the timings and sizes of each asset written
+    """
 
     store: FileStore
     # element: t.Optional[etree.Element] = None  # Empty Group Element?
     elements: t.List[ElementT] = dc.field(default_factory=list)
+    max_workers: t.Optional[int] = None
+    asset_cache: t.Optional[AssetCache] = None
+    profile: t.Optional[Profile] = None
+    _executor: t.Optional[ThreadPoolExecutor] = dc.field(default=None, init=False, repr=False)
+    _pending: t.List[t.Tuple[AssetBlock, ElementT, str, Future]] = dc.field(
+        default_factory=list, init=False, repr=False
+    )
+    # writes of blocks added more than once, e.g. shared datasets, are only submitted once
+    _submitted: t.Dict[int, Future] = dc.field(default_factory=dict, init=False, repr=False)
+    # datasets shared between altair plots, by name
+    _datasets: t.Dict[str, VegaDataset] = dc.field(default_factory=dict, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.max_workers and self.max_workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dp-asset-writer")
+
+    def __enter__(self) -> XMLBuilder:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
     def get_root(self, fragment: bool = False) -> ElementT:
         """Return the top-level ViewXML"""
+        # wait for any outstanding asset writes
+        self.join_assets()
+
         # create the top-level
 
         # get the top-level root
@@ -127,25 +168,101 @@ class XMLBuilder(ViewVisitor):
     @multimethod
     def visit(self, b: AssetBlock):
         """Main XMl creation method - visitor method"""
-        fe = self._add_asset_to_store(b)
+        e = self._mk_asset_element(b)
+        self._add_asset(b, e)
+        return self.add_element(b, e)
 
+    @multimethod
+    def visit(self, b: DataTable):
+        e = self._mk_asset_element(b)
+        self._add_asset(b, e)
+        if b.full:
+            # the full dataset is a separate asset, only fetched when requested by the viewer
+            self._add_asset(b.full, e, src_attr="full_src")
+        return self.add_element(b, e)
+
+    @multimethod
+    def visit(self, b: Plot):
+        e = self._mk_asset_element(b)
+        self._add_asset(b, e)
+        if isinstance(b.data, SchemaBase):
+            from .asset_writers import find_altair_datasets
+
+            # each dataset is only written once, however many plots use it
+            for name, df in find_altair_datasets(b.data).items():
+                self._add_asset(self._datasets.setdefault(name, VegaDataset(df, name)), e, src_attr="datasets")
+        return self.add_element(b, e)
+
+    def _mk_asset_element(self, b: AssetBlock) -> ElementT:
         _E = getattr(E, b._tag)
 
+        # type and src are set once the asset has been added to the store
         e: etree._Element = _E(
-            type=fe.mime,
+            type="",
             # size=conv_attrib(fe.size),
             # hash=fe.hash,
             **{**b._attributes, **b.get_file_attribs()},
             # src=f"attachment://{self.store_count}",
-            src=f"ref://{fe.hash}",
+            src="",
         )
 
         if b.caption:
             e.set("caption", b.caption)
-        return self.add_element(b, e)
+        return e
+
+    def _add_asset(self, b: AssetBlock, e: ElementT, src_attr: str = "src") -> None:
+        if self._executor:
+            if id(b) not in self._submitted:
+                if _is_mpl_plot(b):
+                    # write now, but still add to the store in document order
+                    fut = self._submitted[id(b)] = Future()
+                    fut.set_result(self._write_asset(b))
+                else:
+                    self._submitted[id(b)] = self._executor.submit(self._write_asset, b)
+            self._pending.append((b, e, src_attr, self._submitted[id(b)]))
+        else:
+            self._set_asset_attribs(e, self._add_asset_to_store(b, self._write_asset(b)), src_attr)
+
+    def join_assets(self) -> None:
+        """Wait for all submitted asset writes, adding them to the store in the order visited"""
+        if not self._executor:
+            return
+        try:
+            for b, e, src_attr, fut in self._pending:
+                self._set_asset_attribs(e, self._add_asset_to_store(b, fut.result()), src_attr)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Shut down the thread pool, if any, cancelling any writes not yet joined, e.g. on error"""
+        if not self._executor:
+            return
+        for _, _, _, fut in self._pending:
+            fut.cancel()
+        self._pending = []
+        self._submitted = {}
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    @staticmethod
+    def _set_asset_attribs(e: ElementT, fe: FileEntry, src_attr: str = "src") -> None:
+        ref = f"ref://{fe.hash}"
+        if src_attr == "src":
+            e.set("type", fe.mime)
+        elif src_attr == "datasets":
+            # a list of refs
+            ref = " ".join(filter(None, (e.get(src_attr), ref)))
+        e.set(src_attr, ref)
+
+    def _add_asset_to_store(self, b: AssetBlock, fe: FileEntry) -> FileEntry:
+        # the store may return an existing entry if the contents are identical
+        fe = self.store.add_file(fe)
+        b._prev_entry = fe
+        return fe
 
-    def _add_asset_to_store(self, b: AssetBlock) -> FileEntry:
-        """Default asset store handler that operates on native Python objects"""
+    def _write_asset(self, b: AssetBlock) -> FileEntry:
+        """Default asset handler that operates on native Python objects,
+        writing them to a new frozen entry (that may run on a worker thread)"""
         # import here as a very slow module due to nested imports
         # from .. import files
 
@@ -153,7 +270,6 @@ class XMLBuilder(ViewVisitor):
         # TODO - do we just persist the asset store across the session??
         if b._prev_entry:
             if type(b._prev_entry) == self.store.fw_klass:
-                self.store.add_file(b._prev_entry)
                 return b._prev_entry
             else:
                 b._prev_entry = None
@@ -164,18 +280,35 @@ class XMLBuilder(ViewVisitor):
                 writer = get_writer(b)
                 meta: AssetMeta = writer.get_meta(b.data)
                 fe = self.store.get_file(meta.ext, meta.mime)
-                writer.write_file(b.data, fe.file)
-                self.store.add_file(fe)
+                with self._asset_span(type(writer).__name__) as span_args:
+                    cache_key = self.asset_cache.key(b.data, writer, fe) if self.asset_cache else None
+                    cached = bool(cache_key and self.asset_cache.restore(cache_key, fe))
+                    if not cached:
+                        writer.write_file(b.data, fe.file)
+                        fe.freeze()
+                        if cache_key:
+                            self.asset_cache.save(cache_key, fe)
+                    span_args.update(
+                        block=type(b).__name__, mime=fe.mime, raw_size=fe.raw_size, size=fe.size, cached=cached
+                    )
             except DispatchError:
                 raise DPClientError(f"{type(b.data).__name__} not supported for {self.__class__.__name__}")
         elif b.file is not None:
-            fe = self.store.load_file(b.file)
+            with self._asset_span("read_file") as span_args:
+                fe = self.store.read_file(b.file)
+                span_args.update(block=type(b).__name__, mime=fe.mime, raw_size=fe.raw_size, size=fe.size)
         else:
             raise DPClientError("No asset to add")
 
-        b._prev_entry = fe
         return fe
 
+    def _asset_span(self, name: str) -> t.ContextManager[t.Dict[str, t.Any]]:
+        return self.profile.span(name, "asset") if self.profile else nullcontext({})
+
+
+def _is_mpl_plot(b: AssetBlock) -> bool:
+    return opt.HAVE_MATPLOTLIB and isinstance(b, Plot) and isinstance(b.data, (opt.Axes, opt.Figure, opt.ndarray))
+
 
 AssetMeta = namedtuple("AssetMeta", "ext mime")
 
@@ -206,6 +339,7 @@ def get_writer(b: AssetBlock) -> AssetWriterP:
                 a.Table: aw.HTMLTableWriter,
                 a.DataTable: aw.DataTableWriter,
                 a.Attachment: aw.AttachmentWriter,
+                a.VegaDataset: aw.VegaDatasetWriter,
             }
         )
-    return asset_mapping[type(b)]()
+    return asset_mapping[type(b)](**b.writer_options)
@@ -0,0 +1,127 @@
+"""
+Fixtures for benchmarking, in the style of pytest-benchmark, recording both the run time and
+peak memory (as traced by tracemalloc) of each benchmark.
+Results are saved as JSON with `--bench-json`, and compared against those of a previous run with
+`--bench-compare`, failing any benchmark slower or using more memory than the `--bench-threshold` ratio
+(ignoring those too quick or small to measure reliably), e.g.
+
+    pytest tests/benchmarks --bench --bench-rows=10000,1000000 --bench-json=base.json
+    pytest tests/benchmarks --bench --bench-rows=10000,1000000 --bench-compare=base.json
+
+NOTE - memory allocated by arrow's own memory pool isn't traced, only that by python and numpy
+"""
+import gc
+import json
+import platform
+import time
+import tracemalloc
+import typing as t
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+# timings and peak memory below these are too noisy to compare between runs
+MIN_COMPARE_SECS = 0.05
+MIN_COMPARE_BYTES = 1024 * 1024
+
+
+@dataclass
+class BenchResult:
+    rounds: int
+    min: float
+    mean: float
+    # bytes
+    peak_memory: int
+    # any other measurements, e.g. output sizes, as set via `bench.extra_info`
+    extra_info: t.Dict[str, t.Any] = field(default_factory=dict)
+
+
+def pytest_collection_modifyitems(config, items):
+    if not config.getoption("--bench"):
+        skip = pytest.mark.skip(reason="benchmarks only run with --bench")
+        for item in items:
+            if "benchmark" in item.keywords:
+                item.add_marker(skip)
+
+
+def pytest_generate_tests(metafunc):
+    if "rows" in metafunc.fixturenames:
+        rows = [int(r) for r in metafunc.config.getoption("--bench-rows").split(",")]
+        metafunc.parametrize("rows", rows)
+
+
+@pytest.fixture(scope="session")
+def bench_results(request) -> t.Iterator[t.Dict[str, BenchResult]]:
+    results: t.Dict[str, BenchResult] = {}
+    yield results
+
+    fn = request.config.getoption("--bench-json")
+    if fn and results:
+        versions = dict(python=platform.python_version(), pandas=pd.__version__, pyarrow=pa.__version__)
+        out = dict(machine=platform.machine(), versions=versions, benchmarks={k: asdict(v) for k, v in results.items()})
+        Path(fn).write_text(json.dumps(out, indent=2))
+
+
+@pytest.fixture(scope="session")
+def bench_baseline(request) -> t.Dict[str, BenchResult]:
+    fn = request.config.getoption("--bench-compare")
+    if not fn:
+        return {}
+    return {k: BenchResult(**v) for k, v in json.loads(Path(fn).read_text())["benchmarks"].items()}
+
+
+def check_regression(name: str, result: BenchResult, baseline: BenchResult, threshold: float) -> t.List[str]:
+    """
+    The regressions of the result compared to the baseline, i.e. those greater by more than the threshold ratio,
+    and above the minimum duration or memory that can be compared reliably
+    """
+    regressions = []
+    if result.min > max(baseline.min * threshold, MIN_COMPARE_SECS):
+        regressions.append(f"{name} took {result.min:.4f}s vs {baseline.min:.4f}s")
+    if result.peak_memory > max(baseline.peak_memory * threshold, MIN_COMPARE_BYTES):
+        regressions.append(f"{name} used {result.peak_memory:,} bytes vs {baseline.peak_memory:,} bytes")
+    return regressions
+
+
+@pytest.fixture
+def bench(request, bench_results, bench_baseline) -> t.Callable:
+    """
+    Run the function over several rounds, timing each, and then once more tracing its peak memory,
+    returning the result of the last call. Other measurements can be recorded in `bench.extra_info`
+    """
+    rounds: int = request.config.getoption("--bench-rounds")
+    threshold: float = request.config.getoption("--bench-threshold")
+    name = request.node.name
+    extra_info: t.Dict[str, t.Any] = {}
+
+    def _bench(f: t.Callable, *args, **kwargs) -> t.Any:
+        timings = []
+        for _ in range(rounds):
+            gc.collect()
+            start = time.perf_counter()
+            f(*args, **kwargs)
+            timings.append(time.perf_counter() - start)
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            out = f(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        result = bench_results[name] = BenchResult(
+            rounds=rounds, min=min(timings), mean=sum(timings) / rounds, peak_memory=peak, extra_info=extra_info
+        )
+        baseline = bench_baseline.get(name)
+        if baseline is not None:
+            regressions = check_regression(name, result, baseline, threshold)
+            if regressions:
+                pytest.fail("Regression - " + ", ".join(regressions))
+        return out
+
+    _bench.extra_info = extra_info  # type: ignore
+    return _bench
@@ -0,0 +1,93 @@
+"""
+Generators for the dataframes benchmarked, each stressing a different step of processing,
+following `datapane.builtins.gen_table_df` but vectorised with numpy so they scale to millions of rows
+"""
+import typing as t
+
+import numpy as np
+import pandas as pd
+
+# wide frames have many columns, and so fewer rows for the same number of cells
+WIDE_COLUMNS = 200
+WIDE_ROWS_RATIO = 50
+
+
+def _rng() -> np.random.Generator:
+    # seeded, so runs are comparable
+    return np.random.default_rng(0)
+
+
+def _strs(values: np.ndarray, prefix: str = "value_") -> np.ndarray:
+    return np.char.add(prefix, values.astype(str)).astype(object)
+
+
+def gen_narrow(rows: int, alphabet: str = "ABCDEF") -> pd.DataFrame:
+    """Small ints, as per gen_table_df, which are downcast"""
+    return pd.DataFrame({x: _rng().integers(0, 1000, rows) for x in alphabet})
+
+
+def gen_wide(rows: int) -> pd.DataFrame:
+    """Many float and int columns"""
+    rows = max(rows // WIDE_ROWS_RATIO, 1)
+    rng = _rng()
+    data = {f"f{i}": rng.random(rows) for i in range(WIDE_COLUMNS // 2)}
+    data.update({f"i{i}": rng.integers(-(2**40), 2**40, rows) for i in range(WIDE_COLUMNS // 2)})
+    return pd.DataFrame(data)
+
+
+def gen_low_cardinality_strs(rows: int) -> pd.DataFrame:
+    """Object strings with few unique values, which become categories"""
+    rng = _rng()
+    return pd.DataFrame({f"s{i}": _strs(rng.integers(0, 10 ** (i + 1), rows)) for i in range(3)})
+
+
+def gen_high_cardinality_strs(rows: int) -> pd.DataFrame:
+    """Object strings which are mostly unique, so are sampled to rule out categories"""
+    rng = _rng()
+    return pd.DataFrame({f"s{i}": _strs(rng.permutation(rows)) for i in range(3)})
+
+
+def gen_nullable_ints(rows: int) -> pd.DataFrame:
+    """Ints with missing values, both as floats with NaNs and nullable Int64"""
+    rng = _rng()
+    nulls = rng.random(rows) < 0.1
+    floats = np.where(nulls, np.nan, rng.integers(0, 100_000, rows).astype(np.float64))
+    return pd.DataFrame(dict(as_float=floats, as_int64=pd.array(floats, dtype="Int64")))
+
+
+def gen_timedeltas(rows: int) -> pd.DataFrame:
+    """Timedeltas, which are formatted as strings"""
+    rng = _rng()
+    td = pd.to_timedelta(rng.integers(0, 10**6, rows), unit="s")
+    return pd.DataFrame(dict(td=td, td_null=td.where(rng.random(rows) > 0.1)))
+
+
+def gen_multi_index(rows: int) -> pd.DataFrame:
+    """Hierarchical columns and index, which are flattened and reset"""
+    rng = _rng()
+    index = pd.MultiIndex.from_arrays([np.arange(rows) // 100, np.arange(rows) % 100], names=["outer", "inner"])
+    columns = pd.MultiIndex.from_product([["a", "b"], ["x", "y"]])
+    return pd.DataFrame(rng.random((rows, len(columns))), index=index, columns=columns)
+
+
+def gen_categorical(rows: int) -> pd.DataFrame:
+    """Existing categoricals, with both object and int categories"""
+    rng = _rng()
+    return pd.DataFrame(
+        dict(
+            cat_str=pd.Categorical.from_codes(rng.integers(0, 50, rows), categories=_strs(np.arange(50), "cat_")),
+            cat_int=pd.Categorical.from_codes(rng.integers(0, 50, rows), categories=np.arange(50) * 10),
+        )
+    )
+
+
+FRAMES: t.Dict[str, t.Callable[[int], pd.DataFrame]] = dict(
+    narrow=gen_narrow,
+    wide=gen_wide,
+    low_cardinality_strs=gen_low_cardinality_strs,
+    high_cardinality_strs=gen_high_cardinality_strs,
+    nullable_ints=gen_nullable_ints,
+    timedeltas=gen_timedeltas,
+    multi_index=gen_multi_index,
+    categorical=gen_categorical,
+)
@@ -0,0 +1,59 @@
+"""Benchmarks of processing and writing dataframes as arrow assets, for each of the frames generated"""
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from datapane.common import ArrowFormat
+from datapane.common.df_processor import process_df
+from datapane.view.asset_writers import DataTableWriter
+
+from .conftest import MIN_COMPARE_BYTES, MIN_COMPARE_SECS, BenchResult, check_regression
+from .frames import FRAMES
+
+frames = pytest.mark.parametrize("frame", list(FRAMES))
+
+
+@pytest.mark.benchmark
+@frames
+def test_process_df(bench, frame: str, rows: int):
+    df = FRAMES[frame](rows)
+    out: pd.DataFrame = bench(process_df, df, copy=True)
+    assert len(out) == len(df)
+
+
+@pytest.mark.benchmark
+@frames
+def test_save_file(bench, tmp_path: Path, frame: str, rows: int):
+    df = FRAMES[frame](rows)
+    fn = str(tmp_path / "df.arrow")
+    bench(ArrowFormat.save_file, fn, df)
+    assert ArrowFormat.load_table(fn).num_rows == len(df)
+
+
+@pytest.mark.benchmark
+@frames
+def test_datatable_writer(bench, tmp_path: Path, frame: str, rows: int):
+    df = FRAMES[frame](rows)
+    fn = tmp_path / "df.arrow"
+
+    def _write():
+        with fn.open("wb") as f:
+            DataTableWriter().write_file(df, f)
+
+    bench(_write)
+    assert ArrowFormat.load_table(fn).num_rows == len(df)
+
+
+def test_check_regression():
+    mb = MIN_COMPARE_BYTES
+    baseline = BenchResult(rounds=3, min=1.0, mean=1.1, peak_memory=10 * mb)
+    assert check_regression("a", BenchResult(rounds=3, min=1.2, mean=2.0, peak_memory=12 * mb), baseline, 1.25) == []
+    regressions = check_regression("a", BenchResult(rounds=3, min=1.3, mean=1.3, peak_memory=20 * mb), baseline, 1.25)
+    assert len(regressions) == 2
+
+    # very quick or small benchmarks aren't compared, as they're dominated by noise
+    baseline = BenchResult(rounds=3, min=0.001, mean=0.001, peak_memory=1000)
+    assert check_regression("a", BenchResult(rounds=3, min=0.01, mean=0.01, peak_memory=10_000), baseline, 1.25) == []
+    result = BenchResult(rounds=3, min=MIN_COMPARE_SECS * 2, mean=1.0, peak_memory=2 * mb)
+    assert len(check_regression("a", result, baseline, 1.25)) == 2
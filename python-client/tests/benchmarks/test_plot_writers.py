@@ -0,0 +1,34 @@
+"""Benchmarks of writing plots with many points, compared to previous implementations"""
+import json
+from io import BytesIO
+
+import numpy as np
+import plotly.graph_objects as p_go
+import pytest
+
+from datapane.view.asset_writers import DPTextIOWrapper, PlotWriter
+
+
+def _write_plotly_legacy(fig: p_go.Figure, f) -> None:
+    # the figure JSON, encoded again as a JSON string
+    json.dump(fig.to_json(), DPTextIOWrapper(f))
+
+
+def _write_plotly(fig: p_go.Figure, f) -> None:
+    PlotWriter().write_file(fig, f)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("writer", [_write_plotly_legacy, _write_plotly], ids=["legacy", "compact"])
+def test_plotly_writer(bench, writer, rows: int):
+    rng = np.random.default_rng(0)
+    fig = p_go.Figure(p_go.Scattergl(x=np.arange(rows), y=rng.random(rows), mode="markers"))
+
+    def _write() -> bytes:
+        f = BytesIO()
+        writer(fig, f)
+        return f.getvalue()
+
+    out = bench(_write)
+    bench.extra_info["size"] = len(out)
+    assert json.loads(out)
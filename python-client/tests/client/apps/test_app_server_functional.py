@@ -1,11 +1,18 @@
+import base64
 import dataclasses as dc
+import io
 import json
 import random
+import shutil
 import typing as t
 from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
 
 import dacite
+import pandas as pd
+import pyarrow as pa
+import pytest
 from lxml import etree
 from webtest import TestApp, TestResponse
 
@@ -13,9 +20,12 @@ import datapane as dp
 from datapane.app import server
 from datapane.app.json_rpc import RpcError, RpcRequest, RpcResponse
 from datapane.app.plugins import DPBottlePlugin
+from datapane.app.table_query import TableCache
 from datapane.builtins import gen_df, gen_plot
+from datapane.common import ArrowFormat
 from datapane.common.dp_types import URL, SDict
 from datapane.common.viewxml_utils import ElementT
+from datapane.processors.codecs import CODECS, BrotliCodec, GzipCodec, IdentityCodec, negotiate
 
 from .test_function_views import mk_controls  # noqa: Importing a fixture
 
@@ -64,8 +74,8 @@ def mk_rpc_req(f_name: str, **kwargs) -> RpcRequest:
     return RpcRequest(jsonrpc="2.0", id=random.randint(1, 1000), method=f_name, params=kwargs.copy())
 
 
-def call_rpc(app: TestApp, f_name: str, **kwargs) -> ViewXMLDTO:
-    """Make a synthetic json-rpc request/response call to the app server"""
+def call_rpc_raw(app: TestApp, f_name: str, **kwargs) -> t.Dict:
+    """Make a synthetic json-rpc request/response call to the app server, returning the result"""
     rpc_req = mk_rpc_req(f_name, **kwargs)
     http_res: TestResponse = app.post_json("/app-rpc-call/", rpc_req.dict())
 
@@ -76,7 +86,7 @@ def call_rpc(app: TestApp, f_name: str, **kwargs) -> ViewXMLDTO:
     if "result" in http_res_dict:
         rpc_res = RpcResponse(**http_res_dict)
         assert rpc_req.id == rpc_res.id
-        return dacite.from_dict(ViewXMLDTO, rpc_res.result)
+        return rpc_res.result
     elif "error" in http_res_dict:
         rpc_res = RpcError(**http_res_dict)
         if rpc_res.id:
@@ -86,6 +96,11 @@ def call_rpc(app: TestApp, f_name: str, **kwargs) -> ViewXMLDTO:
         raise AssertionError(f"Unknown response - {http_res_dict}")
 
 
+def call_rpc(app: TestApp, f_name: str, **kwargs) -> ViewXMLDTO:
+    """Make a synthetic json-rpc request/response call to the app server"""
+    return dacite.from_dict(ViewXMLDTO, call_rpc_raw(app, f_name, **kwargs))
+
+
 def bootup_app(app: TestApp, dp_plugin: DPBottlePlugin, *, expected_assets: int = 0) -> ViewXMLDTO:
     """Boot up the app and assert that app.main has been called successfully"""
     # get the initial chrome
@@ -152,6 +167,156 @@ def test_assets():
             assert _res.content_type == asset.mime
 
 
+@pytest.mark.parametrize("read_only", [True, False])
+def test_linked_file_assets(tmp_path: Path, read_only: bool):
+    """Test read-only file assets are linked into the app, and others copied, and served as-is"""
+    fn = tmp_path / "icon.png"
+    shutil.copyfile(Path(__file__).parent.parent / "views" / "test_views" / "datapane-icon-192x192.png", fn)
+    if read_only:
+        fn.chmod(0o444)
+    view = dp.Blocks(dp.Media(file=fn), dp.Attachment(file=fn), gen_df())
+
+    with mk_app(view) as (app, dp_plugin):
+        # identical files are only linked once
+        main_res = bootup_app(app, dp_plugin, expected_assets=2)
+        asset = next(a for a in main_res.assets.values() if a.mime == "image/png")
+        assert asset.size == fn.stat().st_size
+
+        linked_fn = dp_plugin.g_s.app_dir / asset.src.lstrip("/")
+        assert linked_fn.samefile(fn) == read_only
+        _res: TestResponse = app.get(asset.src)
+        assert _res.status_int == 200
+        assert "Content-Encoding" not in _res.headers
+        assert _res.body == fn.read_bytes()
+
+
+@pytest.mark.parametrize("encoding", list(CODECS))
+def test_asset_codecs(monkeypatch, encoding: str):
+    """Test assets are stored using the configured codec, and decoded for clients that don't accept it"""
+    monkeypatch.setenv("DATAPANE_ASSET_CODEC", encoding)
+    df = gen_df()
+    view = dp.Blocks(dp.DataTable(df))
+
+    with mk_app(view) as (app, dp_plugin):
+        main_res = bootup_app(app, dp_plugin, expected_assets=1)
+        asset = next(iter(main_res.assets.values()))
+        stored_fn = dp_plugin.g_s.app_dir / f"{asset.src.lstrip('/')}{CODECS[encoding].suffix}"
+        assert stored_fn.is_file()
+
+        _res: TestResponse = app.get(asset.src, headers={"Accept-Encoding": "identity"})
+        assert _res.status_int == 200
+        assert _res.content_type == asset.mime
+        pd.testing.assert_frame_equal(ArrowFormat.load_file(io.BytesIO(_res.body)), df, check_dtype=False)
+
+
+def test_table_cache():
+    """Test the tables cached are bounded by number, and by size if decoded into memory"""
+    cache = TableCache(max_tables=3, max_decoded_size=10_000)
+    table = pa.table(dict(x=range(1000)))
+    assert table.nbytes == 8000
+    cache.add("a", table, decoded=False)
+    cache.add("b", table, decoded=True)
+    # only a single decoded table fits
+    cache.add("c", table, decoded=True)
+    assert ("a" in cache, "b" in cache, "c" in cache) == (True, False, True)
+    # as do memory-mapped tables, up to the max number
+    assert cache.get("a") is table
+    cache.add("d", table, decoded=False)
+    cache.add("e", table, decoded=False)
+    assert ("a" in cache, "c" in cache, cache.decoded_size) == (True, False, 0)
+    # decoded tables too large to cache aren't kept
+    cache.add("f", pa.table(dict(x=range(2000))), decoded=True)
+    assert "f" not in cache and len(cache) == 3
+
+
+@pytest.mark.parametrize("encoding", ["identity", "gzip"])
+def test_datatable_query(monkeypatch, encoding: str):
+    """Test paging through a DataTable asset, with sorting, filtering and searching applied on the server"""
+    monkeypatch.setenv("DATAPANE_ASSET_CODEC", encoding)
+    df = pd.DataFrame(dict(x=range(100), y=[f"val_{i % 10}" for i in range(100)], z=pd.Categorical(["a", "b"] * 50)))
+    view = dp.Blocks(dp.DataTable(df))
+
+    decodes = []
+    decode = GzipCodec.decode
+
+    def _decode(self, f, *a, **kw):
+        decodes.append(f.name)
+        return decode(self, f, *a, **kw)
+
+    monkeypatch.setattr(GzipCodec, "decode", _decode)
+
+    def query(**params) -> t.Tuple[t.Dict, pd.DataFrame]:
+        res = call_rpc_raw(app, "datatable.query", asset=asset.hash, **params)
+        page = pa.ipc.open_stream(base64.b64decode(res["data"])).read_pandas()
+        return res, page
+
+    with mk_app(view) as (app, dp_plugin):
+        main_res = bootup_app(app, dp_plugin, expected_assets=1)
+        asset = next(iter(main_res.assets.values()))
+
+        res, page = query(offset=10, limit=20)
+        assert (res["total_rows"], res["rows"], res["offset"]) == (100, 100, 10)
+        assert list(page["x"]) == list(range(10, 30))
+
+        res, page = query(sort=[dict(column="y", descending=True), dict(column="x")], limit=5)
+        assert list(page["x"]) == [9, 19, 29, 39, 49]
+
+        res, page = query(filters=[dict(column="x", op="ge", value=50), dict(column="z", value="b")])
+        assert res["rows"] == 25
+        assert list(page["x"]) == list(range(51, 100, 2))
+
+        res, page = query(search="VAL_3", offset=5)
+        assert res["rows"] == 10
+        assert list(page["x"]) == [53, 63, 73, 83, 93]
+
+        res, page = query(filters=[dict(column="y", op="begins", value="VAL_1"), dict(column="x", op="lt", value=50)])
+        assert list(page["x"]) == [1, 11, 21, 31, 41]
+        res, page = query(filters=[dict(column="y", op="not_contains", value="_1")])
+        assert res["rows"] == 90
+
+        # assets with a content-coding are only decoded once, into a memory-mapped variant, even if evicted
+        dp_plugin.g_s.table_cache.clear()
+        query(offset=50)
+        assert len(decodes) == (0 if encoding == "identity" else 1)
+        assert (dp_plugin.g_s.app_dir / asset.src.lstrip("/")).is_file()
+
+        # unknown assets and invalid queries
+        for params in [dict(asset="unknown"), dict(asset=asset.hash, limit=0)]:
+            with pytest.raises(AssertionError, match="-32602"):
+                call_rpc_raw(app, "datatable.query", **params)
+        with pytest.raises(AssertionError, match="-32602"):
+            query(filters=[dict(column="missing", value=1)])
+        with pytest.raises(AssertionError, match="-32602"):
+            query(filters=[dict(column="y", op="contains")])
+
+
+def test_datatable_preview():
+    """Test the full dataset of a previewed DataTable is served as a separate asset, and can be queried"""
+    df = gen_df(1000)
+    view = dp.Blocks(dp.DataTable(df, preview_rows=10))
+
+    with mk_app(view) as (app, dp_plugin):
+        main_res = bootup_app(app, dp_plugin, expected_assets=2)
+        e = main_res.root.find("./DataTable")
+        preview, full = (main_res.assets[e.get(a).split("://")[1]] for a in ("src", "full_src"))
+        for asset, n_rows in [(preview, 10), (full, 1000)]:
+            _res: TestResponse = app.get(asset.src)
+            assert len(ArrowFormat.load_file(io.BytesIO(_res.body))) == n_rows
+
+        res = call_rpc_raw(app, "datatable.query", asset=full.hash, offset=990)
+        assert (res["rows"], res["offset"]) == (1000, 990)
+
+
+def test_negotiate_encoding():
+    available = [BrotliCodec, GzipCodec, IdentityCodec]
+    assert negotiate("gzip, deflate, br", available) is BrotliCodec
+    assert negotiate("gzip, br;q=0.5", available) is GzipCodec
+    assert negotiate("deflate", available) is IdentityCodec
+    assert negotiate(None, available) is IdentityCodec
+    assert negotiate("*", [GzipCodec]) is GzipCodec
+    assert negotiate("br, identity;q=0", [GzipCodec, IdentityCodec]) is None
+
+
 def test_functions():
     """Test calling a simple view with a single function"""
 
@@ -1,3 +1,5 @@
+import base64
+import json
 from io import BytesIO
 
 import altair as alt
@@ -68,6 +70,22 @@ def test_save_plotly():
     writer: AssetWriterP = aw.PlotWriter()
     writer.write_file(fig, BytesIO())
 
+    # written as the figure JSON directly, with large arrays as base64 typed arrays
+    n = aw.PLOTLY_BDATA_MIN_SIZE
+    x, y, z = np.arange(n, dtype=np.int64), np.random.rand(n).astype(">f4"), np.random.rand(n, 2)
+    fig.add_trace(p_go.Scatter(x=x, y=y, text=x.astype(str)))
+    fig.add_trace(p_go.Heatmap(z=z))
+    f = BytesIO()
+    writer.write_file(fig, f)
+    out = json.loads(f.getvalue())
+    assert out["data"][0]["x"] == [0, 1, 2, 3, 4, 5]
+    (out_x, out_y, out_z) = (out["data"][1]["x"], out["data"][1]["y"], out["data"][2]["z"])
+    assert (out_x["dtype"], out_y["dtype"], out_z["dtype"], out_z["shape"]) == ("i4", "f4", "f8", f"{n}, 2")
+    assert np.array_equal(np.frombuffer(base64.b64decode(out_x["bdata"]), "<i4"), x)
+    assert np.array_equal(np.frombuffer(base64.b64decode(out_y["bdata"]), "<f4"), y)
+    assert np.array_equal(np.frombuffer(base64.b64decode(out_z["bdata"]), "<f8").reshape(n, 2), z)
+    assert out["data"][1]["text"] == list(x.astype(str))
+
 
 # NOTE - test disabled until pip release of altair_pandas - however should work if altair test passes
 @pytest.mark.skip(reason="altair_pandas not yet supported")
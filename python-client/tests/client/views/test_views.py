@@ -1,22 +1,41 @@
 """Tests for the API that can run locally (due to design or mocked out)"""
+import base64
+import hashlib
+import json
 import os
+import threading
+import tracemalloc
 import typing as t
 from pathlib import Path
 
+import altair as alt
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import pytest
 from dominate.tags import h2
 from glom import glom
 from lxml.etree import DocumentInvalid
 
 import datapane as dp
+from datapane import optional_libs as opt
 from datapane.blocks import BaseBlock
+from datapane.blocks import asset as asset_blocks
 from datapane.builtins import gen_df, gen_plot
 from datapane.client.exceptions import DPClientError
 from datapane.common.viewxml_utils import load_doc, validate_view_doc
-from datapane.processors import AppTransformations, ConvertXML, Pipeline, PreProcessView, ViewState
-from datapane.processors.file_store import B64FileEntry
+from datapane.processors import AppTransformations, ConvertXML, Pipeline, PreProcessView, Profile, ViewState
+from datapane.processors.asset_cache import AssetCache
+from datapane.processors.codecs import GzipCodec
+from datapane.processors.file_store import B64FileEntry, FileEntry, GzipTmpFileEntry
 from datapane.processors.types import mk_null_pipe
+from datapane.view import XMLBuilder
+from datapane.view.asset_writers import (
+    ALTAIR_SHARED_MIN_ROWS,
+    MPL_RASTER_THRESHOLD,
+    DataTableWriter,
+    altair_dataset_name,
+)
 
 ################################################################################
 # Helpers
@@ -35,16 +54,21 @@ def num_blocks(view_str: str) -> int:
     return int(load_doc(view_str).xpath(x))
 
 
-def _view_to_xml_and_files(app_or_view: t.Union[dp.Blocks, dp.App]) -> ViewState:
-    """Create a viewstate resulting from converting the View to XML & in-mem B64 files"""
-    s = ViewState(blocks=app_or_view, file_entry_klass=B64FileEntry)
+def _view_to_xml_and_files(
+    app_or_view: t.Union[dp.Blocks, dp.App], fw_klass: t.Type[FileEntry] = B64FileEntry
+) -> ViewState:
+    """Create a viewstate resulting from converting the View to XML & files, by default in-mem B64 files"""
+    s = ViewState(blocks=app_or_view, file_entry_klass=fw_klass)
     return Pipeline(s).pipe(PreProcessView()).pipe(AppTransformations()).pipe(ConvertXML()).state
 
 
 def assert_view(
-    view: t.Union[dp.App, dp.Blocks], expected_attachments: int = None, expected_num_blocks: int = None
+    view: t.Union[dp.App, dp.Blocks],
+    expected_attachments: int = None,
+    expected_num_blocks: int = None,
+    fw_klass: t.Type[FileEntry] = B64FileEntry,
 ) -> t.Tuple[str, t.List[t.BinaryIO]]:
-    state = _view_to_xml_and_files(view)
+    state = _view_to_xml_and_files(view, fw_klass)
     view_xml = state.view_xml
     attachments = state.store.file_list
     if expected_attachments:
@@ -305,6 +329,232 @@ def test_gen_view_with_function(datadir: Path):
     assert_view(view, 5, 28)
 
 
+@pytest.mark.parametrize("fw_klass", [B64FileEntry, GzipTmpFileEntry])
+def test_gen_view_dedups_assets(fw_klass: t.Type[FileEntry]):
+    # identical assets are only stored once, but referenced by every block
+    df = gen_df(100)
+    view = dp.Blocks(
+        dp.Select(dp.DataTable(df, label="a"), dp.DataTable(df, label="b"), dp.Plot(gen_plot(), label="c")),
+        dp.DataTable(df.copy()),
+    )
+    (view_xml, attachments) = assert_view(view, 2, fw_klass=fw_klass)
+    srcs = load_doc(view_xml).xpath("/View//DataTable/@src")
+    assert len(srcs) == 3 and len(set(srcs)) == 1
+
+
+@pytest.mark.parametrize("max_workers", [None, 4])
+def test_gen_view_altair_datasets(max_workers: t.Optional[int]):
+    # large frames are stored once as shared datasets, referenced by name from each plot using them
+    df1, df2 = gen_df(ALTAIR_SHARED_MIN_ROWS), gen_df(ALTAIR_SHARED_MIN_ROWS + 1)
+    view = dp.Blocks(
+        alt.Chart(df1).mark_line().encode(x="x", y="y"),
+        alt.Chart(df1.copy()).mark_point().encode(x="x", y="y"),
+        alt.layer(alt.Chart(df2).mark_line().encode(x="x", y="y"), alt.Chart(df1).mark_rule().encode(y="mean(y)")),
+        gen_plot(),
+    )
+    s = ViewState(blocks=view, file_entry_klass=B64FileEntry)
+    s = Pipeline(s).pipe(PreProcessView()).pipe(ConvertXML(max_workers=max_workers)).state
+    assert validate_view_doc(xml_str=s.view_xml)
+    # 4 specs and 2 datasets
+    assert len(s.store.files) == 6
+    (line, point, layer, small) = load_doc(s.view_xml).xpath("/View/Plot")
+    assert line.get("datasets") == point.get("datasets")
+    layer_datasets = layer.get("datasets").split()
+    assert len(layer_datasets) == 2 and layer_datasets[1] == line.get("datasets")
+    assert small.get("datasets") is None
+
+    def _read(ref: str) -> t.Any:
+        fe = s.store.files[ref.split("://")[1]]
+        fe.wrapped.seek(0)
+        return json.loads(base64.b64decode(fe.wrapped.read()))
+
+    assert _read(layer_datasets[0])["name"] == altair_dataset_name(df2)
+
+    spec = _read(line.get("src"))
+    dataset = _read(line.get("datasets"))
+    assert "datasets" not in spec and spec["data"] == {"name": dataset["name"]}
+    assert dataset["name"] == altair_dataset_name(df1)
+    assert dataset["values"] == df1.to_dict(orient="records")
+    # small frames are kept inline
+    assert "datasets" in _read(small.get("src"))
+
+
+def test_gen_view_arrow_tables():
+    # arrow tables and readers are stored directly, and auto-wrapped as DataTables
+    table = pa.Table.from_pandas(gen_df(100))
+    reader = pa.RecordBatchReader.from_batches(table.schema, table.to_batches(10))
+    view = dp.Blocks(dp.DataTable(reader), table)
+    (view_xml, attachments) = assert_view(view, 1)
+    assert load_doc(view_xml).xpath("/View/DataTable/@rows") == ["100"] * 2
+
+    with pytest.raises(DPClientError):
+        _view_to_xml_and_files(dp.Blocks(dp.DataTable(pa.table(dict(a=pa.array([], pa.int64()))))))
+
+
+def test_gen_view_datatable_preview(monkeypatch):
+    # only a preview is embedded, with the full dataset stored as a separate asset (shared with other blocks)
+    df = gen_df(1000)
+    # and the full dataset is the same snapshot of the frame, rather than another copy
+    snapshots = []
+
+    def _to_df(x: pd.DataFrame) -> pd.DataFrame:
+        snapshots.append(x.copy())
+        return snapshots[-1]
+
+    monkeypatch.setattr(asset_blocks, "to_df", _to_df)
+    assert dp.DataTable(df, preview_rows=10).full.data is snapshots[-1] and len(snapshots) == 1
+    view = dp.Blocks(dp.DataTable(df, preview_rows=10), dp.DataTable(df), dp.DataTable(df, preview_rows=1000))
+    (view_xml, attachments) = assert_view(view, 2)
+    (preview, full, small) = load_doc(view_xml).xpath("/View/DataTable")
+    assert (preview.get("rows"), preview.get("preview_rows")) == ("1000", "10")
+    assert preview.get("full_src") == full.get("src") == small.get("src") != preview.get("src")
+    assert [c["name"] for c in json.loads(preview.get("summary"))] == list(df.columns)
+    assert small.get("full_src") is None
+
+    with pytest.raises(DPClientError):
+        dp.DataTable(df, preview_rows=0)
+
+
+def test_gen_view_mpl_formats(monkeypatch):
+    # dense matplotlib plots are saved as images rather than svgs, unless set otherwise
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3])
+    dense_fig, dense_ax = plt.subplots()
+    dense_ax.scatter(np.arange(MPL_RASTER_THRESHOLD + 1), np.arange(MPL_RASTER_THRESHOLD + 1))
+    view = dp.Blocks(dp.Plot(fig), dense_ax, dp.Plot(dense_fig, format="svg"), dp.Plot(fig, format="webp", dpi=50))
+    (view_xml, attachments) = assert_view(view, 4)
+    assert load_doc(view_xml).xpath("/View/Plot/@type") == ["image/svg+xml", "image/png", "image/svg+xml", "image/webp"]
+    plt.close("all")
+
+    with pytest.raises(DPClientError):
+        dp.Plot(fig, format="jpg")
+    # webp images need matplotlib 3.6+
+    monkeypatch.setattr(opt, "HAVE_MATPLOTLIB_WEBP", False)
+    with pytest.raises(DPClientError, match="webp"):
+        dp.Plot(fig, format="webp")
+
+
+@pytest.mark.parametrize("fw_klass", [B64FileEntry, GzipTmpFileEntry])
+def test_file_entry_hash(fw_klass):
+    # entries are hashed as they're written, matching the hash of their frozen contents
+    def _write_entry() -> FileEntry:
+        fe = fw_klass(ext=".arrow")
+        DataTableWriter().write_file(gen_df(1000), fe.file)
+        fe.freeze()
+        return fe
+
+    fe = _write_entry()
+    fe.wrapped.seek(0)
+    contents = fe.wrapped.read()
+    assert fe.hash == hashlib.sha256(contents).hexdigest()[:10]
+    assert fe.size == len(contents)
+    # and identical contents have identical hashes
+    assert _write_entry().hash == fe.hash
+
+
+def test_gzip_header_deterministic(tmp_path: Path):
+    # the gzip header holds neither the name of the (temporary) file written to, nor the time
+    def _encode(name: str) -> bytes:
+        with (tmp_path / name).open("w+b") as f:
+            with GzipCodec().writer(f) as w:
+                w.write(b"abc" * 100)
+            f.seek(0)
+            return f.read()
+
+    assert _encode("dp-a.arrow") == _encode("dp-b.arrow")
+
+
+@pytest.mark.parametrize("fw_klass", [B64FileEntry, GzipTmpFileEntry])
+def test_gen_view_asset_cache(tmp_path: Path, monkeypatch, fw_klass):
+    # unchanged objects reuse the cached serialised asset across runs
+    cache = AssetCache(cache_dir=tmp_path / "cache")
+
+    def _convert() -> ViewState:
+        view = dp.Blocks(dp.DataTable(gen_df(100)), dp.Plot(gen_plot()), dp.Table(gen_df()))
+        s = ViewState(blocks=view, file_entry_klass=fw_klass)
+        pipe = Pipeline(s).pipe(PreProcessView())
+        builder = XMLBuilder(store=pipe.state.store, asset_cache=cache)
+        pipe.state.blocks.accept(builder)
+        builder.get_root()
+        return pipe.state
+
+    s1 = _convert()
+    assert (cache.stats.hits, cache.stats.misses) == (0, 3)
+    s2 = _convert()
+    assert (cache.stats.hits, cache.stats.misses) == (3, 3)
+    assert [f.size for f in s1.store.files.values()] == [f.size for f in s2.store.files.values()]
+    assert list(s1.store.files) == list(s2.store.files)
+
+    # the DataTable is written again once float downcasting is enabled
+    monkeypatch.setenv("DATAPANE_DOWNCAST_FLOATS", "exact")
+    _convert()
+    assert (cache.stats.hits, cache.stats.misses) == (5, 4)
+
+    # entries are evicted once over the max size
+    cache.max_size = 0
+    cache.evict()
+    assert not list((tmp_path / "cache").iterdir())
+
+
+def test_gen_view_asset_cache_altair(tmp_path: Path):
+    # charts are fingerprinted by their spec with named datasets, so those over altair's inline max_rows are cached
+    cache = AssetCache(cache_dir=tmp_path / "cache")
+    df = pd.DataFrame(dict(x=np.arange(6000), y=np.arange(6000) % 7))
+
+    def _convert():
+        view = dp.Blocks(dp.Plot(alt.Chart(df).mark_point().encode(x="x", y="y")))
+        s = ViewState(blocks=view, file_entry_klass=B64FileEntry)
+        pipe = Pipeline(s).pipe(PreProcessView())
+        with XMLBuilder(store=pipe.state.store, asset_cache=cache) as builder:
+            pipe.state.blocks.accept(builder)
+            builder.get_root()
+
+    _convert()
+    assert (cache.stats.hits, cache.stats.misses) == (0, 2)
+    _convert()
+    # both the spec and its dataset
+    assert (cache.stats.hits, cache.stats.misses) == (2, 2)
+
+
+def test_gen_view_parallel_assets(datadir: Path):
+    # concurrent asset writes produce the same, deterministic, document and asset order
+    def _convert(max_workers: t.Optional[int]) -> ViewState:
+        view = gen_view_complex_with_files(datadir)
+        s = ViewState(blocks=view, file_entry_klass=B64FileEntry)
+        return Pipeline(s).pipe(PreProcessView()).pipe(ConvertXML(max_workers=max_workers)).state
+
+    s1 = _convert(None)
+    s2 = _convert(4)
+    assert s1.view_xml == s2.view_xml
+    assert list(s1.store.files) == list(s2.store.files)
+
+
+def test_gen_view_parallel_error(monkeypatch):
+    # matplotlib plots are saved on the calling thread, and the pool is shut down if the walk fails
+    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+
+    save_threads = []
+
+    def _savefig(*a, **kw):
+        save_threads.append(threading.current_thread())
+        raise ValueError("savefig failed")
+
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3])
+    monkeypatch.setattr(Figure, "savefig", _savefig)
+    view = dp.Blocks(*[dp.DataTable(gen_df(1000)) for _ in range(4)], dp.Plot(fig))
+    s = ViewState(blocks=view, file_entry_klass=B64FileEntry)
+    with pytest.raises(ValueError):
+        Pipeline(s).pipe(PreProcessView()).pipe(ConvertXML(max_workers=4))
+    plt.close("all")
+
+    assert save_threads == [threading.main_thread()]
+    assert not [th for th in threading.enumerate() if th.name.startswith("dp-asset-writer")]
+
+
 ################################################################################
 # Local saving
 @pytest.mark.skipif("CI" in os.environ, reason="Currently depends on building fe-components first")
@@ -319,3 +569,77 @@ def test_save_report_with_files(datadir: Path, monkeypatch):  # noqa: ANN
     monkeypatch.chdir(datadir)
     view = gen_view_complex_with_files(datadir, local_report=True)
     dp.save_report(view, path="test_out.html", name="Even better report")
+
+
+@pytest.mark.skipif("CI" in os.environ, reason="Currently depends on building fe-components first")
+def test_save_report_streams_assets(datadir: Path, monkeypatch):  # noqa: ANN
+    monkeypatch.chdir(datadir)
+    # spill all but the smallest assets to disk
+    monkeypatch.setattr(B64FileEntry, "spool_size", 1024)
+    view = dp.Blocks(dp.Plot(gen_plot()), dp.Media(file=datadir / "datapane-icon-192x192.png"))
+    dp.save_report(view, path="test_out.html", name="Streamed report")
+    html = (datadir / "test_out.html").read_text()
+
+    # asset payloads are written as separate elements, rather than as json-encoded data-uris
+    state = _view_to_xml_and_files(view)
+    assert any(fe.size > B64FileEntry.spool_size for fe in state.store.files.values())
+    for h, fe in state.store.files.items():
+        assert f'data-hash="{h}">{fe.contents.decode()}</script>' in html
+    assert "data:image/png;base64" not in html
+
+
+@pytest.mark.skipif("CI" in os.environ, reason="Currently depends on building fe-components first")
+def test_save_report_profile(datadir: Path, monkeypatch):  # noqa: ANN
+    monkeypatch.chdir(datadir)
+    trace_path = datadir / "trace.json"
+    monkeypatch.setenv("DATAPANE_PROFILE_TRACE", str(trace_path))
+    profile = Profile(trace_memory=True)
+    dp.save_report(dp.Blocks(dp.DataTable(gen_df(100)), dp.Plot(gen_plot())), path="test_out.html", profile=profile)
+    assert not tracemalloc.is_tracing()
+
+    processors = [s for s in profile.spans if s.cat == "processor"]
+    assert [s.name for s in processors] == ["PreProcessView", "ConvertXML", "ExportHTMLInlineAssets"]
+    assert all(s.wall > 0 and s.mem_peak > 0 for s in processors)
+    assets = {s.name: s for s in profile.spans if s.cat == "asset"}
+    assert set(assets) == {"DataTableWriter", "PlotWriter"}
+    assert all(s.args["raw_size"] > 0 and s.args["size"] > 0 for s in assets.values())
+
+    trace = json.loads(trace_path.read_text())
+    assert len(trace["traceEvents"]) == len(profile.spans)
+
+
+def test_profile_error(monkeypatch):
+    # memory tracing is opt-in, and is stopped even if the pipeline fails
+    Profile()
+    assert not tracemalloc.is_tracing()
+    profile = Profile(trace_memory=True)
+    assert tracemalloc.is_tracing()
+
+    def _fail(*args):
+        raise ValueError("Unwritable")
+
+    monkeypatch.setattr(DataTableWriter, "write_file", _fail)
+    with pytest.raises(ValueError, match="Unwritable"):
+        dp.stringify_report(dp.Blocks(dp.DataTable(gen_df(10))), profile=profile)
+    assert not tracemalloc.is_tracing()
+    assert [s.name for s in profile.spans if s.cat == "processor"] == ["PreProcessView", "ConvertXML"]
+
+
+@pytest.mark.skipif("CI" in os.environ, reason="Currently depends on building fe-components first")
+def test_build_report_incremental(tmp_path: Path):
+    def _build(*blocks) -> t.Dict[str, str]:
+        dp.build_report(dp.Blocks("Report", *blocks), name="app", dest=tmp_path, incremental=True)
+        return json.loads((app_dir / "manifest.json").read_text())["assets"]
+
+    app_dir = tmp_path / "app"
+    df = gen_df(100)
+    assets_1 = _build(dp.DataTable(df), dp.Plot(gen_plot()))
+    assert len(assets_1) == 2
+    stats_1 = {fn: (app_dir / "assets" / fn).stat() for fn in assets_1.values()}
+
+    # unchanged assets are left untouched, removed ones are pruned
+    assets_2 = _build(dp.DataTable(df), dp.DataTable(gen_df(10)))
+    (h,) = assets_1.keys() & assets_2.keys()
+    fn = assets_2[h]
+    assert (app_dir / "assets" / fn).stat().st_mtime_ns == stats_1[fn].st_mtime_ns
+    assert sorted(p.name for p in (app_dir / "assets").iterdir()) == sorted(assets_2.values())
@@ -1,3 +1,4 @@
+import io
 import sys
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -6,21 +7,38 @@ from typing import Optional
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pytest
 import vega_datasets as vd
 
+import datapane as dp
 from datapane.common import ArrowFormat, SList, log
+from datapane.common.datafiles import CSVFormat, downcast_tolerance
 from datapane.common.df_processor import (
     PD_1_3_GREATER,
     PD_VERSION,
     PD_1_1_x,
     PD_1_2_x,
+    _mk_plan,
+    category_criteria,
     convert_axis,
+    cow_enabled,
+    downcast_floats,
     downcast_numbers,
+    float32_safe,
+    is_category_candidate,
+    may_be_category,
     obj_to_str,
     parse_categories,
     process_df,
+    process_table,
+    str_to_arrow_str,
+    summarise_columns,
     timedelta_to_str,
+    to_df,
+    truncate_dataframe,
 )
+from datapane.view.asset_writers import DataTableWriter
 
 
 def _check_categories_parsed(df: pd.DataFrame, categorical_columns: SList):
@@ -109,6 +127,33 @@ def test_parse_categories_roundtrip(tmp_path: Path):
     pd.testing.assert_frame_equal(df1, df2)
 
 
+def test_parse_categories_sampled():
+    """Sampling large columns rules out high-cardinality ones, with the same decisions as checking exactly"""
+    n = 200_000
+    rng = np.random.default_rng(42)
+    cols = {
+        "unique": np.arange(n),
+        "unique_sorted_runs": np.arange(n) // 2,
+        # either side of the 5% unique threshold, both shuffled and sorted
+        "below_threshold": rng.integers(0, int(0.049 * n), n),
+        "above_threshold": rng.integers(0, int(0.051 * n), n),
+        "below_threshold_sorted": np.sort(rng.integers(0, int(0.049 * n), n)),
+        "above_threshold_sorted": np.arange(n) // 19,
+        "skewed": rng.zipf(1.5, n),
+        "few": rng.integers(0, 20, n),
+    }
+    for name, vals in cols.items():
+        ser = pd.Series(vals.astype(str), dtype="string")
+        ser[::7] = pd.NA
+        expected = category_criteria(ser.nunique(), ser.size)
+        assert is_category_candidate(ser) == expected, name
+        assert pd.api.types.is_categorical_dtype(process_df(pd.DataFrame({name: ser}))[name]) == expected, name
+
+    # high-cardinality columns are ruled out by the sample alone
+    assert not may_be_category(pd.Series(cols["unique"].astype(str), dtype="string"))
+    assert may_be_category(pd.Series(cols["below_threshold"].astype(str), dtype="string"))
+
+
 def test_downcast_numbers():
     # ints
     data = pd.DataFrame(
@@ -118,13 +163,52 @@ def test_downcast_numbers():
     downcast_numbers(data)
     assert [str(x) for x in data.dtypes] == ["uint8", "uint16", "uint32", "uint64", "int8", "int16", "int32", "int64"]
 
-    # floats - currently disabled
-    # data = pd.DataFrame(
-    #     [[1.0, 1.0, 1.0, 1.0, 1.0], [1e3, 1e6, 1e12, 1e30, 1e100]],
-    #     columns=["num1_col", "num2_col", "num3_col", "num4_col", "num5_col"],
-    # )
-    # downcast_numbers(data)
-    # assert [str(x) for x in data.dtypes] == ["float32", "float32", "float32", "float32", "float64"]
+    # floats aren't downcast unless checked, see below
+    data = pd.DataFrame([[1.0, 1.5], [1e3, 1e100]], columns=["num1_col", "num2_col"])
+    downcast_numbers(data)
+    assert [str(x) for x in data.dtypes] == ["float64", "float64"]
+
+
+def test_float32_safe():
+    f32 = np.finfo(np.float32)
+    # exact, including NaN, inf and values that are float32 subnormals
+    assert float32_safe(np.array([0.0, -0.0, 1.5, -1e3, np.nan, np.inf, -np.inf, float(f32.smallest_subnormal)]))
+    assert float32_safe(np.array([], dtype=np.float64))
+    assert float32_safe(np.array([np.nan, np.nan]))
+    # out of range, rather than rounding to inf
+    assert not float32_safe(np.array([1.0, 1e39]))
+    assert not float32_safe(np.array([-1e39]), tolerance=0.5)
+    # float64 subnormals and values that underflow to zero
+    assert not float32_safe(np.array([5e-324]))
+    assert not float32_safe(np.array([1e-50]), tolerance=0.1)
+    # precision lost as a float32 subnormal
+    assert not float32_safe(np.array([1.2345e-42]))
+    assert float32_safe(np.array([1.2345e-42]), tolerance=1e-2)
+    # within a relative tolerance
+    assert not float32_safe(np.array([0.1, 1e30]))
+    assert float32_safe(np.array([0.1, 1e30]), tolerance=1e-7)
+    assert not float32_safe(np.array([0.1 + 1e-6]), tolerance=1e-9)
+
+
+def test_downcast_floats():
+    df = pd.DataFrame(
+        dict(
+            exact=[1.0, 0.5, np.nan],
+            inexact=[0.1, 0.2, 0.3],
+            large=[1.0, 1e100, 2.0],
+            inf=[np.inf, -np.inf, np.nan],
+            ints=[1, 2, 3],
+        )
+    )
+    df["nullable"] = pd.array([0.25, None, 8.0], dtype="Float64")
+    orig = df.copy(deep=True)
+    assert downcast_floats(df) == ["exact", "inf", "nullable"]
+    assert [str(x) for x in df.dtypes] == ["float32", "float64", "float64", "float32", "int64", "Float32"]
+    pd.testing.assert_frame_equal(df.astype(orig.dtypes), orig)
+
+    assert downcast_floats(df, tolerance=1e-6) == ["inexact"]
+    assert df["inexact"].dtype == np.float32
+    assert df["large"].dtype == np.float64
 
 
 def test_timedelta_to_str():
@@ -161,6 +245,229 @@ def test_to_str():
     assert type(data2["cat_obj_col"].cat.categories[0]) == str
 
 
+def test_save_chunked(tmp_path: Path):
+    """Saving in chunks uses a single schema and the same categories as saving in one go"""
+    df = pd.concat([vd.data.cars()] * 20, ignore_index=True)
+    n = len(df)
+    df["str_col"] = [str(x) for x in range(n)]
+    # dtypes that change between chunks
+    df["int_late_col"] = [0] * (n // 2) + list(range(n - n // 2))
+    df["float_late_col"] = [1.0] * (n // 2) + [0.5] * (n - n // 2)
+    df["cat_late_col"] = ["a"] * (n // 2) + ["b", "c"] * ((n - n // 2) // 2)
+
+    fn1, fn2 = mktemp(".arrow", dir=tmp_path), mktemp(".arrow", dir=tmp_path)
+    ArrowFormat.save_file(fn1, df.copy(deep=True))
+    ArrowFormat.save_file(fn2, df.copy(deep=True), chunk_size=500_000)
+    assert pa.ipc.open_file(fn1).num_record_batches == 1
+    assert pa.ipc.open_file(fn2).num_record_batches > 1
+
+    df1 = ArrowFormat.load_file(fn1)
+    df2 = ArrowFormat.load_file(fn2)
+    _check_categories_parsed(df2, ["Name", "Origin", "cat_late_col"])
+    pd.testing.assert_frame_equal(df1, df2, check_dtype=False)
+    assert [str(x) for x in df2.dtypes[-3:]] == ["UInt16", "Float64", "category"]
+
+
+def test_save_chunked_categories(tmp_path: Path):
+    """Saving in chunks keeps existing categoricals, and converts mixed columns, as saving in one go"""
+    n = 20_000
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        dict(
+            cat_int=pd.Categorical(rng.integers(0, 5, n) * 10),
+            cat_ordered=pd.Categorical(
+                rng.choice(["lo", "mid", "hi"], n), categories=["lo", "mid", "hi"], ordered=True
+            ),
+            cat_many=pd.Categorical([f"v{i}" for i in range(n)]),
+            # only strings in the later chunks
+            mixed=pd.Series([1, 2.5] * (n // 4) + ["a", 1.0] * (n // 4), dtype=object),
+        )
+    )
+
+    fn1, fn2 = mktemp(".arrow", dir=tmp_path), mktemp(".arrow", dir=tmp_path)
+    ArrowFormat.save_file(fn1, df.copy(deep=True))
+    ArrowFormat.save_file(fn2, df.copy(deep=True), chunk_size=100_000)
+    assert pa.ipc.open_file(fn2).num_record_batches > 1
+
+    df1 = ArrowFormat.load_file(fn1)
+    df2 = ArrowFormat.load_file(fn2)
+    pd.testing.assert_frame_equal(df1, df2)
+    assert df2["cat_int"].notna().all()
+    assert df2["cat_ordered"].cat.ordered and list(df2["cat_ordered"].cat.categories) == ["lo", "mid", "hi"]
+    assert list(df2["mixed"].cat.categories) == ["1", "1.0", "2.5", "a"]
+
+
+@pytest.mark.parametrize("compression", ["lz4", "zstd"])
+def test_save_compressed(tmp_path: Path, monkeypatch, compression: str):
+    df = pd.concat([vd.data.cars()] * 20, ignore_index=True)
+    fn1, fn2 = mktemp(".arrow", dir=tmp_path), mktemp(".arrow", dir=tmp_path)
+    ArrowFormat.save_file(fn1, df.copy(deep=True))
+    ArrowFormat.save_file(fn2, df.copy(deep=True), compression=compression)
+    assert Path(fn2).stat().st_size < Path(fn1).stat().st_size
+    pd.testing.assert_frame_equal(ArrowFormat.load_file(fn1), ArrowFormat.load_file(fn2))
+
+    # set via the env, but never for DataTable assets, as can't be read by the frontend
+    monkeypatch.setenv("DATAPANE_ARROW_COMPRESSION", compression)
+    fn3 = mktemp(".arrow", dir=tmp_path)
+    ArrowFormat.save_file(fn3, df.copy(deep=True))
+    assert Path(fn3).stat().st_size == Path(fn2).stat().st_size
+    writer = DataTableWriter()
+    assert writer.get_meta(df).mime == ArrowFormat.content_type
+    buf = io.BytesIO()
+    writer.write_file(df, buf)
+    assert len(buf.getvalue()) == Path(fn1).stat().st_size
+
+
+def test_save_downcast_floats(tmp_path: Path, monkeypatch):
+    df = pd.DataFrame(dict(a=np.arange(1000) / 4, b=np.arange(1000) / 10, c=np.arange(1000) * 1e100))
+    assert downcast_tolerance() is None
+
+    def _save_load(**kwargs) -> pd.DataFrame:
+        fn = mktemp(".arrow", dir=tmp_path)
+        ArrowFormat.save_file(fn, df, **kwargs)
+        return ArrowFormat.load_file(fn)
+
+    assert [str(x) for x in _save_load().dtypes] == ["Float64", "Float64", "Float64"]
+    df1 = _save_load(float_tolerance=0.0)
+    assert [str(x) for x in df1.dtypes] == ["Float32", "Float64", "Float64"]
+    assert df1["a"].astype("float64").equals(df["a"])
+    # only downcast if safe in every chunk
+    df1 = _save_load(chunk_size=1000, float_tolerance=1e-6)
+    assert [str(x) for x in df1.dtypes] == ["Float32", "Float32", "Float64"]
+
+    # set via the env, also for arrow tables
+    monkeypatch.setenv("DATAPANE_DOWNCAST_FLOATS", "exact")
+    assert downcast_tolerance() == 0.0
+    fn = mktemp(".arrow", dir=tmp_path)
+    ArrowFormat.save_table(fn, pa.Table.from_pandas(df, preserve_index=False))
+    assert ArrowFormat.load_table(fn).schema.types == [pa.float32(), pa.float64(), pa.float64()]
+    assert process_table(pa.table(dict(a=[0.1, None])), 1e-6).schema.types == [pa.float32()]
+
+    # boolean flags enable exact downcasting, or disable it
+    for env, tolerance in [("1", 0.0), ("Yes", 0.0), ("on", 0.0), ("0", None), ("off", None)]:
+        monkeypatch.setenv("DATAPANE_DOWNCAST_FLOATS", env)
+        assert downcast_tolerance() == tolerance
+
+    monkeypatch.setenv("DATAPANE_DOWNCAST_FLOATS", "1.5")
+    with pytest.raises(ValueError):
+        downcast_tolerance()
+
+
+def test_load_memory_mapped(tmp_path: Path):
+    fn = mktemp(".arrow", dir=tmp_path)
+    df = process_df(vd.data.cars())
+    ArrowFormat.save_file(fn, df.copy(deep=True))
+
+    # the table references the mapped file, rather than allocating
+    allocated = pa.total_allocated_bytes()
+    table = ArrowFormat.load_table(fn)
+    assert pa.total_allocated_bytes() == allocated
+    assert table.num_rows == len(df)
+
+    df1 = ArrowFormat.load_file(fn)
+    assert df1["Name"].dtype == "string[pyarrow]"
+    pd.testing.assert_frame_equal(df, df1)
+
+
+def test_process_table(tmp_path: Path):
+    df = vd.data.cars()
+    df["Duration"] = pd.to_timedelta(df["Cylinders"], unit="h")
+    df.loc[0, "Duration"] = pd.NaT
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # same types as processing via pandas, except for the order of dictionary values,
+    # and floats aren't converted to integers
+    processed = process_table(table)
+    expected = pa.Table.from_pandas(process_df(df.copy(deep=True)), preserve_index=False)
+    for f, f1 in zip(processed.schema, expected.schema):
+        assert f.type == (table.schema.field(f.name).type if pa.types.is_floating(f.type) else f1.type), f.name
+    assert processed.schema.metadata is None
+
+    # readers and large strings (as used by polars) are written without converting to pandas
+    fn = mktemp(".arrow", dir=tmp_path)
+    large_str = table.cast(
+        pa.schema([f.with_type(pa.large_string()) if f.type == pa.string() else f for f in table.schema])
+    )
+    ArrowFormat.save_table(fn, pa.RecordBatchReader.from_batches(large_str.schema, large_str.to_batches(50)))
+    df1 = ArrowFormat.load_file(fn)
+    df2 = save_load_arrow(tmp_path, df)
+    pd.testing.assert_frame_equal(df1, df2, check_categorical=False, check_dtype=False)
+
+    # struct columns are flattened
+    nested = pa.table(dict(a=pa.array([dict(b=1, c=dict(d="x"))] * 3)))
+    assert process_table(nested).column_names == ["a/b", "a/c/d"]
+
+
+@pytest.mark.skipif(PD_VERSION not in PD_1_3_GREATER, reason="Only column-wise processing avoids copies")
+def test_process_df_no_copy(tmp_path: Path):
+    df = vd.data.cars().set_index("Name")
+    df["Duration"] = pd.to_timedelta(df["Cylinders"], unit="h")
+    orig = df.copy(deep=True)
+
+    # the frame is only copied shallowly under copy-on-write, and never mutated by processing
+    df1 = to_df(df)
+    assert np.shares_memory(df1["Miles_per_Gallon"].values, df["Miles_per_Gallon"].values) == cow_enabled()
+    process_df(df1, copy=True)
+    ArrowFormat.save_file(mktemp(".arrow", dir=tmp_path), df1)
+    pd.testing.assert_frame_equal(df1, orig)
+    pd.testing.assert_frame_equal(df, orig)
+
+
+def test_to_df_snapshot(tmp_path: Path):
+    df = vd.data.cars().set_index("Name")
+    orig = df.copy(deep=True)
+
+    # in-place edits after creating the block aren't written to the report
+    table = dp.DataTable(df)
+    df.loc[df.index[0], "Miles_per_Gallon"] = -1
+    df["Origin"].values[0] = "Mars"
+    fn = mktemp(".arrow", dir=tmp_path)
+    ArrowFormat.save_file(fn, table.data)
+    pd.testing.assert_frame_equal(table.data, orig)
+    assert ArrowFormat.load_file(fn)["Miles_per_Gallon"].iloc[0] == orig["Miles_per_Gallon"].iloc[0]
+
+
+def test_truncate_and_summarise():
+    df = vd.data.cars().set_index("Name")
+    assert len(truncate_dataframe(df, max_rows=100, max_cells=None)) == 100
+    assert len(truncate_dataframe(df, max_rows=100, max_cells=400)) == 400 // len(df.columns)
+    assert truncate_dataframe(df, max_rows=1000, max_cells=None) is df
+
+    # the same summary via pandas and arrow
+    df = df.reset_index()
+    summary = summarise_columns(df)
+    summary1 = summarise_columns(pa.Table.from_pandas(df))
+    assert summary[1] == dict(
+        name="Miles_per_Gallon", type="float64", nulls=8, min=9.0, max=46.6, mean=pytest.approx(23.5146, abs=1e-4)
+    )
+    for s, s1 in zip(summary, summary1):
+        assert {**s, "type": None, "min": str(s.get("min"))} == {**s1, "type": None, "min": str(s1.get("min"))}
+
+
+def test_load_csv(tmp_path: Path):
+    df = vd.data.cars()
+    df["Year"] = df["Year"].astype(str)
+    df.loc[0, "Name"] = ""
+    fn = tmp_path / "cars.csv"
+    df.to_csv(fn, index=False)
+
+    # read via arrow, from paths and file objects, with the same types as pandas, e.g. not parsing dates
+    expected = pd.read_csv(fn)
+    pd.testing.assert_frame_equal(CSVFormat.load_file(str(fn)), expected)
+    pd.testing.assert_frame_equal(CSVFormat.load_file(fn), expected)
+    with fn.open("rb") as f:
+        pd.testing.assert_frame_equal(CSVFormat.load_file(f), expected)
+
+    # non utf-8 files
+    fn.write_bytes("a,b\n1,café\n2,naïve déjà vu\n".encode("latin-1") * 10)
+    assert CSVFormat.load_file(str(fn))["b"][:2].tolist() == ["café", "naïve déjà vu"]
+    assert CSVFormat.load_file(fn)["b"][:2].tolist() == ["café", "naïve déjà vu"]
+
+    # falls back to pandas for files arrow can't parse
+    fn.write_text("a,b\n1,2,3\n4,5,6\n")
+    pd.testing.assert_frame_equal(CSVFormat.load_file(str(fn)), pd.read_csv(fn))
+
+
 def test_col_order(tmp_path: Path):
     def _test_order(df: pd.DataFrame):
         # process and compare
@@ -191,6 +498,57 @@ def test_col_order(tmp_path: Path):
     _test_order(data)
 
 
+def test_process_columns(tmp_path: Path):
+    """Column-wise processing matches the frame-wise processing steps"""
+
+    def _process_frame(df: pd.DataFrame) -> pd.DataFrame:
+        convert_axis(df)
+        timedelta_to_str(df)
+        df = df.convert_dtypes()
+        downcast_numbers(df)
+        obj_to_str(df)
+        parse_categories(df)
+        str_to_arrow_str(df)
+        return df
+
+    def _test_df(df: pd.DataFrame):
+        df1 = _process_frame(df.copy(deep=True))
+        df2 = process_df(df, copy=True)
+        pd.testing.assert_frame_equal(df1, df2, check_exact=True)
+        # and produce identical files
+        fn1, fn2 = mktemp(".arrow", dir=tmp_path), mktemp(".arrow", dir=tmp_path)
+        ArrowFormat.save_file(fn1, df1)
+        ArrowFormat.save_file(fn2, df2)
+        assert Path(fn1).read_bytes() == Path(fn2).read_bytes()
+
+    if PD_VERSION not in PD_1_3_GREATER:
+        return
+
+    df = vd.data.cars()
+    _test_df(df)
+    _mk_plan.cache_clear()
+    _test_df(df)
+    assert _mk_plan.cache_info().hits == 1
+
+    _test_df(
+        pd.DataFrame(
+            dict(
+                str_col=[str(x) for x in range(30)] + [None, pd.NA],
+                cat_col=pd.Categorical(["a" for x in range(30)] + [None, pd.NA]),
+                int_na_col=[x for x in range(30)] + [np.nan, np.nan],
+                uint_col=[x for x in range(32)],
+                float_col=[(x + 0.1) for x in range(30)] + [np.nan, np.nan],
+                bool_col=[x % 2 == 0 for x in range(32)],
+                time_col=[timedelta(seconds=x) for x in range(30)] + [pd.NaT, pd.NaT],
+                date_col=[datetime.utcnow() for x in range(30)] + [pd.NaT, pd.NaT],
+                date_tz_col=pd.date_range("2020-01-01", periods=32, tz="UTC"),
+                obj_col=[(str(x), str(x)) for x in range(32)],
+            ),
+            index=pd.Index(list(range(32)), name="idx") + 10,
+        )
+    )
+
+
 def test_e2e_df_processing(tmp_path: Path):
     def _test_df(
         df: pd.DataFrame,
@@ -12,6 +12,22 @@ from datapane.client import config
 from datapane.client.utils import _setup_dp_logging
 
 
+def pytest_addoption(parser):
+    # see tests/benchmarks
+    group = parser.getgroup("bench", "datapane benchmarks")
+    group.addoption("--bench", action="store_true", help="Run the benchmarks")
+    group.addoption("--bench-rows", default="10000", help="Comma-separated numbers of rows to benchmark with")
+    group.addoption("--bench-rounds", type=int, default=5, help="Number of timed rounds per benchmark")
+    group.addoption("--bench-json", default=None, help="Save the results as JSON to this file")
+    group.addoption("--bench-compare", default=None, help="Compare the results to those saved in this JSON file")
+    group.addoption(
+        "--bench-threshold",
+        type=float,
+        default=1.5,
+        help="Fail benchmarks slower than the compared results by this ratio",
+    )
+
+
 @pytest.fixture(autouse=True)
 def dp_setup(request, monkeypatch, tmp_path):
     """
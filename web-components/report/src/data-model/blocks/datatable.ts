@@ -11,6 +11,7 @@ import axios, { AxiosResponse } from "axios";
 import download from "downloadjs";
 import urljoin from "url-join";
 import env from "../../environment";
+import { useRootStore } from "../root-store";
 
 const addQueryParam = (url: string, qp: { k: string; v: string }): string => {
     /**
@@ -60,6 +61,7 @@ const downloadObject = async (url: string, mimeType: string) => {
 };
 
 const AUTO_LOAD_CELLS_LIMIT = 500000;
+export const PAGE_ROWS = 1000;
 
 export type DatasetResponse = {
     data: any[];
@@ -67,6 +69,40 @@ export type DatasetResponse = {
     containsBigInt: boolean;
 };
 
+export type ColumnSummary = {
+    name: string;
+    type: string;
+    nulls: number;
+    min?: any;
+    max?: any;
+    mean?: number;
+};
+
+export type PageResponse = DatasetResponse & {
+    rows: number;
+    offset: number;
+};
+
+export type FilterOp =
+    | "eq"
+    | "ne"
+    | "lt"
+    | "le"
+    | "gt"
+    | "ge"
+    | "contains"
+    | "not_contains"
+    | "begins";
+
+export type TableQuery = {
+    sort: { column: string; descending: boolean }[];
+    filters: { column: string; op: FilterOp; value: any }[];
+    // case-insensitive search over all string columns
+    search?: string;
+};
+
+export const EMPTY_QUERY: TableQuery = { sort: [], filters: [] };
+
 export class DataTableBlock extends AssetBlock {
     public component = markRaw(VDataTableBlock);
     public static captionType: CaptionType = "Table";
@@ -74,8 +110,14 @@ export class DataTableBlock extends AssetBlock {
     public columns: number;
     public size: number;
     public casRef: string;
+    // set when only a preview of the first rows is embedded, with the full dataset fetched on request
+    public previewRows?: number;
+    public summary?: ColumnSummary[];
+    public fullAssetId?: string;
+    public fullSrc?: string;
 
     private webUrl: string;
+    private isServedApp: boolean;
     private _revogridExportPlugin: any;
 
     public get cells(): number {
@@ -83,7 +125,13 @@ export class DataTableBlock extends AssetBlock {
     }
 
     public get deferLoad(): boolean {
-        return this.cells > AUTO_LOAD_CELLS_LIMIT;
+        // previews are small enough to always load
+        return !this.previewRows && this.cells > AUTO_LOAD_CELLS_LIMIT;
+    }
+
+    public get paged(): boolean {
+        // large tables in served apps are queried a page at a time rather than loaded in full
+        return this.isServedApp && (this.deferLoad || !!this.previewRows);
     }
 
     public get exportUrl(): string {
@@ -98,26 +146,49 @@ export class DataTableBlock extends AssetBlock {
         this.size = attributes.size;
         this.casRef = attributes.cas_ref;
         this.webUrl = opts.webUrl;
+        this.isServedApp = !!opts.isServedApp;
+
+        if (attributes.full_src) {
+            const rootStore = useRootStore();
+            const [, fullAssetId] = attributes.full_src.split("://");
+            this.previewRows = Number(attributes.preview_rows);
+            this.summary = attributes.summary
+                ? JSON.parse(attributes.summary)
+                : undefined;
+            this.fullAssetId = fullAssetId;
+            this.fullSrc = rootStore.assetMap[fullAssetId].src;
+        }
 
         this.componentProps = {
             ...this.componentProps,
             streamContents: this.streamContents,
+            streamFull: this.streamFull,
+            fetchPage: this.fetchPage,
             getCsvText: this.getCsvText,
             downloadLocal: this.downloadLocal,
             downloadRemote: this.downloadRemote,
             deferLoad: this.deferLoad,
+            paged: this.paged,
+            previewRows: this.previewRows,
+            rows: this.rows,
+            summary: this.summary,
             cells: this.cells,
             refId: this.refId,
         };
     }
 
-    private fetchDataset(opts: Record<string, string>): Promise<any> {
-        return axios.get(this.src, opts).then((r: AxiosResponse) => {
+    private fetchDataset(
+        opts: Record<string, string>,
+        src: string = this.src,
+    ): Promise<any> {
+        return axios.get(src, opts).then((r: AxiosResponse) => {
             return r.data;
         });
     }
 
-    public streamContents = async (): Promise<DatasetResponse> => {
+    public streamContents = async (
+        src: string = this.src,
+    ): Promise<DatasetResponse> => {
         /**
          * Fetch dataset and convert to arrow format
          */
@@ -125,10 +196,58 @@ export class DataTableBlock extends AssetBlock {
             responseType: "arraybuffer",
         };
         const { apiResponseToArrow } = await import("../datatable/arrow-utils");
-        const arrayBuffer = await this.fetchDataset(opts);
+        const arrayBuffer = await this.fetchDataset(opts, src);
         return apiResponseToArrow(arrayBuffer);
     };
 
+    public streamFull = async (): Promise<DatasetResponse> => {
+        /**
+         * Fetch the full dataset of a previewed table
+         */
+        return this.streamContents(this.fullSrc ?? this.src);
+    };
+
+    public fetchPage = async (
+        offset: number,
+        query: TableQuery = EMPTY_QUERY,
+        limit = PAGE_ROWS,
+    ): Promise<PageResponse> => {
+        /**
+         * Fetch a page of rows from the app server, which returns them in arrow format,
+         * with any sorting, filtering and searching applied on the server over the full dataset
+         */
+        const r = await axios.post(
+            "/app-rpc-call/",
+            {
+                jsonrpc: "2.0",
+                id: 1,
+                method: "datatable.query",
+                params: {
+                    asset: this.fullAssetId ?? this.assetId,
+                    offset,
+                    limit,
+                    sort: query.sort,
+                    filters: query.filters,
+                    search: query.search || undefined,
+                },
+            },
+            { headers: { "Content-Type": "application/json" } },
+        );
+        const { result, error } = r.data;
+        if (!result) {
+            throw new Error(
+                error ? `${error.message} (${error.code})` : "Unknown error",
+            );
+        }
+        const { apiResponseToArrow } = await import("../datatable/arrow-utils");
+        const buf = Uint8Array.from(atob(result.data), (c) => c.charCodeAt(0));
+        return {
+            ...apiResponseToArrow(buf),
+            rows: result.rows,
+            offset: result.offset,
+        };
+    };
+
     public downloadLocal = async (): Promise<void> => {
         /**
          * Download the current state of the DataTable via the client
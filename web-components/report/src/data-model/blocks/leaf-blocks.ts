@@ -63,6 +63,45 @@ const readGcsTextOrJsonFile = <T = string | object | null>(
     return axios.get(url).then((res) => res.data);
 };
 
+const TYPED_ARRAYS: Record<string, any> = {
+    i1: Int8Array,
+    u1: Uint8Array,
+    i2: Int16Array,
+    u2: Uint16Array,
+    i4: Int32Array,
+    u4: Uint32Array,
+    f4: Float32Array,
+    f8: Float64Array,
+};
+
+const decodePlotlyTypedArrays = (json: any): any => {
+    /**
+     * replace plotly's base64-encoded typed arrays, i.e. `{ dtype, bdata, shape }`, with typed arrays,
+     * as these are only supported natively from plotly.js 2.28
+     */
+    if (Array.isArray(json)) {
+        return json.map(decodePlotlyTypedArrays);
+    }
+    if (json === null || typeof json !== "object") {
+        return json;
+    }
+    if (typeof json.bdata === "string" && json.dtype in TYPED_ARRAYS) {
+        const bytes = Uint8Array.from(atob(json.bdata), (c) => c.charCodeAt(0));
+        const arr = new TYPED_ARRAYS[json.dtype](bytes.buffer);
+        if (!json.shape) {
+            return arr;
+        }
+        const [rows, cols] = String(json.shape).split(",").map(Number);
+        return Array.from({ length: rows }, (_, i) =>
+            arr.subarray(i * cols, (i + 1) * cols),
+        );
+    }
+    for (const k of Object.keys(json)) {
+        json[k] = decodePlotlyTypedArrays(json[k]);
+    }
+    return json;
+};
+
 /* Inline blocks */
 
 export class Block {
@@ -229,6 +268,7 @@ export abstract class AssetBlock extends Block {
      */
     public src: string;
     public type: string;
+    public assetId: string;
 
     public constructor(elem: Elem, figure: BlockFigure) {
         super(elem, figure);
@@ -246,6 +286,7 @@ export abstract class AssetBlock extends Block {
         }
 
         const { src, mime } = rootStore.assetMap[assetId];
+        this.assetId = assetId;
         this.src = src;
         this.type = mime;
         this.componentProps = {
@@ -327,16 +368,58 @@ export class BokehBlock extends PlotAssetBlock {
     public component = markRaw(VBokehBlock);
 }
 
+type VegaDataset = { name: string; values: any[] };
+
+// datasets shared between Vega plots, by asset ID, so each is only fetched once
+const vegaDatasets = new Map<string, Promise<VegaDataset>>();
+
 export class VegaBlock extends PlotAssetBlock {
     public component = markRaw(VVegaBlock);
+    // the asset IDs of any shared datasets, referenced by name from the spec
+    public datasetIds: string[];
+
+    public constructor(elem: Elem, figure: BlockFigure) {
+        super(elem, figure);
+        const { datasets } = elem.attributes;
+        this.datasetIds = datasets
+            ? datasets.split(" ").map((ref: string) => ref.split("://")[1])
+            : [];
+    }
+
+    private fetchDataset(assetId: string): Promise<VegaDataset> {
+        if (!vegaDatasets.has(assetId)) {
+            const rootStore = useRootStore();
+            vegaDatasets.set(
+                assetId,
+                readGcsTextOrJsonFile<VegaDataset>(
+                    rootStore.assetMap[assetId].src,
+                ),
+            );
+        }
+        return vegaDatasets.get(assetId)!;
+    }
+
+    protected async fetchAssetData(): AssetResource {
+        const [spec, datasets] = await Promise.all([
+            readGcsTextOrJsonFile<any>(this.src),
+            Promise.all(this.datasetIds.map((id) => this.fetchDataset(id))),
+        ]);
+        for (const { name, values } of datasets) {
+            spec.datasets = { ...spec.datasets, [name]: values };
+        }
+        return spec;
+    }
 }
 
 export class PlotlyBlock extends PlotAssetBlock {
     public component = markRaw(VPlotlyBlock);
 
     protected async fetchAssetData(): AssetResource {
-        const res = await readGcsTextOrJsonFile<string>(this.src);
-        return JSON.parse(res);
+        const res = await readGcsTextOrJsonFile<string | object>(this.src);
+        // NOTE - older assets are double-encoded, as a JSON string of the figure
+        return decodePlotlyTypedArrays(
+            typeof res === "string" ? JSON.parse(res) : res,
+        );
     }
 }
 
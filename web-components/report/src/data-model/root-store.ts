@@ -20,6 +20,7 @@ const mkBlockMap = (
     isLightProse: boolean,
     isOrg: boolean,
     webUrl?: string,
+    isServedApp = false,
 ): BlockTest[] => {
     /**
      * class_: The deserialized class that maps to a JSON `elem`
@@ -36,7 +37,7 @@ const mkBlockMap = (
         {
             class_: b.DataTableBlock,
             test: maps.jsonIsArrowTable,
-            opts: { webUrl },
+            opts: { webUrl, isServedApp },
         },
         { class_: b.CodeBlock, test: maps.jsonIsCode },
         { class_: b.VegaBlock, test: maps.jsonIsVega },
@@ -196,7 +197,12 @@ export const useRootStore = defineStore("root", () => {
         const { view_xml, assets } = parseAppData(appData);
 
         blockMap.push(
-            ...mkBlockMap(meta.isLightProse, meta.isOrg, meta.webUrl),
+            ...mkBlockMap(
+                meta.isLightProse,
+                meta.isOrg,
+                meta.webUrl,
+                !localAppData,
+            ),
         );
 
         Object.assign(assetMap, assets);
@@ -86,5 +86,7 @@ export const jsonIsBokeh = (json: any): boolean =>
 export const jsonIsPlotly = (json: any): boolean =>
     jsonType(json) === "application/vnd.plotly.v1+json";
 
+// NOTE - matplotlib plots may also be saved as raster images, which are displayed the same way
 export const jsonIsSvg = (json: any): boolean =>
-    jsonType(json).includes("image/svg");
+    jsonType(json).includes("image/svg") ||
+    (json.name === "Plot" && jsonType(json).startsWith("image/"));